@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""This module contains batch compression functions of the pdfebc program. A batch consists of
+several source directories, each with its own output directory. All files of a batch are
+compressed by one shared pool of worker processes.
+
+The jobs of a batch are kept in a :py:class:`pdfebc_core.job_table.JobTable`, which stays
+small for batches of millions of files, and which can be saved to a file so that an
+interrupted batch can be continued where it stopped.
+
+.. module:: batch
+    :platform: Unix
+    :synopsis: Batch compression of multiple directories with a shared worker pool.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import daiquiri
+from .compress import (compress_pdf, _get_pdf_filenames_at, _output_is_complete,
+                       _remove_stale_temporary_outputs, _check_ghostscript_ahead)
+from .scheduling import MemoryBudgetScheduler, JobResult
+from .outputs import ensure_directory, plan_output_paths
+from .priority import LoadAdaptiveLimit, validate_priority, apply_worker_priority
+from .job_table import JobTable, CompressionJob, DONE, FAILED
+
+BATCH_STARTING = """Compressing {} PDF files from {} directories with {} workers ..."""
+DIRECTORY_PROGRESS = "[{}/{}] '{}' done"
+FILE_FAILED = "Failed to compress '{}': {}"
+JOB_TABLE_MISMATCH = "Job table '{}' belongs to another batch, with directories {}"
+BATCH_DONE = """Batch done! {} files compressed, {} failed.
+{} bytes in, {} bytes out, {:.1f} seconds"""
+
+# Amount of jobs per worker that are handed to the process pool ahead of time, so that a
+# worker does not wait for the next job while the results are consumed.
+SUBMIT_AHEAD = 4
+# Minimum amount of seconds between two saves of the job states during a batch.
+STATE_SAVE_INTERVAL = 5.0
+
+LOGGER = daiquiri.getLogger(__name__)
+
+# Whether the priority of the batch has been applied to this worker process, see
+# _compress_in_worker.
+_priority_applied = False
+
+DirectoryProgress = namedtuple('DirectoryProgress',
+                               ['source_directory', 'output_directory', 'done', 'total',
+                                'source_path', 'output_path', 'error'])
+
+BatchSummary = namedtuple('BatchSummary',
+                          ['directories', 'files', 'failed', 'input_bytes', 'output_bytes',
+                           'elapsed'])
+
+def plan_jobs(directory_pairs, resume=False):
+    """Find all files to compress in the given directories, ordered with the largest file first.
+    Starting the largest files first keeps a few big files from being left for last, which
+    reduces the total time of the batch. The output directories are created if they do not
+    exist, and files with the same name that go to the same output directory get different
+    output paths, see :py:func:`pdfebc_core.outputs.plan_output_paths`.
+
+    Args:
+        directory_pairs (list((str, str))): Pairs of source and output directories.
+        resume (bool): Whether to leave out files that have complete outputs from a previous
+        run.
+    Returns:
+        list(CompressionJob): The jobs.
+    Raises:
+        ValueError
+    """
+    return list(plan_job_table(directory_pairs, resume))
+
+def plan_job_table(directory_pairs, resume=False):
+    """Like :py:func:`plan_jobs`, but return the jobs as a compact
+    :py:class:`pdfebc_core.job_table.JobTable`. Only the paths of the files that go to one
+    output directory are held as strings at a time.
+
+    Args:
+        directory_pairs (list((str, str))): Pairs of source and output directories.
+        resume (bool): Whether to leave out files that have complete outputs from a previous
+        run.
+    Returns:
+        JobTable: The jobs.
+    Raises:
+        ValueError
+    """
+    directory_pairs = list(directory_pairs)
+    by_output_directory = OrderedDict()
+    for directory_index, (source_directory, output_directory) in enumerate(directory_pairs):
+        if not os.path.isdir(source_directory):
+            raise ValueError("%s is not a directory!" % source_directory)
+        ensure_directory(output_directory)
+        if resume:
+            _remove_stale_temporary_outputs(output_directory)
+        key = os.path.realpath(output_directory)
+        by_output_directory.setdefault(key, (output_directory, []))[1].append(directory_index)
+    table = JobTable(directory_pairs)
+    for output_directory, directory_indexes in by_output_directory.values():
+        sources = [(source_path, directory_index) for directory_index in directory_indexes
+                   for source_path in _get_pdf_filenames_at(directory_pairs[directory_index][0])]
+        output_paths = plan_output_paths([source_path for source_path, _ in sources],
+                                         output_directory)
+        for source_path, directory_index in sources:
+            output_path = output_paths[source_path]
+            if resume and _output_is_complete(source_path, output_path):
+                continue
+            table.add(source_path, output_path, os.stat(source_path).st_size, directory_index)
+    table.sort_by_size()
+    return table
+
+def compress_directories(directory_pairs, ghostscript_binary, engine=None, max_workers=None,
+                         resume=False, memory_budget=None, priority=None, load_threshold=None,
+                         job_table_path=None):
+    """Compress all PDF files in several source directories into their respective output
+    directories, using one process pool for all files. This is a generator function that
+    yields a DirectoryProgress each time a file is done, and a BatchSummary at the end.
+
+    If a memory budget is given, the files are compressed by a
+    :py:class:`pdfebc_core.scheduling.MemoryBudgetScheduler` instead of a plain process pool.
+
+    The workers, and the Ghostscript processes they start, can be run with a lower priority,
+    see :py:mod:`pdfebc_core.priority`. With a load threshold, fewer files are compressed
+    concurrently while the load average of the host is above it.
+
+    With a job table path, the planned jobs are saved to that file, and the states of the jobs
+    are saved every few seconds while the batch runs. If the file already exists, the batch is
+    not planned again, but continues with the jobs in the file that are not done. Remove the
+    file to plan the batch from scratch, e.g. to pick up files that were added since.
+
+    A file that fails to compress does not stop the batch. The error is instead reported in
+    the DirectoryProgress of that file.
+
+    Args:
+        directory_pairs (list((str, str))): Pairs of source and output directories.
+        ghostscript_binary (str): Name of the Ghostscript binary.
+        engine (CompressionEngine or FastestEnginePolicy): Engine, or policy for selecting an
+        engine per file. Defaults to Ghostscript with the given binary.
+        max_workers (int): Amount of worker processes. Defaults to the amount of CPUs.
+        resume (bool): Whether to resume an earlier, interrupted run.
+        memory_budget (int): Memory budget in bytes for the concurrently running jobs.
+        priority (pdfebc_core.priority.WorkerPriority): Priority of the workers.
+        load_threshold (float): Load average above which the concurrency is lowered.
+        job_table_path (str): Path to a file to keep the jobs of the batch in.
+    Raises:
+        ValueError
+        FileNotFoundError
+        subprocess.SubprocessError
+    """
+    if priority is not None:
+        validate_priority(priority)
+    directory_pairs = [tuple(pair) for pair in directory_pairs]
+    start_time = time.monotonic()
+    if job_table_path is not None and os.path.exists(job_table_path):
+        table = JobTable.load(job_table_path)
+        if table.directory_pairs != directory_pairs:
+            raise ValueError(JOB_TABLE_MISMATCH.format(job_table_path, table.directory_pairs))
+        if resume:
+            for output_directory in {output for _, output in directory_pairs}:
+                _remove_stale_temporary_outputs(output_directory)
+    else:
+        table = plan_job_table(directory_pairs, resume)
+        if job_table_path is not None:
+            table.save(job_table_path)
+    _check_ghostscript_ahead(engine, ghostscript_binary,
+                             (job.source_path for job in table.pending()))
+    totals = [0] * len(directory_pairs)
+    for job in table.pending():
+        totals[job.directory_index] += 1
+    jobs = sum(totals)
+    done = [0] * len(directory_pairs)
+    max_workers = max_workers or os.cpu_count() or 1
+    load_limit = LoadAdaptiveLimit(max_workers, load_threshold) if load_threshold else None
+    LOGGER.info(BATCH_STARTING.format(jobs, len(directory_pairs), max_workers))
+    input_bytes = output_bytes = failed = 0
+    if memory_budget:
+        scheduler = MemoryBudgetScheduler(memory_budget, max_workers, priority, load_limit)
+        results = scheduler.run(table.pending(), ghostscript_binary, engine)
+    else:
+        results = _run_in_pool(table.pending(), ghostscript_binary, engine, max_workers,
+                               priority, load_limit)
+    last_save = time.monotonic()
+    try:
+        for job, error, _ in results:
+            source_directory, output_directory = directory_pairs[job.directory_index]
+            done[job.directory_index] += 1
+            table.set_state(job.job_index, DONE if error is None else FAILED)
+            if job_table_path is not None and \
+                    time.monotonic() - last_save >= STATE_SAVE_INTERVAL:
+                table.save_states(job_table_path)
+                last_save = time.monotonic()
+            if error is None:
+                input_bytes += job.size
+                output_bytes += os.stat(job.output_path).st_size
+                LOGGER.info(DIRECTORY_PROGRESS.format(done[job.directory_index],
+                                                      totals[job.directory_index],
+                                                      job.output_path))
+            else:
+                failed += 1
+                LOGGER.error(FILE_FAILED.format(job.source_path, error))
+            yield DirectoryProgress(source_directory=source_directory,
+                                    output_directory=output_directory,
+                                    done=done[job.directory_index],
+                                    total=totals[job.directory_index],
+                                    source_path=job.source_path,
+                                    output_path=job.output_path,
+                                    error=error)
+    finally:
+        if job_table_path is not None:
+            table.save_states(job_table_path)
+    elapsed = time.monotonic() - start_time
+    LOGGER.info(BATCH_DONE.format(jobs - failed, failed, input_bytes, output_bytes, elapsed))
+    yield BatchSummary(directories=len(directory_pairs), files=jobs, failed=failed,
+                       input_bytes=input_bytes, output_bytes=output_bytes, elapsed=elapsed)
+
+def _run_in_pool(jobs, ghostscript_binary, engine, max_workers, priority=None,
+                 load_limit=None):
+    """Run compression jobs in a process pool. This is a generator function that yields a
+    JobResult for each job as it finishes.
+
+    Jobs are taken from the iterable as they are submitted, so that a large batch is not held
+    by the pool all at once. Without a load limit, a few jobs per worker are submitted ahead
+    of time. With one, only as many jobs as the limit allows are submitted at a time.
+    """
+    jobs = iter(jobs)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while True:
+            limit = max_workers * SUBMIT_AHEAD if load_limit is None else load_limit.limit()
+            while len(running) < limit:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                if priority is None:
+                    future = executor.submit(compress_pdf, job.source_path, job.output_path,
+                                             ghostscript_binary, engine)
+                else:
+                    future = executor.submit(_compress_in_worker, priority, job.source_path,
+                                             job.output_path, ghostscript_binary, engine)
+                running[future] = job
+            if not running:
+                return
+            timeout = None if load_limit is None else load_limit.interval
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield JobResult(job=running.pop(future), error=future.exception(),
+                                peak_rss=None)
+
+def _compress_in_worker(priority, *args):
+    """Compress a file in a worker process of a pool, applying the priority of the batch to the
+    worker before its first file. The pools do not use an initializer for this, as
+    ProcessPoolExecutor only takes one from Python 3.7.
+
+    Args:
+        priority (pdfebc_core.priority.WorkerPriority): The priority.
+        *args: Arguments to :py:func:`pdfebc_core.compress.compress_pdf`.
+    Returns:
+        CompressionResult: The result.
+    """
+    global _priority_applied
+    if not _priority_applied:
+        apply_worker_priority(priority)
+        _priority_applied = True
+    return compress_pdf(*args)
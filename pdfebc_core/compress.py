@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """This module contains the PDF manipulation functions of the pdfebc program. Ghostscript is used to
-compress PDF files.
+compress PDF files by default, but any engine from the engines module may be used instead.
 
 .. module:: compress
     :platform: Unix
@@ -10,13 +10,36 @@ compress PDF files.
 """
 import os
 import sys
+import time
+import uuid
+import shutil
+import socket
 import subprocess
+from collections import namedtuple
 import daiquiri
-from .misc_utils import if_callable_call_with_formatted_string
+from . import events
+from .misc_utils import if_callable_call_with_formatted_string, group_identical_files
+from .engines import resolve_engine, GhostscriptEngine, FastestEnginePolicy
+from .ghostscript import check_ghostscript
+from .outputs import ensure_directory, plan_output_paths, lock_output
+from .inspection import inspect_pdf
+from .tracing import span, traced
+from .disk_space import estimate_output_size, is_out_of_space
 
 BYTES_PER_MEGABYTE = 1024**2
 FILE_SIZE_LOWER_LIMIT = BYTES_PER_MEGABYTE
+# Files that are not expected to shrink by at least this fraction are copied instead.
+MIN_EXPECTED_SAVINGS = 0.1
 PDF_EXTENSION = ".pdf"
+# Suffix of the temporary files that outputs are written to before being moved into place.
+TEMPORARY_OUTPUT_SUFFIX = ".part"
+# Separates the host name from the rest of the name of a temporary output.
+TEMPORARY_HOST_SEPARATOR = "@"
+# Amount of seconds after the last write that a temporary output from another host is stale.
+STALE_TEMPORARY_OUTPUT_AGE = 6 * 60 * 60
+# Amount of bytes at the end of an output file that must contain the end-of-file marker.
+EOF_MARKER_SEARCH_SIZE = 1024
+EOF_MARKER = b"%%EOF"
 
 COMPRESSING_MULTIPLE = """Source directory: '{}'
 Output directory: '{}'
@@ -28,11 +51,27 @@ FILE_DONE = "File done! Result saved to '{}'"
 NOT_COMPRESSING = """Not compressing '{}'
 Reason: Actual file size is {} bytes,
 lower limit for compression is {} bytes"""
-GS_NOT_INSTALLED = """Ghostscript not installed or not aliased to '{}'.
-Exiting ..."""
+NOT_COMPRESSING_UNPROMISING = """Not compressing '{}'
+Reason: {} is expected to save {:.0%},
+lower limit for compression is {:.0%}"""
+ALREADY_DONE = "Output '{}' is already complete, skipping '{}'"
+WRITTEN_CONCURRENTLY = "Output '{}' was written by another process, skipping '{}'"
+REMOVING_STALE_OUTPUT = "Removing stale temporary output '{}'"
+FILE_FAILED = "Failed to compress '{}': {}"
+DUPLICATE = "'{}' is identical to '{}', result linked to '{}'"
+DEDUPLICATION_SAVED = "Deduplication saved compressing {} files, {} bytes in total"
+GS_FOUND = "Using Ghostscript {} at '{}'"
+OUT_OF_SPACE = """Stopping, '{}' is out of space with {} files left
+Free some space and run again with resume to continue"""
 
 LOGGER = daiquiri.getLogger(__name__)
 
+CompressionResult = namedtuple('CompressionResult',
+                               ['source_path', 'output_path', 'input_size', 'output_size',
+                                'skip_reason', 'elapsed'])
+CompressionResult.__new__.__defaults__ = (None,)
+
+@traced("scan")
 def _get_pdf_filenames_at(source_directory):
     """Find all PDF files in the specified directory.
 
@@ -51,55 +90,474 @@ def _get_pdf_filenames_at(source_directory):
             for filename in os.listdir(source_directory)
             if filename.endswith(PDF_EXTENSION)]
 
-def compress_pdf(filepath, output_path, ghostscript_binary):
+def compress_pdf(filepath, output_path, ghostscript_binary, engine=None, progress=None,
+                 profile=None):
     """Compress a single PDF file.
 
+    The output is first written to a temporary file in the output directory, which is moved
+    into place once it is complete. A killed run therefore never leaves a truncated file at
+    the output path. While the output is written, an advisory lock is held on it (see
+    :py:func:`pdfebc_core.outputs.lock_output`). If another process holds the lock, this waits
+    for it, and skips the file if the other process left a complete output.
+
     Args:
         filepath (str): Path to the PDF file.
         output_path (str): Output path.
         ghostscript_binary (str): Name/alias of the Ghostscript binary.
+        engine (CompressionEngine or FastestEnginePolicy): Engine, or policy for selecting an
+        engine, to compress with. Defaults to Ghostscript with the given binary.
+        progress (function): Called with the current page and the total amount of pages (or
+        None if unknown) as the engine processes pages.
+        profile (pdfebc_core.profiles.DeviceProfile): Device profile to tune Ghostscript to.
+        Only used if no engine is given. To use a profile for a batch, pass
+        ``GhostscriptEngine(ghostscript_binary, profile)`` as its engine.
+
+    Returns:
+        CompressionResult: The result. If the file was copied instead of compressed, the reason
+        is given by skip_reason.
 
     Raises:
         ValueError
         FileNotFoundError
+        subprocess.CalledProcessError
     """
     if not filepath.endswith(PDF_EXTENSION):
         raise ValueError("Filename must end with .pdf!\n%s does not." % filepath)
+    if engine is None and profile is not None:
+        engine = GhostscriptEngine(ghostscript_binary, profile)
+    started = time.monotonic()
+    file_size = os.stat(filepath).st_size
+    with span("compress_pdf", source_path=filepath, input_size=file_size), \
+         lock_output(output_path) as waited:
+        if waited and _output_is_complete(filepath, output_path):
+            skip_reason = WRITTEN_CONCURRENTLY.format(output_path, filepath)
+            LOGGER.info(skip_reason)
+            return CompressionResult(source_path=filepath, output_path=output_path,
+                                     input_size=file_size,
+                                     output_size=os.stat(output_path).st_size,
+                                     skip_reason=skip_reason,
+                                     elapsed=time.monotonic() - started)
+        output_size, skip_reason = _compress_to(filepath, file_size, output_path,
+                                                ghostscript_binary, engine, progress)
+    LOGGER.info(FILE_DONE.format(output_path))
+    return CompressionResult(source_path=filepath, output_path=output_path,
+                             input_size=file_size, output_size=output_size,
+                             skip_reason=skip_reason, elapsed=time.monotonic() - started)
+
+def _compress_to(filepath, file_size, output_path, ghostscript_binary, engine, progress):
+    """Compress or copy a file to a temporary file, and move it to the output path. See
+    :py:func:`compress_pdf`.
+
+    Returns:
+        (int, str): The size of the output and the reason for copying instead of compressing,
+        or None if the file was compressed.
+    """
+    temporary_path = _temporary_output_path(output_path)
+    skip_reason = None
     try:
-        file_size = os.stat(filepath).st_size
         if file_size < FILE_SIZE_LOWER_LIMIT:
-            LOGGER.info(NOT_COMPRESSING.format(filepath, file_size, FILE_SIZE_LOWER_LIMIT))
-            process = subprocess.Popen(['cp', filepath, output_path])
+            skip_reason = NOT_COMPRESSING.format(filepath, file_size, FILE_SIZE_LOWER_LIMIT)
+        else:
+            with span("inspect"):
+                inspection = inspect_pdf(filepath)
+                engine = resolve_engine(engine, filepath, ghostscript_binary, inspection)
+            expected_savings = 1 - engine.expected_ratio(inspection)
+            if inspection is not None and expected_savings < MIN_EXPECTED_SAVINGS:
+                skip_reason = NOT_COMPRESSING_UNPROMISING.format(filepath, engine.name,
+                                                                 expected_savings,
+                                                                 MIN_EXPECTED_SAVINGS)
+        if skip_reason:
+            LOGGER.info(skip_reason)
+            with span("copy"):
+                _copy(filepath, temporary_path)
         else:
             LOGGER.info(COMPRESSING.format(filepath))
-            process = subprocess.Popen(
-                [ghostscript_binary, "-sDEVICE=pdfwrite",
-                 "-dCompatabilityLevel=1.4", "-dPDFSETTINGS=/ebook",
-                 "-dNOPAUSE", "-dQUIET", "-dBATCH",
-                 "-sOutputFile=%s" % output_path, filepath]
-                )
+            with span(engine.name, children=True):
+                engine.compress(filepath, temporary_path, progress)
+        with span("move_into_place"):
+            output_size = os.stat(temporary_path).st_size
+            os.replace(temporary_path, output_path)
+    except BaseException:
+        _remove_if_exists(temporary_path)
+        raise
+    return output_size, skip_reason
+
+def _copy(filepath, output_path):
+    """Copy a file that is not worth compressing to the output path.
+
+    Args:
+        filepath (str): Path to the PDF file.
+        output_path (str): Output path.
+    Raises:
+        OSError
+    """
+    shutil.copyfile(filepath, output_path)
+
+def _temporary_output_path(output_path):
+    """Create a unique, hidden path next to the output path to write the output to. The path
+    contains the pid and host name of the writing process, so that stale temporary files can be
+    told apart from ones that are being written to, also on output storage that is shared by
+    several hosts.
+
+    Args:
+        output_path (str): Output path.
+    Returns:
+        str: The temporary path.
+    """
+    directory, basename = os.path.split(output_path)
+    temporary_name = ".{}.{}-{}{}{}{}".format(basename, os.getpid(), uuid.uuid4().hex[:8],
+                                             TEMPORARY_HOST_SEPARATOR, socket.gethostname(),
+                                             TEMPORARY_OUTPUT_SUFFIX)
+    return os.path.join(directory, temporary_name)
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
     except FileNotFoundError:
-        msg = GS_NOT_INSTALLED.format(ghostscript_binary)
-        raise FileNotFoundError(msg)
-    process.communicate()
-    LOGGER.info(FILE_DONE.format(output_path))
+        pass
+
+def _output_is_complete(source_path, output_path):
+    """Check if an output from a previous run can be trusted.
+
+    Args:
+        source_path (str): Path to the source PDF file.
+        output_path (str): Path to the output PDF file.
+    Returns:
+        bool: True if the output exists, is newer than the source and ends with an end-of-file
+        marker.
+    """
+    try:
+        output_stat = os.stat(output_path)
+    except FileNotFoundError:
+        return False
+    if output_stat.st_mtime < os.stat(source_path).st_mtime:
+        return False
+    with open(output_path, 'rb') as file:
+        file.seek(max(0, output_stat.st_size - EOF_MARKER_SEARCH_SIZE))
+        return EOF_MARKER in file.read()
+
+def _remove_stale_temporary_outputs(output_directory):
+    """Remove temporary outputs left behind by processes that are no longer running.
+
+    A temporary output written on this host is stale if its process is not running. Whether
+    a process on another host is running can't be checked, so a temporary output from another
+    host, or without a host in its name, is stale if it has not been written to for
+    STALE_TEMPORARY_OUTPUT_AGE seconds.
+
+    Args:
+        output_directory (str): The output directory.
+    """
+    hostname = socket.gethostname()
+    now = time.time()
+    for filename in os.listdir(output_directory):
+        if not (filename.startswith(".") and filename.endswith(TEMPORARY_OUTPUT_SUFFIX)):
+            continue
+        path = os.path.join(output_directory, filename)
+        name, _, host = filename[:-len(TEMPORARY_OUTPUT_SUFFIX)].rpartition(
+            TEMPORARY_HOST_SEPARATOR)
+        if host == hostname:
+            try:
+                pid = int(name.rsplit(".", 1)[1].split("-")[0])
+            except (IndexError, ValueError):
+                continue
+            stale = not _process_is_alive(pid)
+        else:
+            try:
+                stale = now - os.stat(path).st_mtime > STALE_TEMPORARY_OUTPUT_AGE
+            except FileNotFoundError:
+                continue
+        if stale:
+            LOGGER.info(REMOVING_STALE_OUTPUT.format(path))
+            _remove_if_exists(path)
 
-def compress_multiple_pdfs(source_directory, output_directory, ghostscript_binary):
+def _process_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def compress_multiple_pdfs(source_directory, output_directory, ghostscript_binary, engine=None,
+                           resume=False, deduplicate=True, space_guard=None):
     """Compress all PDF files in the current directory and place the output in the
-    given output directory. This is a generator function that first yields the amount
-    of files to be compressed, and then yields the output path of each file.
+    given output directory. This is a generator function that yields the progress events of
+    the compression, see :py:func:`produce_compression_events`.
 
     Args:
         source_directory (str): Filepath to the source directory.
         output_directory (str): Filepath to the output directory.
         ghostscript_binary (str): Name of the Ghostscript binary.
+        engine (CompressionEngine or FastestEnginePolicy): Engine, or policy for selecting an
+        engine per file. Defaults to Ghostscript with the given binary.
+        resume (bool): Whether to resume an earlier, interrupted run.
+        deduplicate (bool): Whether to compress files with identical contents only once.
+        space_guard (pdfebc_core.disk_space.DiskSpaceGuard): If given, the free space of the
+        output directory is checked before and during the batch.
+    Raises:
+        ValueError
+        pdfebc_core.disk_space.DiskSpaceError
+    """
+    yield from events.iterate(_producer(source_directory, output_directory, ghostscript_binary,
+                                        engine, resume, deduplicate, space_guard))
 
-    Returns:
-        list(str): paths to outputs.
+async def compress_multiple_pdfs_async(source_directory, output_directory, ghostscript_binary,
+                                       engine=None, resume=False, deduplicate=True,
+                                       space_guard=None):
+    """Like :py:func:`compress_multiple_pdfs`, but is an async iterator. The compression runs
+    in a separate thread, so the event loop is not blocked.
+    """
+    async for event in events.aiterate(_producer(source_directory, output_directory,
+                                                 ghostscript_binary, engine, resume,
+                                                 deduplicate, space_guard)):
+        yield event
+
+def compress_multiple_pdfs_with_callback(source_directory, output_directory,
+                                         ghostscript_binary, callback, engine=None,
+                                         resume=False, deduplicate=True, space_guard=None):
+    """Like :py:func:`compress_multiple_pdfs`, but passes the events to a callback instead of
+    yielding them.
+
+    Args:
+        callback (function): Called with each event. Nothing is called if it is not callable.
+    """
+    events.with_callback(_producer(source_directory, output_directory, ghostscript_binary,
+                                   engine, resume, deduplicate, space_guard), callback)
+
+def produce_compression_events(emit, source_directory, output_directory, ghostscript_binary,
+                               engine=None, resume=False, deduplicate=True, space_guard=None):
+    """Compress all PDF files in the source directory, and report progress by emitting events.
+    A :py:class:`pdfebc_core.events.Started` event is emitted first, and a
+    :py:class:`pdfebc_core.events.Finished` event last. In between, each file gets a FileStarted
+    event, possibly some FileProgress events, and a FileDone, Skipped, Deduplicated or Failed
+    event. A file that fails to compress does not stop the others.
+
+    With deduplication, files with identical contents are grouped before compressing (by size,
+    and then by hash for files of the same size). Only the first file of each group is
+    compressed, and its output is hard linked (or copied, if linking is not possible) to the
+    outputs of the others.
+
+    In resume mode, files with complete outputs from a previous run are skipped, and temporary
+    outputs left behind by crashed runs are removed.
+
+    With a space guard, the batch is not started if the output volume lacks room for the
+    estimated outputs, and pauses before a file while the volume is short of space. If the
+    guard gives up waiting, or a file fails because the volume is full, the remaining files are
+    left alone and a :py:class:`pdfebc_core.events.Stopped` event is emitted before the
+    Finished event. With a guard, any failure while the free space is below the watermark
+    counts as a full volume. The batch can then be continued in resume mode.
+
+    The output directory is created if it does not exist.
+
+    Args:
+        emit (function): Called with each event.
+        source_directory (str): Filepath to the source directory.
+        output_directory (str): Filepath to the output directory.
+        ghostscript_binary (str): Name of the Ghostscript binary.
+        engine (CompressionEngine or FastestEnginePolicy): Engine, or policy for selecting an
+        engine per file. Defaults to Ghostscript with the given binary.
+        resume (bool): Whether to resume an earlier, interrupted run.
+        deduplicate (bool): Whether to compress files with identical contents only once.
+        space_guard (pdfebc_core.disk_space.DiskSpaceGuard): If given, the free space of the
+        output directory is checked before and during the batch.
+    Raises:
+        ValueError
+        FileNotFoundError
+        subprocess.SubprocessError
+        pdfebc_core.disk_space.DiskSpaceError
     """
     source_paths = _get_pdf_filenames_at(source_directory)
-    yield len(source_paths)
-    for source_path in source_paths:
-        output = os.path.join(output_directory, os.path.basename(source_path))
-        compress_pdf(source_path, output, ghostscript_binary)
-        yield output
+    _check_ghostscript_ahead(engine, ghostscript_binary, source_paths)
+    ensure_directory(output_directory)
+    output_paths = plan_output_paths(source_paths, output_directory)
+    if resume:
+        _remove_stale_temporary_outputs(output_directory)
+    if deduplicate:
+        groups = group_identical_files(source_paths)
+    else:
+        groups = [[source_path] for source_path in source_paths]
+    if space_guard is not None:
+        needed = _estimate_needed_space(groups, output_paths, engine, resume)
+        space_guard.check(output_directory, sum(needed.values()))
+    LOGGER.info(COMPRESSING_MULTIPLE.format(source_directory, output_directory,
+                                            len(source_paths)))
+    emit(events.Started(source_directory, output_directory, len(source_paths)))
+    counts = {events.FileDone: 0, events.Skipped: 0, events.Failed: 0,
+              events.Deduplicated: 0}
+    saved_bytes = 0
+    remaining = len(source_paths)
+    stop_reason = None
+    for original_path, *duplicate_paths in groups:
+        original_output = output_paths[original_path]
+        if space_guard is not None and not space_guard.wait_for_room(output_directory,
+                                                                     needed[original_path]):
+            stop_reason = OUT_OF_SPACE.format(output_directory, remaining)
+            break
+        original_event = _compress_and_emit(emit, original_path, original_output,
+                                            ghostscript_binary, engine, resume)
+        counts[type(original_event)] += 1
+        for source_path in duplicate_paths:
+            output = output_paths[source_path]
+            emit(events.FileStarted(source_path, output))
+            if isinstance(original_event, events.Failed):
+                event = events.Failed(source_path, original_event.error)
+            elif resume and _output_is_complete(source_path, output):
+                event = events.Skipped(source_path, output, ALREADY_DONE.format(output,
+                                                                              source_path))
+            else:
+                try:
+                    _link_or_copy(original_output, output)
+                except OSError as exc:
+                    LOGGER.error(FILE_FAILED.format(source_path, exc))
+                    event = events.Failed(source_path, exc)
+                else:
+                    size = os.stat(source_path).st_size
+                    LOGGER.info(DUPLICATE.format(source_path, original_path, output))
+                    event = events.Deduplicated(source_path, output, original_path, size)
+                    saved_bytes += size
+            counts[type(event)] += 1
+            emit(event)
+        remaining -= 1 + len(duplicate_paths)
+        if isinstance(original_event, events.Failed) and _is_out_of_space(
+                original_event.error, output_directory, space_guard):
+            if remaining:
+                stop_reason = OUT_OF_SPACE.format(output_directory, remaining)
+            break
+    if stop_reason:
+        LOGGER.error(stop_reason)
+        emit(events.Stopped(output_directory, stop_reason, remaining))
+    LOGGER.info(ALL_FILES_DONE.format(output_directory))
+    if saved_bytes:
+        LOGGER.info(DEDUPLICATION_SAVED.format(counts[events.Deduplicated], saved_bytes))
+    emit(events.Finished(output_directory, counts[events.FileDone], counts[events.Skipped],
+                         counts[events.Failed], counts[events.Deduplicated], saved_bytes))
+
+def _is_out_of_space(error, output_directory, space_guard):
+    """Check if a file failed because the output volume is full. Engines that run a subprocess
+    fail with a CalledProcessError rather than an ENOSPC error, so with a space guard, the free
+    space is checked again after any failure.
+
+    Args:
+        error (Exception): The error of the file.
+        output_directory (str): The output directory.
+        space_guard (pdfebc_core.disk_space.DiskSpaceGuard): The space guard, or None.
+    Returns:
+        bool: True if the volume is out of space.
+    """
+    if is_out_of_space(error):
+        return True
+    return space_guard is not None and not space_guard.has_room(output_directory, 0)
+
+def _estimate_needed_space(groups, output_paths, engine, resume):
+    """Estimate the space that the outputs of a batch need, from the sizes of the inputs and
+    the default ratio of the engine. Duplicates are linked to the output of their original, and
+    need no space of their own.
+
+    Returns:
+        dict(str, int): The estimated output size of the first file of each group.
+    """
+    if engine is None:
+        ratio = GhostscriptEngine.default_ratio
+    elif isinstance(engine, FastestEnginePolicy):
+        ratio = max(engine.target_ratio, engine.fallback.default_ratio)
+    else:
+        ratio = engine.default_ratio
+    needed = {}
+    for original_path, *_ in groups:
+        if resume and _output_is_complete(original_path, output_paths[original_path]):
+            needed[original_path] = 0
+        else:
+            needed[original_path] = estimate_output_size(_file_size(original_path), ratio,
+                                                         FILE_SIZE_LOWER_LIMIT)
+    return needed
+
+def _check_ghostscript_ahead(engine, ghostscript_binary, source_paths):
+    """Check that Ghostscript is installed and can write PDF files before a batch starts, if
+    the batch is going to use it. It is not used if all files are below the size limit for
+    compression, or if another engine is given.
+
+    Args:
+        engine (CompressionEngine or FastestEnginePolicy): The engine argument of the batch.
+        ghostscript_binary (str): Name of the Ghostscript binary.
+        source_paths (list(str)): The files of the batch.
+    Raises:
+        FileNotFoundError
+        subprocess.SubprocessError
+        ValueError
+    """
+    if isinstance(engine, FastestEnginePolicy):
+        engine = engine.fallback_for(ghostscript_binary)
+    if engine is None:
+        binary = ghostscript_binary
+    elif isinstance(engine, GhostscriptEngine):
+        binary = engine.binary
+    else:
+        return
+    if not any(_file_size(source_path) >= FILE_SIZE_LOWER_LIMIT
+               for source_path in source_paths):
+        return
+    info = check_ghostscript(binary)
+    LOGGER.info(GS_FOUND.format(info.version, info.path))
+
+def _file_size(filepath):
+    try:
+        return os.stat(filepath).st_size
+    except OSError:
+        return 0
+
+def _compress_and_emit(emit, source_path, output, ghostscript_binary, engine, resume):
+    """Compress a single file of a batch and emit its events.
+
+    Returns:
+        namedtuple: The last event emitted for the file.
+    """
+    emit(events.FileStarted(source_path, output))
+    if resume and _output_is_complete(source_path, output):
+        reason = ALREADY_DONE.format(output, source_path)
+        LOGGER.info(reason)
+        event = events.Skipped(source_path, output, reason)
+    else:
+        def progress(page, pages):
+            emit(events.FileProgress(source_path, page, pages))
+        started = time.monotonic()
+        try:
+            result = compress_pdf(source_path, output, ghostscript_binary, engine, progress)
+        except (OSError, subprocess.SubprocessError) as exc:
+            LOGGER.error(FILE_FAILED.format(source_path, exc))
+            event = events.Failed(source_path, exc, time.monotonic() - started)
+        else:
+            if result.skip_reason:
+                event = events.Skipped(source_path, output, result.skip_reason)
+            else:
+                event = events.FileDone(source_path, output, result.input_size,
+                                        result.output_size, result.elapsed)
+    emit(event)
+    return event
+
+def _link_or_copy(source_path, output_path):
+    """Hard link a file to the output path, or copy it if it can't be linked. The output path is
+    replaced atomically.
+
+    Args:
+        source_path (str): Path to the file.
+        output_path (str): Output path.
+    """
+    temporary_path = _temporary_output_path(output_path)
+    try:
+        try:
+            os.link(source_path, temporary_path)
+        except OSError:
+            shutil.copyfile(source_path, temporary_path)
+        os.replace(temporary_path, output_path)
+    except BaseException:
+        _remove_if_exists(temporary_path)
+        raise
+
+def _producer(source_directory, output_directory, ghostscript_binary, engine, resume,
+              deduplicate, space_guard=None):
+    def producer(emit):
+        produce_compression_events(emit, source_directory, output_directory,
+                                   ghostscript_binary, engine, resume, deduplicate,
+                                   space_guard)
+    return producer
@@ -19,6 +19,16 @@ The config file should have the following format:
 | src = <source_dir>
 | out = <out_dir>
 
+The DEFAULTS section may also define device profiles, and select one of them with the optional
+profile key. See the profiles module for the format:
+
+| profile = <profile_name>
+| profile.<profile_name> = resolution=<dpi>, grayscale=<yes/no>, max_size=<width>x<height>
+
+A config file is checked with a single parse by :py:func:`validate_config`, which returns the
+parsed config together with its diagnostics. The config files of many users can be checked at
+once with :py:func:`validate_config_directory`.
+
 .. module:: config_utils
     :platform: Unix
     :synopsis: Configuration utility functions.
@@ -26,8 +36,10 @@ The config file should have the following format:
 .. moduleauthor:: Simon Larsén <slarse@kth.se>
 """
 import os
+import glob
 import configparser
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import appdirs
 
 CONFIG_FILENAME = 'config.cnf'
@@ -48,6 +60,34 @@ OUT_DEFAULT_DIR_KEY = "out"
 DEFAULT_SECTION_KEYS = {GS_DEFAULT_BINARY_KEY, SRC_DEFAULT_DIR_KEY, OUT_DEFAULT_DIR_KEY}
 SECTION_KEYS = {EMAIL_SECTION_KEY: EMAIL_SECTION_KEYS,
                 DEFAULT_SECTION_KEY: DEFAULT_SECTION_KEYS}
+PROFILE_KEY = "profile"
+PROFILE_KEY_PREFIX = "profile."
+# Keys that a section may contain in addition to the required ones, and prefixes of such keys.
+OPTIONAL_SECTION_KEYS = {DEFAULT_SECTION_KEY: {PROFILE_KEY}}
+OPTIONAL_SECTION_KEY_PREFIXES = {DEFAULT_SECTION_KEY: (PROFILE_KEY_PREFIX,)}
+CONFIG_FILE_PATTERN = '*.cnf'
+# Amount of config files that are read concurrently by validate_config_directory.
+VALIDATION_WORKERS = 8
+
+ConfigDiagnostics = namedtuple('ConfigDiagnostics',
+                               ['config_path', 'config', 'valid', 'missing_sections',
+                                'malformed_entries', 'unknown_entries', 'profile_errors',
+                                'error'])
+ConfigDiagnostics.__doc__ = """Diagnostics of a config file.
+
+Args:
+    config_path (str): Path to the config file.
+    config (defaultdict): The parsed config, or None if the file could not be parsed.
+    valid (bool): Whether the config passes :py:func:`check_config`, and its device profiles
+    are well formed.
+    missing_sections (set(str)): Sections that are missing or empty.
+    malformed_entries (dict(str, set(str))): The required options of each section that are
+    missing or empty.
+    unknown_entries (dict(str, set(str))): The options of each section that are not allowed.
+    profile_errors (dict(str, ConfigurationError)): The errors of the device profiles that are
+    badly formed, and of the selected profile if it is not defined, by profile name.
+    error (Exception): The error that the file could not be read or parsed because of, or None.
+"""
 
 class ConfigurationError(configparser.ParsingError):
     """Error thrown whenever something is wrong with the configuration file."""
@@ -119,7 +159,9 @@ def check_config(config):
         if not section_content:
             raise ConfigurationError("Config file badly formed! Section {} is missing."
                                      .format(section))
-        elif not _section_is_healthy(section_content, expected_section_keys):
+        elif not _section_is_healthy(section_content, expected_section_keys,
+                                     OPTIONAL_SECTION_KEYS.get(section, ()),
+                                     OPTIONAL_SECTION_KEY_PREFIXES.get(section, ())):
             raise ConfigurationError("The {} section of the configuration file is badly formed!"
                                      .format(section))
 
@@ -132,20 +174,87 @@ def run_config_diagnostics(config_path=CONFIG_PATH):
         str, Set[str], dict(str, Set[str]): The path to the configuration file, a set of missing
         sections and a dict that maps each section to the entries that have either missing or empty
         options.
+    Raises:
+        IOError
+        configparser.Error
+    """
+    diagnostics = validate_config(config_path)
+    if diagnostics.error is not None:
+        raise diagnostics.error
+    return config_path, diagnostics.missing_sections, diagnostics.malformed_entries
+
+def validate_config(config_path=CONFIG_PATH):
+    """Read and check a config file with a single parse.
+
+    Args:
+        config_path (str): Path to the config file.
+    Returns:
+        ConfigDiagnostics: The parsed config and its diagnostics. If the file is not a valid
+        config file, the error is reported in the diagnostics instead of raised.
+    Raises:
+        IOError
     """
-    config = read_config(config_path)
+    if not os.path.isfile(config_path):
+        raise IOError("No config file found at %s" % config_path)
+    config_parser = configparser.ConfigParser()
+    try:
+        config_parser.read(config_path)
+    except configparser.Error as exc:
+        return _unreadable_config(config_path, exc)
+    config = _config_parser_to_defaultdict(config_parser)
+    valid = True
     missing_sections = set()
     malformed_entries = defaultdict(set)
+    unknown_entries = defaultdict(set)
     for section, expected_section_keys in SECTION_KEYS.items():
         section_content = config.get(section)
         if not section_content:
             missing_sections.add(section)
-        else:
-            for option in expected_section_keys:
-                option_value = section_content.get(option)
-                if not option_value:
-                    malformed_entries[section].add(option)
-    return config_path, missing_sections, malformed_entries
+            valid = False
+            continue
+        for option in expected_section_keys:
+            if option not in section_content:
+                valid = False
+            if not section_content.get(option):
+                malformed_entries[section].add(option)
+        optional_keys = OPTIONAL_SECTION_KEYS.get(section, ())
+        optional_prefixes = OPTIONAL_SECTION_KEY_PREFIXES.get(section, ())
+        for option in section_content.keys() - expected_section_keys:
+            if option not in optional_keys and not option.startswith(optional_prefixes):
+                unknown_entries[section].add(option)
+                valid = False
+    profile_errors = _profile_errors(config.get(DEFAULT_SECTION_KEY) or {})
+    return ConfigDiagnostics(config_path=config_path, config=config,
+                             valid=valid and not profile_errors,
+                             missing_sections=missing_sections,
+                             malformed_entries=malformed_entries,
+                             unknown_entries=unknown_entries, profile_errors=profile_errors,
+                             error=None)
+
+def validate_config_directory(directory, pattern=CONFIG_FILE_PATTERN,
+                              max_workers=VALIDATION_WORKERS):
+    """Validate all config files in a directory, several at a time. Reading and parsing a
+    config file mostly waits on the file system, so the files are validated by a pool of
+    threads.
+
+    Args:
+        directory (str): Path to the directory.
+        pattern (str): Glob pattern of the names of the config files.
+        max_workers (int): Amount of files to validate concurrently.
+    Returns:
+        OrderedDict(str, ConfigDiagnostics): The diagnostics of each config file, ordered by
+        path. Files that can't be read are reported with the error in their diagnostics.
+    Raises:
+        ValueError
+    """
+    if not os.path.isdir(directory):
+        raise ValueError("%s is not a directory!" % directory)
+    config_paths = sorted(path for path in glob.glob(os.path.join(glob.escape(directory),
+                                                                  pattern))
+                          if os.path.isfile(path))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_validate_config_file, config_paths))
+    return OrderedDict(zip(config_paths, results))
 
 def get_attribute_from_config(config, section, attribute):
     """Try to parse an attribute of the config file.
@@ -177,15 +286,10 @@ def valid_config_exists(config_path=CONFIG_PATH):
     Returns:
         boolean: True if there is a valid config file, false if not.
     """
-    if os.path.isfile(config_path):
-        try:
-            config = read_config(config_path)
-            check_config(config)
-        except (ConfigurationError, IOError):
-            return False
-    else:
+    try:
+        return validate_config(config_path).valid
+    except IOError:
         return False
-    return True
 
 def config_to_string(config):
     """Nice output string for the config, which is a nested defaultdict.
@@ -215,13 +319,64 @@ def _config_parser_to_defaultdict(config_parser):
                 config[section][option] = option_value
     return config
 
-def _section_is_healthy(section, expected_keys):
-    """Check that the section contains all keys it should.
+def _validate_config_file(config_path):
+    """Validate a config file, and report an error reading it in its diagnostics.
+
+    Args:
+        config_path (str): Path to the config file.
+    Returns:
+        ConfigDiagnostics: The diagnostics.
+    """
+    try:
+        return validate_config(config_path)
+    except (IOError, UnicodeDecodeError) as exc:
+        return _unreadable_config(config_path, exc)
+
+def _profile_errors(section_content):
+    """Parse the device profiles of the DEFAULTS section of a config, and check that the
+    selected profile is defined.
+
+    Args:
+        section_content (dict): The DEFAULTS section.
+    Returns:
+        dict(str, ConfigurationError): The errors by profile name.
+    """
+    # profiles imports this module, so it can't be imported at the top
+    from .profiles import parse_profile, UNKNOWN_PROFILE
+    errors = {}
+    for option, value in section_content.items():
+        if option.startswith(PROFILE_KEY_PREFIX):
+            name = option[len(PROFILE_KEY_PREFIX):]
+            try:
+                parse_profile(name, value)
+            except ConfigurationError as exc:
+                errors[name] = exc
+    selected = section_content.get(PROFILE_KEY)
+    if selected and PROFILE_KEY_PREFIX + selected not in section_content:
+        errors[selected] = ConfigurationError(UNKNOWN_PROFILE.format(selected,
+                                                                     DEFAULT_SECTION_KEY))
+    return errors
+
+def _unreadable_config(config_path, error):
+    return ConfigDiagnostics(config_path=config_path, config=None, valid=False,
+                             missing_sections=set(), malformed_entries=defaultdict(set),
+                             unknown_entries=defaultdict(set), profile_errors={},
+                             error=error)
+
+def _section_is_healthy(section, expected_keys, optional_keys=(), optional_prefixes=()):
+    """Check that the section contains all keys it should, and no others.
 
     Args:
         section (defaultdict): A defaultdict.
         expected_keys (Iterable): A Set of keys that should be contained in the section.
+        optional_keys (Iterable): Keys that may be contained in the section.
+        optional_prefixes (tuple(str)): Prefixes of keys that may be contained in the section.
     Returns:
         boolean: True if the section is healthy, false if not.
     """
-    return set(section.keys()) == set(expected_keys)
+    keys = set(section.keys())
+    expected_keys = set(expected_keys)
+    if not expected_keys <= keys:
+        return False
+    return all(key in optional_keys or key.startswith(tuple(optional_prefixes))
+               for key in keys - expected_keys)
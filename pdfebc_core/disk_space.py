@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""This module contains checks of the free space on the volume of an output directory, so that
+a batch does not fill the volume partway through.
+
+Before a batch starts, the space that its outputs need is estimated from the sizes of the
+inputs and the expected compression ratio, and the batch is not started if the volume would
+be left with less free space than a low watermark. While the batch runs, the free space is
+checked again before each file. When it is below the watermark, the batch pauses until space
+is freed, and stops cleanly if that does not happen in time. The outputs of a batch are
+written atomically, so a stopped batch can be continued with ``resume=True``.
+
+.. module:: disk_space
+    :platform: Unix
+    :synopsis: Free space checks for batches.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import math
+import time
+import errno
+import daiquiri
+
+BYTES_PER_MEGABYTE = 1024**2
+# Default amount of bytes to always leave free on the output volume.
+LOW_WATERMARK = 512 * BYTES_PER_MEGABYTE
+# Default amount of seconds between two checks of the free space while paused.
+POLL_INTERVAL = 5.0
+# Default amount of seconds to stay paused before giving up.
+MAX_WAIT = 600.0
+
+NOT_ENOUGH_SPACE = """Not enough free space in '{}'
+Needed: {} bytes, plus {} bytes to keep free
+Available: {} bytes"""
+PAUSED = "Free space in '{}' is {} bytes, below the watermark, pausing"
+RESUMED = "Free space in '{}' is {} bytes, resuming"
+
+LOGGER = daiquiri.getLogger(__name__)
+
+class DiskSpaceError(OSError):
+    """Raised when there is not enough free space for a batch."""
+
+    def __init__(self, message):
+        super().__init__(errno.ENOSPC, message)
+
+class DiskSpaceGuard:
+    """Checks that the volume of a directory has room for more outputs, and waits for room
+    when it does not.
+
+    Args:
+        low_watermark (int): Amount of bytes to always leave free.
+        poll_interval (float): Amount of seconds between two checks while waiting.
+        max_wait (float): Amount of seconds to wait for space before giving up.
+    """
+
+    def __init__(self, low_watermark=LOW_WATERMARK, poll_interval=POLL_INTERVAL,
+                 max_wait=MAX_WAIT):
+        self.low_watermark = low_watermark
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+
+    def has_room(self, directory, needed):
+        """Check if a directory has room for outputs of the given size.
+
+        Args:
+            directory (str): The directory.
+            needed (int): Amount of bytes needed.
+        Returns:
+            bool: True if the free space would stay above the watermark.
+        """
+        return free_space(directory) - needed >= self.low_watermark
+
+    def check(self, directory, needed):
+        """Check that a directory has room for outputs of the given size.
+
+        Args:
+            directory (str): The directory.
+            needed (int): Amount of bytes needed.
+        Raises:
+            DiskSpaceError
+        """
+        available = free_space(directory)
+        if available - needed < self.low_watermark:
+            raise DiskSpaceError(NOT_ENOUGH_SPACE.format(directory, needed, self.low_watermark,
+                                                         available))
+
+    def wait_for_room(self, directory, needed):
+        """Wait until a directory has room for outputs of the given size, or until the maximum
+        wait time has passed.
+
+        Args:
+            directory (str): The directory.
+            needed (int): Amount of bytes needed.
+        Returns:
+            bool: True if there is room, False if the wait timed out.
+        """
+        if self.has_room(directory, needed):
+            return True
+        LOGGER.warning(PAUSED.format(directory, free_space(directory)))
+        deadline = time.monotonic() + self.max_wait
+        while time.monotonic() < deadline:
+            time.sleep(min(self.poll_interval, max(0, deadline - time.monotonic())))
+            if self.has_room(directory, needed):
+                LOGGER.info(RESUMED.format(directory, free_space(directory)))
+                return True
+        return False
+
+def free_space(directory):
+    """Return the amount of bytes that unprivileged processes can write to the volume of a
+    directory.
+
+    Args:
+        directory (str): The directory.
+    Returns:
+        int: The free space in bytes.
+    """
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+def estimate_output_size(input_size, ratio, lower_limit):
+    """Estimate the size of the output of a file.
+
+    Args:
+        input_size (int): Size of the file in bytes.
+        ratio (float): Expected output size divided by input size for compressed files.
+        lower_limit (int): Files smaller than this are copied instead of compressed.
+    Returns:
+        int: The estimated output size in bytes.
+    """
+    if input_size < lower_limit:
+        return input_size
+    return math.ceil(input_size * ratio)
+
+def is_out_of_space(error):
+    """Check if an error was caused by a full volume.
+
+    Args:
+        error (Exception): The error.
+    Returns:
+        bool: True if the volume or the user's quota is full.
+    """
+    return isinstance(error, OSError) and error.errno in (errno.ENOSPC, errno.EDQUOT)
@@ -11,16 +11,22 @@ for more information.
 .. moduleauthor:: Simon Larsén <slarse@kth.se>
 """
 import smtplib
+import copy
 import asyncio
 import aiosmtplib
 import os
+import mmap
+import base64
+from collections import namedtuple
+from email.utils import getaddresses
 from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
+from email.mime.nonmultipart import MIMENonMultipart
 from email.mime.multipart import MIMEMultipart
 from .config_utils import (EMAIL_SECTION_KEY, USER_KEY, RECEIVER_KEY, PASSWORD_KEY, SMTP_PORT_KEY,
                            SMTP_SERVER_KEY, get_attribute_from_config, read_config, CONFIG_PATH,
                            ConfigurationError, check_config)
-from .misc_utils import if_callable_call_with_formatted_string
+from .misc_utils import if_callable_call_with_formatted_string, group_identical_files
+from .tracing import span
 
 
 SENDING_PRECONF = """Sending files ...
@@ -32,23 +38,236 @@ SMTP Port: {}
 Files:
 {}"""
 FILES_SENT = "Files successfully sent!"""
+DUPLICATE_NOTE = "'{}' is identical to the attached '{}' and was not attached again."
+NO_SENDER = "No Sender or From header in the email"
+NO_RECIPIENTS = "No To, Cc or Bcc header in the email"
+MULTIPLE_RESENT_HEADERS = "More than one Resent- header block in the email"
 
-async def send_with_attachments(subject, message, filepaths, config):
+# Policies for attachments with identical contents. 'keep' attaches all of them, 'first' only
+# attaches the first one and 'note' does the same, but also lists the left out files in the
+# message.
+DUPLICATES_KEEP = "keep"
+DUPLICATES_FIRST = "first"
+DUPLICATES_NOTE = "note"
+DUPLICATE_POLICIES = {DUPLICATES_KEEP, DUPLICATES_FIRST, DUPLICATES_NOTE}
+
+# Size of the chunks that a message is sent in when the server supports BDAT.
+BDAT_CHUNK_SIZE = 1024**2
+# Estimated size of the boundary lines and blank lines around a MIME part.
+MIME_PART_OVERHEAD = 64
+# Default amount of concurrent connections of a bulk send.
+BULK_CONNECTIONS = 4
+
+Recipient = namedtuple('Recipient', ['address', 'subject', 'message'])
+RecipientResult = namedtuple('RecipientResult', ['address', 'error'])
+
+class MappedAttachment(MIMENonMultipart):
+    """An application/octet-stream MIME part with the contents of a file, like
+    email.mime.application.MIMEApplication. Instead of reading the file into memory and
+    encoding it right away, the file is memory mapped and base64 encoded the first time the
+    payload is needed, which is usually when the message is serialized. After encoding, the
+    mapping is closed.
+
+    Args:
+        filepath (str): Path to the file.
+        **params: Content-Type parameters, e.g. Name.
+    """
+    _mapped = None
+    _encoded = None
+
+    def __init__(self, filepath, **params):
+        super().__init__('application', 'octet-stream', **params)
+        self['Content-Transfer-Encoding'] = 'base64'
+        with open(filepath, 'rb') as file:
+            if os.fstat(file.fileno()).st_size:
+                self._mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._encoded = ''
+
+    def encode(self):
+        """Encode the mapped file, if it has not already been encoded."""
+        if self._encoded is None and self._mapped is not None:
+            self._encoded = base64.encodebytes(memoryview(self._mapped)).decode('ascii')
+            self._mapped.close()
+            self._mapped = None
+
+    @property
+    def _payload(self):
+        self.encode()
+        return self._encoded
+
+    @_payload.setter
+    def _payload(self, payload):
+        if self._mapped is not None:
+            self._mapped.close()
+            self._mapped = None
+        self._encoded = payload
+
+async def send_with_attachments(subject, message, filepaths, config,
+                                duplicate_policy=DUPLICATES_KEEP, executor=None, limiter=None):
     """Send an email from the user (a gmail) to the receiver.
 
+    All files are attached by default. With the duplicate policy 'first' or 'note', files with
+    identical contents are only attached once, and with 'note', the message lists the files
+    that were left out. Identical files are found by comparing sizes first, and only hashing
+    files of the same size.
+
     Args:
         subject (str): Subject of the email.
         message (str): A message.
         filepaths (list(str)): Filepaths to files to be attached.
         config (defaultdict): A defaultdict.
+        duplicate_policy (str): One of DUPLICATE_POLICIES.
+        executor (concurrent.futures.Executor): Executor to read and encode the attachments in,
+        see :py:func:`_attach_files_concurrently`.
+        limiter (pdfebc_core.rate_limit.SendLimiter): Limiter to wait for before sending.
+    Raises:
+        ValueError
+    """
+    filepaths, notes = _deduplicate_attachments(filepaths, duplicate_policy)
+    email_ = _compose_email(subject, message, notes,
+                            get_attribute_from_config(config, EMAIL_SECTION_KEY, USER_KEY),
+                            get_attribute_from_config(config, EMAIL_SECTION_KEY, RECEIVER_KEY))
+    await _attach_files_concurrently(filepaths, email_, executor)
+    await _send_email(email_, config, limiter=limiter)
+
+async def send_bulk(recipients, filepaths, config, connections=BULK_CONNECTIONS, rate=None,
+                    duplicate_policy=DUPLICATES_KEEP, executor=None, limiter=None):
+    """Send the same files to many recipients, each with their own subject and message.
+
+    The files are read and encoded once, and the attachment parts are shared by all messages,
+    so only the text part differs between them. The messages are sent over a pool of
+    connections that are each logged in once and then reused for many messages. A recipient
+    that can not be sent to does not stop the others, and a connection that is lost is
+    replaced for the next message. Duplicate files are handled as by
+    :py:func:`send_with_attachments`, and all files are attached by default.
+
+    Args:
+        recipients (list(Recipient)): The recipients with their subjects and messages.
+        filepaths (list(str)): Filepaths to files to be attached.
+        config (defaultdict): A defaultdict.
+        connections (int): Maximum amount of concurrent connections to the SMTP server.
+        rate (float): Maximum amount of messages per second over all connections. Defaults to
+        no limit.
+        duplicate_policy (str): One of DUPLICATE_POLICIES.
+        executor (concurrent.futures.Executor): Executor to read and encode the attachments in,
+        see :py:func:`_attach_files_concurrently`.
+        limiter (pdfebc_core.rate_limit.SendLimiter): Limiter to wait for before each message.
+    Returns:
+        list(RecipientResult): One result per recipient, in the given order. The error of a
+        result is None if the message was sent.
+    Raises:
+        ValueError
     """
+    recipients = list(recipients)
+    filepaths, notes = _deduplicate_attachments(filepaths, duplicate_policy)
+    shared = MIMEMultipart()
+    await _attach_files_concurrently(filepaths, shared, executor)
+    attachments = shared.get_payload()
+    sender = get_attribute_from_config(config, EMAIL_SECTION_KEY, USER_KEY)
+    pending = asyncio.Queue()
+    for index in range(len(recipients)):
+        pending.put_nowait(index)
+    results = [None] * len(recipients)
+    pace = _pacer(rate)
+
+    async def work():
+        server = None
+        while not pending.empty():
+            index = pending.get_nowait()
+            recipient = recipients[index]
+            email_ = _compose_email(recipient.subject, recipient.message, notes, sender,
+                                    recipient.address)
+            for part in attachments:
+                email_.attach(part)
+            try:
+                if server is None:
+                    server = await _connect(config)
+                await pace()
+                if limiter is not None:
+                    await limiter.acquire(_message_size(email_))
+                await _deliver(server, email_)
+            except (aiosmtplib.SMTPException, OSError, ValueError) as exc:
+                results[index] = RecipientResult(recipient.address, exc)
+                server = await _reset(server)
+            else:
+                results[index] = RecipientResult(recipient.address, None)
+        if server is not None:
+            await _quit(server)
+
+    await asyncio.gather(*[work() for _ in range(min(connections, len(recipients)))])
+    return results
+
+def _compose_email(subject, message, notes, sender, receiver):
+    """Create an email with a text part and no attachments.
+
+    Args:
+        subject (str): Subject of the email.
+        message (str): A message.
+        notes (list(str)): Notes to add to the end of the message.
+        sender (str): Address of the sender.
+        receiver (str): Address of the receiver.
+    Returns:
+        email.MIMEMultipart: The email.
+    """
+    if notes:
+        message = "\n\n".join(part for part in (message, "\n".join(notes)) if part)
     email_ = MIMEMultipart()
     email_.attach(MIMEText(message))
     email_["Subject"] = subject
-    email_["From"] = get_attribute_from_config(config, EMAIL_SECTION_KEY, USER_KEY)
-    email_["To"] = get_attribute_from_config(config, EMAIL_SECTION_KEY, RECEIVER_KEY)
-    _attach_files(filepaths, email_)
-    await _send_email(email_, config)
+    email_["From"] = sender
+    email_["To"] = receiver
+    return email_
+
+def _pacer(rate):
+    """Create a coroutine function that spaces out the calls to it, such that it returns at
+    most rate times per second.
+
+    Args:
+        rate (float): Maximum amount of calls per second, or None for no limit.
+    """
+    next_slot = [0]
+
+    async def pace():
+        if not rate:
+            return
+        now = asyncio.get_event_loop().time()
+        slot = max(now, next_slot[0])
+        next_slot[0] = slot + 1 / rate
+        await asyncio.sleep(slot - now)
+    return pace
+
+def _deduplicate_attachments(filepaths, duplicate_policy):
+    """Remove files with identical contents from a list of attachments.
+
+    Args:
+        filepaths (list(str)): A list of filepaths.
+        duplicate_policy (str): One of DUPLICATE_POLICIES.
+    Returns:
+        list(str), list(str): The filepaths to attach and notes about the left out files. There
+        are only notes with the 'note' policy.
+    Raises:
+        ValueError
+    """
+    if duplicate_policy not in DUPLICATE_POLICIES:
+        raise ValueError("Unknown duplicate policy '{}', must be one of {}"
+                         .format(duplicate_policy, sorted(DUPLICATE_POLICIES)))
+    if duplicate_policy == DUPLICATES_KEEP:
+        return list(filepaths), []
+    unique_filepaths = []
+    notes = []
+    for group in group_identical_files(filepaths):
+        attached = group[0]
+        unique_filepaths.append(attached)
+        attached_name = os.path.basename(attached)
+        left_out_names = []
+        for filepath in group[1:]:
+            name = os.path.basename(filepath)
+            if name != attached_name and name not in left_out_names:
+                left_out_names.append(name)
+        if duplicate_policy == DUPLICATES_NOTE:
+            notes.extend(DUPLICATE_NOTE.format(name, attached_name) for name in left_out_names)
+    return unique_filepaths, notes
 
 def _attach_files(filepaths, email_):
     """Take a list of filepaths and attach the files to a MIMEMultipart.
@@ -57,30 +276,240 @@ def _attach_files(filepaths, email_):
         filepaths (list(str)): A list of filepaths.
         email_ (email.MIMEMultipart): A MIMEMultipart email_.
     """
-    for filepath in filepaths:
-        base = os.path.basename(filepath)
-        with open(filepath, "rb") as file:
-            part = MIMEApplication(file.read(), Name=base)
-            part["Content-Disposition"] = 'attachment; filename="%s"' % base
-            email_.attach(part)
+    with span("attach", files=len(filepaths)):
+        for filepath in filepaths:
+            email_.attach(_create_attachment(filepath, encode=False))
+
+async def _attach_files_concurrently(filepaths, email_, executor=None, loop=None):
+    """Read and base64 encode files in an executor, one task per file, and attach them to a
+    MIMEMultipart in the given order. This keeps the event loop responsive while large files
+    are encoded.
+
+    The default executor of the loop is a thread pool. The encoding is done in small chunks, so
+    the threads do not block the loop, but they share one core. To encode on several cores,
+    pass a concurrent.futures.ProcessPoolExecutor.
+
+    Args:
+        filepaths (list(str)): A list of filepaths.
+        email_ (email.MIMEMultipart): A MIMEMultipart email_.
+        executor (concurrent.futures.Executor): The executor. Defaults to the default executor
+        of the loop.
+        loop (asyncio.AbstractEventLoop): The event loop. Defaults to the current loop.
+    """
+    loop = loop or asyncio.get_event_loop()
+    with span("attach", files=len(filepaths)):
+        parts = await asyncio.gather(*[
+            loop.run_in_executor(executor, _create_attachment, filepath)
+            for filepath in filepaths])
+    for part in parts:
+        email_.attach(part)
 
-async def _send_email(email_, config, loop=asyncio.get_event_loop()):
+def _create_attachment(filepath, encode=True):
+    """Create an attachment part for a file.
+
+    Args:
+        filepath (str): Path to the file.
+        encode (bool): Whether to encode the file right away instead of when the message is
+        serialized.
+    Returns:
+        MappedAttachment: The attachment.
+    """
+    base = os.path.basename(filepath)
+    part = MappedAttachment(filepath, Name=base)
+    part["Content-Disposition"] = 'attachment; filename="%s"' % base
+    if encode:
+        part.encode()
+    return part
+
+async def _send_email(email_, config, loop=asyncio.get_event_loop(), limiter=None):
     """Send an email.
 
     Args:
         email_ (email.MIMEMultipart): The email to send.
         config (defaultdict): A defaultdict.
+        limiter (pdfebc_core.rate_limit.SendLimiter): Limiter to wait for before connecting.
+    Raises:
+        ValueError
+    """
+    if limiter is not None:
+        await limiter.acquire(_message_size(email_))
+    server = await _connect(config, loop)
+    await _deliver(server, email_)
+    with span("quit"):
+        await server.quit()
+
+def _message_size(email_):
+    """Estimate the size of an email from its headers and payloads, without serializing it.
+
+    Args:
+        email_ (email.message.Message): The email.
+    Returns:
+        int: The estimated size in bytes.
+    """
+    size = 0
+    for part in email_.walk():
+        size += MIME_PART_OVERHEAD + sum(len(name) + len(value) + 4 for name, value in part.items())
+        if not part.is_multipart():
+            size += len(part.get_payload())
+    return size
+
+async def _connect(config, loop=None):
+    """Connect and log in to the SMTP server of the config.
+
+    Args:
+        config (defaultdict): A defaultdict.
+        loop (asyncio.AbstractEventLoop): The event loop. Defaults to the current loop.
+    Returns:
+        aiosmtplib.SMTP: The logged in client.
     """
     smtp_server = get_attribute_from_config(config, EMAIL_SECTION_KEY, SMTP_SERVER_KEY)
     smtp_port = int(get_attribute_from_config(config, EMAIL_SECTION_KEY, SMTP_PORT_KEY))
     user = get_attribute_from_config(config, EMAIL_SECTION_KEY, USER_KEY)
     password = get_attribute_from_config(config, EMAIL_SECTION_KEY, PASSWORD_KEY)
-    server = aiosmtplib.SMTP(hostname=smtp_server, port=smtp_port, loop=loop, use_tls=False)
-    await server.connect()
-    await server.starttls()
-    await server.login(user, password)
-    await server.send_message(email_)
-    await server.quit()
+    server = aiosmtplib.SMTP(hostname=smtp_server, port=smtp_port,
+                             loop=loop or asyncio.get_event_loop(), use_tls=False)
+    with span("connect"):
+        await server.connect()
+    with span("starttls"):
+        await server.starttls()
+    with span("login"):
+        await server.login(user, password)
+    return server
+
+async def _reset(server):
+    """Reset the mail transaction of a client after a failed send, so that the connection can
+    be reused.
+
+    Args:
+        server (aiosmtplib.SMTP): The client, or None.
+    Returns:
+        aiosmtplib.SMTP: The client, or None if the connection was lost.
+    """
+    if server is None or not server.is_connected:
+        return None
+    try:
+        await server.rset()
+    except (aiosmtplib.SMTPException, OSError):
+        server.close()
+        return None
+    return server
+
+async def _quit(server):
+    """End a session, closing the connection even if the server does not reply."""
+    try:
+        with span("quit"):
+            await server.quit()
+    except (aiosmtplib.SMTPException, OSError):
+        server.close()
+
+async def _deliver(server, email_, chunk_size=BDAT_CHUNK_SIZE):
+    """Send an email over a connection that has greeted the server with EHLO.
+
+    If the server supports the CHUNKING extension, the message is sent with BDAT commands in
+    large chunks. The chunks are sent as they are, so the message is not scanned for lines to
+    dot-stuff, and a large message takes one round-trip per chunk. Otherwise, or if the
+    installed aiosmtplib does not let raw data be sent, the message is sent with DATA. The
+    commands are not pipelined even if the server supports PIPELINING, as aiosmtplib reads
+    exactly one reply per command that it writes.
+
+    Args:
+        server (aiosmtplib.SMTP): A connected SMTP client.
+        email_ (email.MIMEMultipart): The email to send.
+        chunk_size (int): Maximum size of a BDAT chunk in bytes.
+    Raises:
+        ValueError, aiosmtplib.SMTPException
+    """
+    with span("send"):
+        if not (server.supports_extension("chunking") and _can_send_raw(server)):
+            await server.send_message(email_)
+        else:
+            await _send_in_chunks(server, email_, chunk_size)
+
+async def _send_in_chunks(server, email_, chunk_size):
+    """Send an email with BDAT commands. See :py:func:`_deliver`."""
+    sender, recipients = _envelope(email_)
+    if "Bcc" in email_ or "Resent-Bcc" in email_:
+        email_ = copy.copy(email_)
+        del email_["Bcc"]
+        del email_["Resent-Bcc"]
+    data = memoryview(email_.as_bytes(policy=email_.policy.clone(linesep="\r\n")))
+    await server.mail(sender)
+    for recipient in recipients:
+        await server.rcpt(recipient)
+    for offset in range(0, max(len(data), 1), chunk_size):
+        chunk = data[offset:offset + chunk_size]
+        last = offset + chunk_size >= len(data)
+        await _send_chunk(server, chunk, last)
+
+def _envelope(email_):
+    """Take the envelope sender and recipients of an email from its headers, like
+    aiosmtplib.SMTP.send_message and smtplib.SMTP.send_message do. The sender is the address
+    of the Sender header, or the first address of the From header. If the email is resent, the
+    Resent- headers are used instead.
+
+    Returns:
+        (str, list(str)): The sender and the recipients.
+    Raises:
+        ValueError
+    """
+    resent_dates = email_.get_all("Resent-Date")
+    if resent_dates is None:
+        prefix = ""
+    elif len(resent_dates) == 1:
+        prefix = "Resent-"
+    else:
+        raise ValueError(MULTIPLE_RESENT_HEADERS)
+    sender_header = email_[prefix + "Sender"] or email_[prefix + "From"]
+    senders = [address for _, address in getaddresses([str(sender_header or "")]) if address]
+    if not senders:
+        raise ValueError(NO_SENDER)
+    recipients = [address for _, address in getaddresses(
+        [str(value) for field in ("To", "Cc", "Bcc")
+         for value in email_.get_all(prefix + field, [])]) if address]
+    if not recipients:
+        raise ValueError(NO_RECIPIENTS)
+    return senders[0], recipients
+
+async def _send_chunk(server, chunk, last):
+    """Send a BDAT command and its chunk of the message, and read the reply.
+
+    Raises:
+        aiosmtplib.SMTPDataError
+    """
+    command = "BDAT {}{}\r\n".format(len(chunk), " LAST" if last else "")
+    code, message = await _send_raw(server, command.encode("ascii"), chunk)
+    if code != 250:
+        raise aiosmtplib.SMTPDataError(code, message)
+
+def _can_send_raw(server):
+    """Check if raw data can be sent over the connection of an SMTP client, see
+    :py:func:`_send_raw`.
+    """
+    protocol = getattr(server, "protocol", None)
+    return callable(getattr(protocol, "write", None)) and \
+        callable(getattr(protocol, "read_response", None))
+
+async def _send_raw(server, *data):
+    """Write data to the connection of an SMTP client as it is, and read one reply.
+
+    aiosmtplib has no public way to send a command that it does not know, so this uses the
+    write and read_response methods of its protocol object, which it has had since version
+    1.0. This is the only function that does.
+
+    Args:
+        server (aiosmtplib.SMTP): A connected SMTP client.
+        *data (bytes): The data to write.
+    Returns:
+        (int, str): The code and message of the reply.
+    Raises:
+        aiosmtplib.SMTPServerDisconnected
+    """
+    if not _can_send_raw(server):
+        raise aiosmtplib.SMTPServerDisconnected("Server not connected")
+    for part in data:
+        server.protocol.write(part)
+    response = await server.protocol.read_response(timeout=server.timeout)
+    return response.code, response.message
 
 async def send_files_preconf(filepaths, config_path=CONFIG_PATH):
     """Send files using the config.ini settings.
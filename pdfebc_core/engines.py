@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""This module contains the compression engines of the pdfebc program. An engine wraps a single
+PDF rewriting tool behind a common interface, so that the compress module does not need to know
+which tool is doing the work. Ghostscript is the default engine, and is the only one that
+actually downsamples images. The other engines perform lossless structural rewrites (object
+streams, stream compression, deduplication), which are a lot faster but give smaller gains.
+
+.. module:: engines
+    :platform: Unix
+    :synopsis: Compression engines wrapping Ghostscript, qpdf, mutool and pikepdf.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import re
+import shutil
+import subprocess
+import importlib.util
+from .inspection import inspect_pdf, estimate_ratios
+from .ghostscript import resolve_binary
+from .profiles import ghostscript_flags
+
+ENGINE_NOT_INSTALLED = """{} not installed or not aliased to '{}'.
+Exiting ..."""
+
+_GS_PAGE_RANGE_RE = re.compile(r"Processing pages (\d+) through (\d+)\.")
+_GS_PAGE_RE = re.compile(r"Page (\d+)$")
+
+class CompressionEngine:
+    """Base class for compression engines.
+
+    Subclasses must set the class attributes and implement :py:meth:`compress`. The
+    ``relative_speed`` attribute is only meaningful in comparison with other engines, and is
+    used by :py:class:`FastestEnginePolicy` to order the engines.
+    """
+    name = None
+    relative_speed = 1.0
+    lossless = True
+    default_ratio = 1.0
+
+    def is_available(self):
+        """Check if the engine can be used on this machine.
+
+        Returns:
+            bool: True if the engine is available.
+        """
+        raise NotImplementedError()
+
+    def expected_ratio(self, inspection):
+        """Estimate the output size divided by the input size for an inspected file.
+
+        Args:
+            inspection (PdfInspection): Inspection of the file, or None if it could not be
+            inspected.
+        Returns:
+            float: The expected size ratio.
+        """
+        if inspection is None:
+            return self.default_ratio
+        lossy_ratio, lossless_ratio = estimate_ratios(inspection)
+        return lossless_ratio if self.lossless else lossy_ratio
+
+    def compress(self, filepath, output_path, progress=None):
+        """Compress a single PDF file.
+
+        Args:
+            filepath (str): Path to the PDF file.
+            output_path (str): Output path.
+            progress (function): Called with the current page and the total amount of pages (or
+            None if unknown) as pages are processed. Engines that can't report progress never
+            call it.
+        Raises:
+            FileNotFoundError
+            subprocess.CalledProcessError
+        """
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return "{}()".format(type(self).__name__)
+
+class SubprocessEngine(CompressionEngine):
+    """Base class for engines that run an external binary."""
+
+    def __init__(self, binary):
+        self.binary = binary
+
+    def command(self, filepath, output_path):
+        """Build the command line for compressing a file.
+
+        Args:
+            filepath (str): Path to the PDF file.
+            output_path (str): Output path.
+        Returns:
+            list(str): The command.
+        """
+        raise NotImplementedError()
+
+    def is_available(self):
+        return shutil.which(self.binary) is not None
+
+    def compress(self, filepath, output_path, progress=None):
+        command = self.command(filepath, output_path)
+        process = self._start(command)
+        process.communicate()
+        self._check(process, command)
+
+    def _start(self, command, **kwargs):
+        try:
+            return subprocess.Popen(command, **kwargs)
+        except FileNotFoundError:
+            raise FileNotFoundError(ENGINE_NOT_INSTALLED.format(self.name, self.binary))
+
+    def _check(self, process, command):
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.binary)
+
+class GhostscriptEngine(SubprocessEngine):
+    """Lossy compression with Ghostscript's pdfwrite device. The binary is launched by its
+    absolute path, which is resolved once per process (see
+    :py:func:`pdfebc_core.ghostscript.resolve_binary`).
+
+    Args:
+        binary (str): Name of the Ghostscript binary.
+        profile (pdfebc_core.profiles.DeviceProfile): Device profile to tune the output to.
+        Defaults to the /ebook preset alone.
+    """
+    name = "Ghostscript"
+    relative_speed = 1.0
+    lossless = False
+    default_ratio = 0.35
+
+    def __init__(self, binary="gs", profile=None):
+        super().__init__(binary)
+        self.profile = profile
+
+    def command(self, filepath, output_path, quiet=True):
+        command = [resolve_binary(self.binary) or self.binary, "-sDEVICE=pdfwrite",
+                   "-dCompatabilityLevel=1.4", "-dPDFSETTINGS=/ebook"]
+        if self.profile is not None:
+            command += ghostscript_flags(self.profile)
+        command += ["-dNOPAUSE", "-dQUIET", "-dBATCH",
+                    "-sOutputFile=%s" % output_path, filepath]
+        if not quiet:
+            command.remove("-dQUIET")
+        return command
+
+    def compress(self, filepath, output_path, progress=None):
+        """Compress a single PDF file. If a progress function is given, Ghostscript is run
+        without -dQUIET and its page output is parsed for progress.
+        """
+        if progress is None:
+            super().compress(filepath, output_path)
+            return
+        command = self.command(filepath, output_path, quiet=False)
+        process = self._start(command, stdout=subprocess.PIPE, universal_newlines=True)
+        first_page, pages = 1, None
+        with process.stdout:
+            for line in process.stdout:
+                line = line.strip()
+                page_match = _GS_PAGE_RE.match(line)
+                if page_match:
+                    progress(int(page_match.group(1)) - first_page + 1, pages)
+                    continue
+                range_match = _GS_PAGE_RANGE_RE.match(line)
+                if range_match:
+                    first_page, last_page = map(int, range_match.groups())
+                    pages = last_page - first_page + 1
+        process.wait()
+        self._check(process, command)
+
+class QpdfEngine(SubprocessEngine):
+    """Lossless structural rewrite with qpdf."""
+    name = "qpdf"
+    relative_speed = 10.0
+    default_ratio = 0.85
+
+    def __init__(self, binary="qpdf"):
+        super().__init__(binary)
+
+    def command(self, filepath, output_path):
+        return [self.binary, "--object-streams=generate", "--compress-streams=y",
+                "--recompress-flate", "--", filepath, output_path]
+
+class MutoolEngine(SubprocessEngine):
+    """Lossless structural rewrite with MuPDF's mutool."""
+    name = "mutool"
+    relative_speed = 6.0
+    default_ratio = 0.8
+
+    def __init__(self, binary="mutool"):
+        super().__init__(binary)
+
+    def command(self, filepath, output_path):
+        return [self.binary, "clean", "-gggg", "-z", filepath, output_path]
+
+class PikepdfEngine(CompressionEngine):
+    """Lossless structural rewrite with pikepdf. Runs in-process, and requires the optional
+    ``pikepdf`` package.
+    """
+    name = "pikepdf"
+    relative_speed = 8.0
+    default_ratio = 0.85
+
+    def is_available(self):
+        return importlib.util.find_spec("pikepdf") is not None
+
+    def compress(self, filepath, output_path, progress=None):
+        try:
+            import pikepdf
+        except ImportError:
+            raise FileNotFoundError(ENGINE_NOT_INSTALLED.format(self.name, "pikepdf"))
+        with pikepdf.open(filepath) as pdf:
+            pdf.remove_unreferenced_resources()
+            pdf.save(output_path, compress_streams=True,
+                     object_stream_mode=pikepdf.ObjectStreamMode.generate)
+
+class FastestEnginePolicy:
+    """Policy that picks the fastest available engine that is expected to reach the target
+    ratio for a given file. If no engine is expected to reach the target, the fallback engine
+    is used.
+
+    Args:
+        target_ratio (float): The highest acceptable output size divided by input size.
+        engines (list(CompressionEngine)): Candidate engines. Defaults to all known engines.
+        fallback (CompressionEngine): Engine to use when no candidate reaches the target.
+        Defaults to Ghostscript with the binary that the file is compressed with, see
+        :py:meth:`fallback_for`.
+    """
+
+    def __init__(self, target_ratio, engines=None, fallback=None):
+        if not 0 < target_ratio <= 1:
+            raise ValueError("target_ratio must be in (0, 1], was {}".format(target_ratio))
+        self.target_ratio = target_ratio
+        self.fallback = fallback or GhostscriptEngine()
+        self._default_fallback = fallback is None
+        candidates = engines if engines is not None else default_engines(self.fallback)
+        self.engines = sorted([engine for engine in candidates if engine.is_available()],
+                              key=lambda engine: engine.relative_speed, reverse=True)
+
+    def fallback_for(self, ghostscript_binary=None):
+        """Return the fallback engine for a Ghostscript binary. Unless a fallback was given to
+        the policy, this is Ghostscript with that binary.
+
+        Args:
+            ghostscript_binary (str): Name/alias of the Ghostscript binary that the compress
+            functions were given, or None.
+        Returns:
+            CompressionEngine: The fallback engine.
+        """
+        if self._default_fallback and ghostscript_binary:
+            return GhostscriptEngine(ghostscript_binary)
+        return self.fallback
+
+    def select(self, filepath, inspection=None, ghostscript_binary=None):
+        """Select an engine for the given file.
+
+        Args:
+            filepath (str): Path to the PDF file.
+            inspection (PdfInspection): Inspection of the file. The file is inspected if this
+            is not given.
+            ghostscript_binary (str): Name/alias of the Ghostscript binary to use if the
+            fallback is selected, see :py:meth:`fallback_for`.
+        Returns:
+            CompressionEngine: The selected engine.
+        """
+        if inspection is None:
+            inspection = inspect_pdf(filepath)
+        for engine in self.engines:
+            if engine.expected_ratio(inspection) <= self.target_ratio:
+                if engine is self.fallback:
+                    return self.fallback_for(ghostscript_binary)
+                return engine
+        return self.fallback_for(ghostscript_binary)
+
+def default_engines(ghostscript=None):
+    """Return one instance of each known engine.
+
+    Args:
+        ghostscript (GhostscriptEngine): Ghostscript engine to use. Defaults to one using the
+        'gs' binary.
+    Returns:
+        list(CompressionEngine): The engines.
+    """
+    return [ghostscript or GhostscriptEngine(), QpdfEngine(), MutoolEngine(), PikepdfEngine()]
+
+def resolve_engine(engine, filepath, ghostscript_binary, inspection=None):
+    """Turn the engine argument of the compress functions into an actual engine.
+
+    Args:
+        engine (CompressionEngine or FastestEnginePolicy or None): The engine or policy.
+        If None, Ghostscript is used.
+        filepath (str): Path to the PDF file that is about to be compressed.
+        ghostscript_binary (str): Name/alias of the Ghostscript binary.
+        inspection (PdfInspection): Inspection of the file, if one has already been made.
+    Returns:
+        CompressionEngine: The engine to compress the file with.
+    """
+    if engine is None:
+        return GhostscriptEngine(ghostscript_binary)
+    if isinstance(engine, FastestEnginePolicy):
+        return engine.select(filepath, inspection, ghostscript_binary)
+    return engine
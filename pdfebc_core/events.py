@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""This module contains the events that the compress functions report progress with, and helpers
+for consuming them.
+
+Events are produced by calling an emit function, and can be consumed in three ways: with a
+callback (see :py:func:`with_callback`), as a plain iterator (see :py:func:`iterate`) or as an
+async iterator (see :py:func:`aiterate`). Per-page progress events are throttled, so that a
+fast producer does not slow down the compression with event handling.
+
+.. module:: events
+    :platform: Unix
+    :synopsis: Progress events for the compress functions.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import time
+import queue
+import asyncio
+import threading
+from collections import namedtuple
+
+# Minimum amount of seconds between two progress events for the same file.
+PROGRESS_INTERVAL = 0.2
+# Maximum amount of events waiting to be consumed by an iterator before the producer blocks.
+MAX_QUEUED_EVENTS = 256
+# Amount of seconds between two checks of a blocked producer for whether the iterator is closed.
+STOP_CHECK_INTERVAL = 0.1
+
+Started = namedtuple('Started', ['source_directory', 'output_directory', 'total'])
+FileStarted = namedtuple('FileStarted', ['source_path', 'output_path'])
+FileProgress = namedtuple('FileProgress', ['source_path', 'page', 'pages'])
+FileDone = namedtuple('FileDone', ['source_path', 'output_path', 'input_size', 'output_size',
+                                   'elapsed'])
+Skipped = namedtuple('Skipped', ['source_path', 'output_path', 'reason'])
+Failed = namedtuple('Failed', ['source_path', 'error', 'elapsed'])
+# The elapsed field is the amount of seconds that the producer spent on the file, or None if
+# it is not known. It does not include time spent waiting for the consumer of the events.
+FileDone.__new__.__defaults__ = (None,)
+Failed.__new__.__defaults__ = (None,)
+Deduplicated = namedtuple('Deduplicated', ['source_path', 'output_path', 'original_path',
+                                           'saved_bytes'])
+Stopped = namedtuple('Stopped', ['output_directory', 'reason', 'remaining'])
+Finished = namedtuple('Finished', ['output_directory', 'done', 'skipped', 'failed',
+                                   'deduplicated', 'saved_bytes'])
+
+_END = object()
+
+class ProgressThrottle:
+    """Drops progress events that arrive too soon after the previous one for the same file.
+    The last page of a file is always let through.
+
+    Args:
+        emit (function): Function to pass the events that are let through to.
+        interval (float): Minimum amount of seconds between two progress events for a file.
+    """
+
+    def __init__(self, emit, interval=PROGRESS_INTERVAL):
+        self.emit = emit
+        self.interval = interval
+        self._last_progress = {}
+
+    def __call__(self, event):
+        if isinstance(event, FileProgress):
+            now = time.monotonic()
+            last = self._last_progress.get(event.source_path)
+            is_last_page = event.pages is not None and event.page >= event.pages
+            if last is not None and now - last < self.interval and not is_last_page:
+                return
+            self._last_progress[event.source_path] = now
+        elif isinstance(event, (FileDone, Skipped, Failed, Deduplicated)):
+            self._last_progress.pop(event.source_path, None)
+        self.emit(event)
+
+def with_callback(producer, callback, interval=PROGRESS_INTERVAL):
+    """Run an event producer, passing each event to a callback in the calling thread.
+
+    Args:
+        producer (function): Function that takes an emit function and produces events by
+        calling it.
+        callback (function): Called with each event. If it is not callable, the events are
+        dropped.
+        interval (float): Minimum amount of seconds between two progress events for a file.
+    """
+    def emit(event):
+        if callable(callback):
+            callback(event)
+    producer(ProgressThrottle(emit, interval))
+
+def iterate(producer, interval=PROGRESS_INTERVAL):
+    """Run an event producer in a separate thread and iterate over its events. This is a
+    generator function, and the producer is not started until the first event is requested.
+    An exception raised by the producer is re-raised by the iterator.
+
+    If the iterator is closed before the producer is done, e.g. by breaking out of a loop over
+    it, the producer is stopped at the next event it emits, by raising out of its emit
+    function. The iterator waits for the producer to stop.
+
+    Args:
+        producer (function): Function that takes an emit function and produces events by
+        calling it.
+        interval (float): Minimum amount of seconds between two progress events for a file.
+    """
+    events = queue.Queue(MAX_QUEUED_EVENTS)
+    stop = threading.Event()
+
+    def put(event):
+        while not stop.is_set():
+            try:
+                events.put(event, timeout=STOP_CHECK_INTERVAL)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped()
+
+    thread = threading.Thread(target=_run_producer, args=(producer, interval, put),
+                              daemon=True)
+    thread.start()
+    try:
+        while True:
+            event = events.get()
+            if event is _END:
+                break
+            if isinstance(event, _ProducerError):
+                raise event.error
+            yield event
+    finally:
+        stop.set()
+        thread.join()
+
+async def aiterate(producer, interval=PROGRESS_INTERVAL, loop=None):
+    """Run an event producer in a separate thread and asynchronously iterate over its events.
+    An exception raised by the producer is re-raised by the iterator.
+
+    Args:
+        producer (function): Function that takes an emit function and produces events by
+        calling it.
+        interval (float): Minimum amount of seconds between two progress events for a file.
+        loop (asyncio.AbstractEventLoop): The event loop. Defaults to the running loop.
+    """
+    loop = loop or asyncio.get_event_loop()
+    events = asyncio.Queue()
+
+    def put(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    thread = threading.Thread(target=_run_producer, args=(producer, interval, put),
+                              daemon=True)
+    thread.start()
+    while True:
+        event = await events.get()
+        if event is _END:
+            break
+        if isinstance(event, _ProducerError):
+            raise event.error
+        yield event
+
+class _ProducerError:
+    def __init__(self, error):
+        self.error = error
+
+class _Stopped(Exception):
+    """Raised out of the emit function of a producer whose iterator has been closed."""
+
+def _run_producer(producer, interval, put):
+    try:
+        try:
+            producer(ProgressThrottle(put, interval))
+        except _Stopped:
+            raise
+        except Exception as exc:
+            put(_ProducerError(exc))
+        else:
+            put(_END)
+    except _Stopped:
+        pass
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions for finding and probing the Ghostscript binary. A probe
+resolves the binary to an absolute path, and asks it for its version and output devices. The
+results are cached per process, so that a batch can validate Ghostscript before it starts
+without paying for it on every file, and so that later launches of Ghostscript skip the search
+through PATH.
+
+Probes are cached by the absolute path and modification time of the binary, so upgrading
+Ghostscript in place invalidates the cache.
+
+.. module:: ghostscript
+    :platform: Unix
+    :synopsis: Ghostscript binary resolution and capability probing.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import shutil
+import threading
+import subprocess
+from collections import namedtuple
+
+GS_NOT_INSTALLED = """Ghostscript not installed or not aliased to '{}'.
+Exiting ..."""
+GS_PROBE_FAILED = "Failed to probe Ghostscript at '{}': {}"
+GS_DEVICE_MISSING = "Ghostscript {} at '{}' does not support the {} device"
+# Device that the compression requires.
+REQUIRED_DEVICE = "pdfwrite"
+# Amount of seconds to wait for Ghostscript to answer a probe.
+PROBE_TIMEOUT = 10
+
+GhostscriptInfo = namedtuple('GhostscriptInfo', ['path', 'version', 'devices'])
+
+_lock = threading.Lock()
+_resolved_paths = {}
+_probes = {}
+
+def resolve_binary(binary):
+    """Resolve the name or path of a binary to an absolute path. The path is cached, and is
+    only searched for again if the cached path no longer exists.
+
+    Args:
+        binary (str): Name or path of the binary.
+    Returns:
+        str: The absolute path, or None if the binary can't be found.
+    """
+    with _lock:
+        path = _resolved_paths.get(binary)
+    if path is not None and os.path.isfile(path):
+        return path
+    path = shutil.which(binary)
+    if path is None:
+        return None
+    path = os.path.abspath(path)
+    with _lock:
+        _resolved_paths[binary] = path
+    return path
+
+def probe_ghostscript(binary):
+    """Find a Ghostscript binary and ask it for its version and output devices. Repeated probes
+    of an unchanged binary are answered from a cache.
+
+    Args:
+        binary (str): Name or path of the Ghostscript binary.
+    Returns:
+        GhostscriptInfo: The absolute path, the version and the output devices.
+    Raises:
+        FileNotFoundError
+        subprocess.SubprocessError
+    """
+    path = resolve_binary(binary)
+    if path is None:
+        raise FileNotFoundError(GS_NOT_INSTALLED.format(binary))
+    key = (path, os.stat(path).st_mtime_ns)
+    with _lock:
+        info = _probes.get(key)
+    if info is not None:
+        return info
+    version = _run(path, "--version").strip()
+    info = GhostscriptInfo(path=path, version=version, devices=_parse_devices(_run(path, "-h")))
+    with _lock:
+        _probes[key] = info
+    return info
+
+def check_ghostscript(binary, device=REQUIRED_DEVICE):
+    """Check that a Ghostscript binary exists and supports a device.
+
+    Args:
+        binary (str): Name or path of the Ghostscript binary.
+        device (str): The device.
+    Returns:
+        GhostscriptInfo: The result of the probe.
+    Raises:
+        FileNotFoundError
+        subprocess.SubprocessError
+        ValueError
+    """
+    info = probe_ghostscript(binary)
+    if device not in info.devices:
+        raise ValueError(GS_DEVICE_MISSING.format(info.version, info.path, device))
+    return info
+
+def clear_cache():
+    """Forget all resolved paths and probes."""
+    with _lock:
+        _resolved_paths.clear()
+        _probes.clear()
+
+def _run(path, option):
+    """Run Ghostscript with a single option and return its output."""
+    try:
+        process = subprocess.run([path, option], stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, universal_newlines=True,
+                                 timeout=PROBE_TIMEOUT)
+    except OSError as exc:
+        raise FileNotFoundError(GS_PROBE_FAILED.format(path, exc))
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args, process.stdout)
+    return process.stdout
+
+def _parse_devices(help_text):
+    """Parse the output devices from the output of ``gs -h``. The devices are listed on
+    indented lines after an 'Available devices:' line.
+
+    Args:
+        help_text (str): The output of ``gs -h``.
+    Returns:
+        frozenset(str): The devices.
+    """
+    devices = set()
+    in_devices = False
+    for line in help_text.splitlines():
+        if line.strip() == "Available devices:":
+            in_devices = True
+        elif in_devices and line[:1].isspace():
+            devices.update(line.split())
+        elif in_devices:
+            break
+    return frozenset(devices)
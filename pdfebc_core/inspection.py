@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""This module contains a cheap PDF inspector for the pdfebc program. It is used to estimate
+how much a PDF file can be compressed before spending CPU on actually compressing it.
+
+The inspector memory maps the file and only looks at the trailer, the cross-reference
+section(s) and the dictionaries of the objects listed there. Stream data is never decoded,
+except for cross-reference streams, which are small. If the cross-reference information can't
+be understood, the inspector falls back to a regex scan of the mapped file for image
+dictionaries, which is still a lot cheaper than a compression pass.
+
+.. module:: inspection
+    :platform: Unix
+    :synopsis: Cheap PDF pre-inspection for compression estimates.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import re
+import mmap
+import zlib
+from collections import namedtuple
+
+# Amount of bytes read from the end of a file when looking for the trailer.
+TRAILER_SNIFF_SIZE = 2048
+# Amount of bytes read at an object offset when looking at its dictionary.
+OBJECT_HEADER_SIZE = 1024
+# Upper limit on the amount of chained cross-reference sections to follow.
+MAX_XREF_SECTIONS = 32
+# Resolution that the /ebook Ghostscript preset downsamples images to.
+TARGET_DPI = 150
+# Page size to assume when no /MediaBox can be found (US Letter, in points).
+DEFAULT_PAGE_SIZE = (612.0, 792.0)
+POINTS_PER_INCH = 72.0
+
+# Expected size ratios for the different parts of a file, used by estimate_ratios.
+RAW_IMAGE_LOSSY_RATIO = 0.1
+RAW_IMAGE_LOSSLESS_RATIO = 0.5
+FLATE_IMAGE_LOSSY_RATIO = 0.4
+DCT_IMAGE_LOSSY_RATIO = 0.95
+OTHER_IMAGE_LOSSY_RATIO = 0.9
+STRUCTURE_RATIO = 0.7
+OPTIMIZED_STRUCTURE_RATIO = 0.95
+
+PdfInspection = namedtuple(
+    'PdfInspection',
+    ['file_size', 'page_count', 'page_size', 'uses_object_streams', 'image_count',
+     'image_bytes', 'raw_image_bytes', 'dct_image_bytes', 'flate_image_bytes',
+     'max_image_dpi'])
+
+ImageInfo = namedtuple('ImageInfo', ['width', 'height', 'filters', 'length'])
+
+_STARTXREF_RE = re.compile(rb"startxref\s+(\d+)")
+_XREF_ENTRY_RE = re.compile(rb"\s*(\d{10}) (\d{5}) ([nf])")
+_XREF_SUBSECTION_RE = re.compile(rb"\s*(\d+) (\d+)[ \t]*\r?\n")
+_OBJ_HEADER_RE = re.compile(rb"\s*\d+\s+\d+\s+obj\b")
+_IMAGE_RE = re.compile(rb"/Subtype\s*/Image\b")
+_PAGE_RE = re.compile(rb"/Type\s*/Page\b(?!s)")
+_PAGES_COUNT_RE = re.compile(rb"/Type\s*/Pages\b.*?/Count\s+(\d+)", re.DOTALL)
+_MEDIABOX_RE = re.compile(
+    rb"/MediaBox\s*\[\s*(-?[\d.]+)\s+(-?[\d.]+)\s+(-?[\d.]+)\s+(-?[\d.]+)\s*\]")
+_INT_KEY_RE = r"/{}\s+(\d+)\b(?!\s+\d+\s+R)"
+_REF_KEY_RE = r"/{}\s+(\d+)\s+\d+\s+R"
+_OBJ_INT_RE = re.compile(rb"\s*\d+\s+\d+\s+obj\s*(\d+)")
+_FILTER_RE = re.compile(rb"/Filter\s*(\[[^\]]*\]|/\w+)")
+_NAME_RE = re.compile(rb"/(\w+)")
+_PREV_RE = re.compile(rb"/Prev\s+(\d+)")
+_XREFSTM_RE = re.compile(rb"/XRefStm\s+(\d+)")
+
+def inspect_pdf(filepath):
+    """Inspect a PDF file without parsing it fully.
+
+    Args:
+        filepath (str): Path to the PDF file.
+    Returns:
+        PdfInspection: The inspection, or None if the file is empty.
+    """
+    file_size = os.stat(filepath).st_size
+    if file_size == 0:
+        return None
+    with open(filepath, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        try:
+            offsets, uses_object_streams = _read_xref(data)
+        except (ValueError, IndexError, AttributeError, zlib.error):
+            offsets = None
+            uses_object_streams = _tail(data).find(b"/XRef") != -1
+        if not offsets:
+            return _inspect_by_scanning(data, file_size, uses_object_streams)
+        return _inspect_objects(data, offsets, file_size, uses_object_streams)
+
+def estimate_ratios(inspection, target_dpi=TARGET_DPI):
+    """Estimate the output size divided by the input size of lossy and lossless compression.
+
+    Args:
+        inspection (PdfInspection): An inspection of the file.
+        target_dpi (int): Resolution that lossy compression downsamples images to.
+    Returns:
+        (float, float): The lossy and lossless ratio estimates.
+    """
+    size = inspection.file_size
+    other_image_bytes = (inspection.image_bytes - inspection.raw_image_bytes
+                         - inspection.dct_image_bytes - inspection.flate_image_bytes)
+    structure_bytes = max(0, size - inspection.image_bytes)
+    structure_ratio = (OPTIMIZED_STRUCTURE_RATIO if inspection.uses_object_streams
+                       else STRUCTURE_RATIO)
+    downsampling = 1.0
+    if inspection.max_image_dpi and inspection.max_image_dpi > target_dpi:
+        downsampling = (target_dpi / inspection.max_image_dpi)**2
+    lossy = (structure_bytes * structure_ratio
+             + downsampling * (inspection.raw_image_bytes * RAW_IMAGE_LOSSY_RATIO
+                               + inspection.flate_image_bytes * FLATE_IMAGE_LOSSY_RATIO
+                               + inspection.dct_image_bytes * DCT_IMAGE_LOSSY_RATIO
+                               + other_image_bytes * OTHER_IMAGE_LOSSY_RATIO))
+    lossless = (structure_bytes * structure_ratio
+                + inspection.raw_image_bytes * RAW_IMAGE_LOSSLESS_RATIO
+                + (inspection.image_bytes - inspection.raw_image_bytes))
+    return min(1.0, lossy / size), min(1.0, lossless / size)
+
+def _inspect_objects(data, offsets, file_size, uses_object_streams):
+    """Build an inspection from the dictionaries of the objects in the xref.
+
+    Args:
+        data (mmap.mmap): The mapped file.
+        offsets (dict(int, int)): Object numbers mapped to offsets.
+        file_size (int): Size of the file.
+        uses_object_streams (bool): Whether the file uses object streams.
+    Returns:
+        PdfInspection: The inspection.
+    """
+    def resolve_int(number):
+        if number not in offsets:
+            return 0
+        match = _OBJ_INT_RE.match(_object_header(data, offsets[number]))
+        return int(match.group(1)) if match else 0
+
+    images = []
+    page_count = 0
+    pages_count = None
+    page_size = None
+    for offset in sorted(offsets.values()):
+        header = _object_header(data, offset)
+        if _IMAGE_RE.search(header):
+            images.append(_image_info(header, resolve_int))
+        elif _PAGE_RE.search(header):
+            page_count += 1
+        else:
+            match = _PAGES_COUNT_RE.search(header)
+            if match:
+                pages_count = max(pages_count or 0, int(match.group(1)))
+        if page_size is None:
+            page_size = _page_size(header)
+    # with object streams, the page dictionaries are compressed and can't be counted
+    if pages_count is not None and page_count < pages_count:
+        page_count = pages_count
+    return _build_inspection(file_size, page_count or None, page_size, uses_object_streams,
+                             images)
+
+def _inspect_by_scanning(data, file_size, uses_object_streams):
+    """Build an inspection by scanning the mapped file for image dictionaries.
+
+    Args:
+        data (mmap.mmap): The mapped file.
+        file_size (int): Size of the file.
+        uses_object_streams (bool): Whether the file uses object streams.
+    Returns:
+        PdfInspection: The inspection.
+    """
+    images = []
+    for match in _IMAGE_RE.finditer(data):
+        start = data.rfind(b"obj", max(0, match.start() - OBJECT_HEADER_SIZE), match.start())
+        if start == -1:
+            start = match.start()
+        images.append(_image_info(_object_header(data, start)))
+    page_count = sum(1 for _ in _PAGE_RE.finditer(data)) or None
+    match = _MEDIABOX_RE.search(data)
+    page_size = _page_size(match.group(0)) if match else None
+    return _build_inspection(file_size, page_count, page_size, uses_object_streams, images)
+
+def _build_inspection(file_size, page_count, page_size, uses_object_streams, images):
+    page_size = page_size or DEFAULT_PAGE_SIZE
+    page_inches = (page_size[0] / POINTS_PER_INCH, page_size[1] / POINTS_PER_INCH)
+    byte_counts = {'raw': 0, 'dct': 0, 'flate': 0}
+    max_dpi = 0.0
+    for image in images:
+        if not image.filters:
+            byte_counts['raw'] += image.length
+        elif b"DCTDecode" in image.filters:
+            byte_counts['dct'] += image.length
+        elif image.filters == [b"FlateDecode"]:
+            byte_counts['flate'] += image.length
+        # assume that images span the whole page, which underestimates the resolution
+        dpi = max(image.width / page_inches[0], image.height / page_inches[1])
+        max_dpi = max(max_dpi, dpi)
+    image_bytes = min(file_size, sum(image.length for image in images))
+    return PdfInspection(file_size=file_size,
+                         page_count=page_count,
+                         page_size=page_size,
+                         uses_object_streams=uses_object_streams,
+                         image_count=len(images),
+                         image_bytes=image_bytes,
+                         raw_image_bytes=byte_counts['raw'],
+                         dct_image_bytes=byte_counts['dct'],
+                         flate_image_bytes=byte_counts['flate'],
+                         max_image_dpi=max_dpi or None)
+
+def _image_info(header, resolve_int=None):
+    """Extract the interesting entries from an image XObject dictionary.
+
+    Args:
+        header (bytes): The beginning of the image object.
+        resolve_int (function): Function that returns the integer value of an object given its
+        number. If None, indirect entries are counted as 0.
+    Returns:
+        ImageInfo: The image info.
+    """
+    match = _FILTER_RE.search(header)
+    filters = _NAME_RE.findall(match.group(1)) if match else []
+    return ImageInfo(width=_int_entry(header, "Width", resolve_int),
+                     height=_int_entry(header, "Height", resolve_int),
+                     filters=filters,
+                     length=_int_entry(header, "Length", resolve_int))
+
+def _int_entry(dictionary, key, resolve_int=None):
+    """Get a direct, or if possible indirect, integer entry from a dictionary.
+
+    Returns:
+        int: The value, or 0 if it could not be found.
+    """
+    match = re.search(_INT_KEY_RE.format(key).encode(), dictionary)
+    if match:
+        return int(match.group(1))
+    match = re.search(_REF_KEY_RE.format(key).encode(), dictionary)
+    if match and resolve_int:
+        return resolve_int(int(match.group(1)))
+    return 0
+
+def _page_size(header):
+    match = _MEDIABOX_RE.search(header)
+    if not match:
+        return None
+    llx, lly, urx, ury = map(float, match.groups())
+    width, height = abs(urx - llx), abs(ury - lly)
+    return (width, height) if width and height else None
+
+def _tail(data):
+    return data[max(0, len(data) - TRAILER_SNIFF_SIZE):]
+
+def _object_header(data, offset):
+    """Get the beginning of an object, up to its stream data if it is a stream."""
+    header = data[offset:offset + OBJECT_HEADER_SIZE]
+    for keyword in (b"stream", b"endobj"):
+        end = header.find(keyword)
+        if end != -1:
+            header = header[:end]
+    return header
+
+def _read_xref(data):
+    """Read the offsets of all uncompressed objects from the cross-reference sections.
+
+    Args:
+        data (mmap.mmap): The mapped file.
+    Returns:
+        (dict(int, int), bool): Object numbers mapped to offsets and whether the file uses
+        object streams.
+    Raises:
+        ValueError
+        zlib.error
+    """
+    matches = list(_STARTXREF_RE.finditer(_tail(data)))
+    if not matches:
+        raise ValueError("No startxref found")
+    pending = [int(matches[-1].group(1))]
+    visited = set()
+    offsets = {}
+    uses_object_streams = False
+    while pending and len(visited) < MAX_XREF_SECTIONS:
+        position = pending.pop()
+        if position in visited or position >= len(data):
+            continue
+        visited.add(position)
+        xref_stream = None
+        if data[position:position + 4] == b"xref":
+            section_offsets, trailer = _read_xref_table(data, position)
+            match = _XREFSTM_RE.search(trailer)
+            if match:
+                xref_stream = int(match.group(1))
+        else:
+            section_offsets, trailer, compressed = _read_xref_stream(data, position)
+            uses_object_streams = uses_object_streams or compressed
+        # entries in newer sections take precedence over older ones
+        for number, offset in section_offsets.items():
+            offsets.setdefault(number, offset)
+        match = _PREV_RE.search(trailer)
+        if match:
+            pending.append(int(match.group(1)))
+        # the xref stream of a hybrid file belongs to the same update as its table, so it is
+        # read before the previous section, and is pushed last to be popped first
+        if xref_stream is not None:
+            pending.append(xref_stream)
+    return offsets, uses_object_streams
+
+def _read_xref_table(data, position):
+    """Read a classic cross-reference table and its trailer dictionary.
+
+    Returns:
+        (dict(int, int), bytes): Object numbers mapped to offsets and the trailer.
+    """
+    trailer_start = data.find(b"trailer", position)
+    if trailer_start == -1:
+        raise ValueError("No trailer found for xref table at {}".format(position))
+    table = data[position + 4:trailer_start]
+    offsets = {}
+    index = 0
+    while True:
+        subsection = _XREF_SUBSECTION_RE.match(table, index)
+        if not subsection:
+            break
+        first, count = int(subsection.group(1)), int(subsection.group(2))
+        index = subsection.end()
+        for number in range(first, first + count):
+            entry = _XREF_ENTRY_RE.match(table, index)
+            if not entry:
+                raise ValueError("Malformed xref entry at {}".format(position + 4 + index))
+            index = entry.end()
+            if entry.group(3) == b"n":
+                offsets[number] = int(entry.group(1))
+    return offsets, data[trailer_start:trailer_start + TRAILER_SNIFF_SIZE]
+
+def _read_xref_stream(data, position):
+    """Read a cross-reference stream.
+
+    Returns:
+        (dict(int, int), bytes, bool): Object numbers mapped to offsets, the stream dictionary
+        and whether any object is stored in an object stream.
+    """
+    header = data[position:position + OBJECT_HEADER_SIZE]
+    if not _OBJ_HEADER_RE.match(header) or b"/XRef" not in header:
+        raise ValueError("No xref stream at {}".format(position))
+    stream_keyword = header.find(b"stream")
+    dictionary = header[:stream_keyword]
+    length = _int_entry(dictionary, "Length")
+    widths = [int(width) for width in
+              re.search(rb"/W\s*\[\s*([\d\s]+)\]", dictionary).group(1).split()]
+    index_match = re.search(rb"/Index\s*\[\s*([\d\s]+)\]", dictionary)
+    size = _int_entry(dictionary, "Size")
+    index = ([int(value) for value in index_match.group(1).split()] if index_match
+             else [0, size])
+    start = position + stream_keyword + len(b"stream")
+    start += 2 if data[start:start + 2] == b"\r\n" else 1
+    raw = data[start:start + length]
+    if b"/FlateDecode" in dictionary:
+        raw = zlib.decompress(raw)
+    rows = _unpredict(raw, sum(widths), dictionary)
+    offsets = {}
+    compressed = False
+    row_iter = iter(rows)
+    for first, count in zip(index[::2], index[1::2]):
+        for number in range(first, first + count):
+            row = next(row_iter, None)
+            if row is None:
+                break
+            fields = []
+            column = 0
+            for width in widths:
+                fields.append(int.from_bytes(row[column:column + width], 'big'))
+                column += width
+            entry_type = fields[0] if widths[0] else 1
+            if entry_type == 1:
+                offsets[number] = fields[1]
+            elif entry_type == 2:
+                compressed = True
+    return offsets, dictionary, compressed
+
+def _unpredict(raw, columns, dictionary):
+    """Split decoded xref stream data into rows, undoing PNG predictors if present.
+
+    Only the None and Up PNG filters are supported, as those are the ones that PDF writers
+    use for cross-reference streams in practice.
+
+    Raises:
+        ValueError
+    """
+    predictor = _int_entry(dictionary, "Predictor")
+    if predictor < 10:
+        return [raw[i:i + columns] for i in range(0, len(raw), columns)]
+    rows = []
+    previous = bytes(columns)
+    for i in range(0, len(raw), columns + 1):
+        png_filter, row = raw[i], raw[i + 1:i + 1 + columns]
+        if png_filter == 2:
+            row = bytes((a + b) & 0xff for a, b in zip(row, previous))
+        elif png_filter != 0:
+            raise ValueError("Unsupported PNG predictor filter {}".format(png_filter))
+        rows.append(row)
+        previous = row
+    return rows
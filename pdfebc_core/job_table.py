@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""This module contains a compact table of compression jobs for very large batches.
+
+A batch of a million files kept as a list of :py:class:`CompressionJob` tuples costs several
+hundred bytes per file for the tuples and the full path strings. A :py:class:`JobTable`
+instead stores each directory once, and keeps the jobs in ``array`` columns of directory
+indexes, name offsets, sizes and states, with the basenames packed into one buffer. That is
+about 40 bytes per file plus the length of its name. Jobs are built as
+:py:class:`CompressionJob` tuples only when they are read.
+
+A table can be saved to a file and loaded again, and the states of its jobs can be saved on
+their own while a batch runs, so that an interrupted batch can continue with the jobs that are
+not done without planning the batch again.
+
+.. module:: job_table
+    :platform: Unix
+    :synopsis: Compact, resumable table of compression jobs.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import sys
+import json
+import heapq
+from array import array
+from collections import namedtuple
+
+PENDING = 0
+DONE = 1
+FAILED = 2
+STATES = (PENDING, DONE, FAILED)
+
+MAGIC = b"PDFEBC-JOBS 1\n"
+_INDEX_TYPECODE = 'I'
+_OFFSET_TYPECODE = 'Q'
+_SIZE_TYPECODE = 'q'
+_STATE_TYPECODE = 'B'
+# Columns of a table in the order that they are saved in. The states are saved last, so that
+# they can be rewritten in place.
+_JOB_COLUMNS = ('_source_directories', '_output_directories', '_source_names',
+                '_output_names', '_sizes', '_directory_indexes')
+# Amount of jobs that are sorted as a list of Python ints at a time by JobTable.sort_by_size.
+SORT_CHUNK_SIZE = 2**16
+
+NOT_A_JOB_TABLE = "'{}' is not a job table"
+INCOMPATIBLE_JOB_TABLE = "Job table '{}' was saved on an incompatible platform"
+INVALID_STATE = "Invalid job state {}"
+
+CompressionJob = namedtuple('CompressionJob', ['source_path', 'output_path', 'size',
+                                               'directory_index', 'job_index'])
+CompressionJob.__new__.__defaults__ = (None,)
+CompressionJob.__doc__ = """A file to compress.
+
+Args:
+    source_path (str): Path to the source file.
+    output_path (str): Path to the output file.
+    size (int): Size of the source file in bytes.
+    directory_index (int): Index of the directory pair of the file in its batch.
+    job_index (int): Index of the job in its :py:class:`JobTable`, or None.
+"""
+
+class JobTable:
+    """Table of compression jobs, stored in compact columns.
+
+    Args:
+        directory_pairs (list((str, str))): Pairs of source and output directories of the
+        batch. Only kept as a record, e.g. to check that a saved table belongs to a batch.
+    """
+
+    def __init__(self, directory_pairs=()):
+        self.directory_pairs = [tuple(pair) for pair in directory_pairs]
+        self._directories = []
+        self._directory_ids = {}
+        self._names = bytearray()
+        self._name_ends = array(_OFFSET_TYPECODE)
+        self._source_directories = array(_INDEX_TYPECODE)
+        self._output_directories = array(_INDEX_TYPECODE)
+        self._source_names = array(_INDEX_TYPECODE)
+        self._output_names = array(_INDEX_TYPECODE)
+        self._sizes = array(_SIZE_TYPECODE)
+        self._directory_indexes = array(_INDEX_TYPECODE)
+        self._states = array(_STATE_TYPECODE)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        source_path = os.path.join(self._directories[self._source_directories[index]],
+                                   self._name(self._source_names[index]))
+        output_path = os.path.join(self._directories[self._output_directories[index]],
+                                   self._name(self._output_names[index]))
+        return CompressionJob(source_path=source_path, output_path=output_path,
+                              size=self._sizes[index],
+                              directory_index=self._directory_indexes[index],
+                              job_index=index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def add(self, source_path, output_path, size, directory_index):
+        """Add a pending job to the table.
+
+        Args:
+            source_path (str): Path to the source file.
+            output_path (str): Path to the output file.
+            size (int): Size of the source file in bytes.
+            directory_index (int): Index of the directory pair of the file.
+        Returns:
+            int: Index of the job.
+        """
+        source_directory, source_name = os.path.split(source_path)
+        output_directory, output_name = os.path.split(output_path)
+        self._source_directories.append(self._intern_directory(source_directory))
+        self._output_directories.append(self._intern_directory(output_directory))
+        source_name_id = self._add_name(source_name)
+        self._source_names.append(source_name_id)
+        self._output_names.append(source_name_id if output_name == source_name
+                                  else self._add_name(output_name))
+        self._sizes.append(size)
+        self._directory_indexes.append(directory_index)
+        self._states.append(PENDING)
+        return len(self) - 1
+
+    def state(self, index):
+        """Return the state of a job, :py:const:`PENDING`, :py:const:`DONE` or
+        :py:const:`FAILED`.
+        """
+        return self._states[index]
+
+    def set_state(self, index, state):
+        """Set the state of a job.
+
+        Args:
+            index (int): Index of the job.
+            state (int): The new state.
+        Raises:
+            ValueError
+        """
+        if state not in STATES:
+            raise ValueError(INVALID_STATE.format(state))
+        self._states[index] = state
+
+    def pending(self):
+        """Iterate over the jobs that are not done, i.e. pending and failed jobs, in table
+        order. Used to continue an interrupted batch.
+
+        Yields:
+            CompressionJob: The jobs.
+        """
+        for index, state in enumerate(self._states):
+            if state != DONE:
+                yield self[index]
+
+    def count(self, state):
+        """Return the amount of jobs in a state."""
+        return self._states.count(state)
+
+    def sort_by_size(self):
+        """Order the jobs with the largest file first, keeping the order of equally large files.
+        The states are reordered with their jobs, so indexes from before the sort are invalid
+        afterwards.
+
+        Sorting all indexes at once would build a list of Python ints of about 36 bytes per
+        job. Instead, the indexes are sorted in chunks of :py:const:`SORT_CHUNK_SIZE`, which are
+        kept as arrays and merged. The sort therefore needs about 8 bytes per job, and then one
+        column at a time is rebuilt in the new order.
+        """
+        sizes = self._sizes
+        chunks = [array(_INDEX_TYPECODE, sorted(range(start, min(start + SORT_CHUNK_SIZE,
+                                                                  len(self))),
+                                                key=sizes.__getitem__, reverse=True))
+                  for start in range(0, len(self), SORT_CHUNK_SIZE)]
+        # the chunks are in index order and merge keeps the order of equal keys across them,
+        # so the merge is stable
+        order = array(_INDEX_TYPECODE, heapq.merge(*chunks, key=sizes.__getitem__,
+                                                   reverse=True))
+        del chunks
+        for column in _JOB_COLUMNS + ('_states',):
+            values = getattr(self, column)
+            setattr(self, column, array(values.typecode, (values[index] for index in order)))
+
+    def save(self, path):
+        """Save the table to a file. The file is written next to the path and moved into
+        place, so an interrupted save leaves the previous file intact.
+
+        Args:
+            path (str): Path to the file.
+        """
+        header = {'directories': self._directories,
+                  'directory_pairs': self.directory_pairs,
+                  'jobs': len(self),
+                  'names': len(self._name_ends),
+                  'names_size': len(self._names),
+                  'byteorder': sys.byteorder,
+                  'itemsizes': [array(typecode).itemsize for typecode in
+                                (_INDEX_TYPECODE, _OFFSET_TYPECODE, _SIZE_TYPECODE)]}
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(MAGIC)
+            file.write(json.dumps(header).encode('utf-8') + b'\n')
+            self._name_ends.tofile(file)
+            file.write(self._names)
+            for column in _JOB_COLUMNS:
+                getattr(self, column).tofile(file)
+            self._states.tofile(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+
+    def save_states(self, path):
+        """Rewrite the states of the jobs in a file that the table was saved to or loaded from,
+        which is much cheaper than saving the whole table.
+
+        Args:
+            path (str): Path to the file.
+        """
+        with open(path, 'r+b') as file:
+            file.seek(-len(self._states), os.SEEK_END)
+            self._states.tofile(file)
+            file.flush()
+            os.fsync(file.fileno())
+
+    @classmethod
+    def load(cls, path):
+        """Load a table from a file.
+
+        Args:
+            path (str): Path to the file.
+        Returns:
+            JobTable: The table.
+        Raises:
+            ValueError
+            OSError
+        """
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(NOT_A_JOB_TABLE.format(path))
+            try:
+                header = json.loads(file.readline().decode('utf-8'))
+            except ValueError as exc:
+                raise ValueError(NOT_A_JOB_TABLE.format(path)) from exc
+            itemsizes = [array(typecode).itemsize for typecode in
+                         (_INDEX_TYPECODE, _OFFSET_TYPECODE, _SIZE_TYPECODE)]
+            if header['byteorder'] != sys.byteorder or header['itemsizes'] != itemsizes:
+                raise ValueError(INCOMPATIBLE_JOB_TABLE.format(path))
+            table = cls(header['directory_pairs'])
+            table._directories = header['directories']
+            table._directory_ids = {directory: directory_id for directory_id, directory
+                                    in enumerate(table._directories)}
+            try:
+                table._name_ends.fromfile(file, header['names'])
+                table._names = bytearray(file.read(header['names_size']))
+                for column in _JOB_COLUMNS:
+                    getattr(table, column).fromfile(file, header['jobs'])
+                table._states.fromfile(file, header['jobs'])
+            except EOFError as exc:
+                raise ValueError(NOT_A_JOB_TABLE.format(path)) from exc
+        return table
+
+    def _intern_directory(self, directory):
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = self._directory_ids[directory] = len(self._directories)
+            self._directories.append(directory)
+        return directory_id
+
+    def _add_name(self, name):
+        self._names += name.encode('utf-8', 'surrogateescape')
+        self._name_ends.append(len(self._names))
+        return len(self._name_ends) - 1
+
+    def _name(self, name_id):
+        start = self._name_ends[name_id - 1] if name_id else 0
+        return self._names[start:self._name_ends[name_id]].decode('utf-8', 'surrogateescape')
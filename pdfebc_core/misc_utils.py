@@ -10,6 +10,12 @@ for more information.
 
 .. moduleauthor:: Simon Larsén <slarse@kth.se>
 """
+import os
+import hashlib
+from collections import OrderedDict
+
+# Size of the chunks that files are read in when hashing them.
+HASH_CHUNK_SIZE = 1024**2
 
 def if_callable_call_with_formatted_string(callback, formattable_string, *args):
     """If the callback is callable, format the string with the args and make a call.
@@ -30,3 +36,45 @@ def if_callable_call_with_formatted_string(callback, formattable_string, *args):
                          "and the amount of args given.")
     if callable(callback):
         callback(formatted_string)
+
+def group_identical_files(filepaths):
+    """Group files with identical contents. Files are first grouped by size, and only files
+    that share their size with another file are hashed.
+
+    Args:
+        filepaths (list(str)): A list of filepaths. A path that occurs several times is put in
+        the same group several times.
+    Returns:
+        list(list(str)): Groups of filepaths with identical contents, in order of the first
+        occurrence of each group in 'filepaths'. Within a group, the paths are in the order
+        that they were given.
+    """
+    by_size = OrderedDict()
+    for filepath in filepaths:
+        by_size.setdefault(os.stat(filepath).st_size, []).append(filepath)
+    groups = []
+    for same_size in by_size.values():
+        if len(same_size) == 1:
+            groups.append(same_size)
+            continue
+        by_digest = OrderedDict()
+        for filepath in same_size:
+            by_digest.setdefault(file_digest(filepath), []).append(filepath)
+        groups.extend(by_digest.values())
+    position = {filepath: index for index, filepath in reversed(list(enumerate(filepaths)))}
+    groups.sort(key=lambda group: position[group[0]])
+    return groups
+
+def file_digest(filepath):
+    """Compute the SHA-256 digest of a file, reading it in chunks.
+
+    Args:
+        filepath (str): Path to the file.
+    Returns:
+        bytes: The digest.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions for planning where the outputs of the compress functions go,
+and for writing them safely when several processes share an output directory.
+
+Output files are named after their source files. When sources in different directories have
+the same name and are compressed into the same output directory, the first one in sorted order
+keeps its name, and the others get a suffix derived from the path of their source directory.
+The names therefore only depend on the sources, and not on the order that they are found in.
+
+Each output is written while holding an advisory lock (``fcntl.flock``) on a lock file next to
+it, so that processes that compress into the same output directory never write the same output
+at the same time.
+
+.. module:: outputs
+    :platform: Unix
+    :synopsis: Output path planning and locking.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import fcntl
+import hashlib
+import contextlib
+import daiquiri
+
+LOCK_SUFFIX = ".lock"
+# Amount of hex digits of the source directory hash in the name of a colliding output.
+COLLISION_HASH_LENGTH = 8
+
+NAME_COLLISION = "'{}' has the same name as '{}', its output is '{}'"
+
+LOGGER = daiquiri.getLogger(__name__)
+
+def ensure_directory(directory):
+    """Create a directory and its parents, if they don't already exist. Safe to call from
+    several processes at once.
+
+    Args:
+        directory (str): Path to the directory.
+    Raises:
+        OSError
+    """
+    os.makedirs(directory, exist_ok=True)
+
+def plan_output_paths(source_paths, output_directory):
+    """Decide the output path of each source file, such that no two sources get the same
+    output path.
+
+    Args:
+        source_paths (list(str)): Paths to the source files.
+        output_directory (str): The output directory.
+    Returns:
+        dict(str, str): The output path of each source path.
+    """
+    output_paths = {}
+    owners = {}
+    for source_path in sorted(set(source_paths)):
+        basename = os.path.basename(source_path)
+        name = basename
+        if name in owners:
+            stem, extension = os.path.splitext(basename)
+            directory = os.path.dirname(os.path.abspath(source_path))
+            digest = hashlib.sha1(directory.encode('utf-8', 'surrogateescape')).hexdigest()
+            name = "{}-{}{}".format(stem, digest[:COLLISION_HASH_LENGTH], extension)
+            counter = 1
+            while name in owners:
+                counter += 1
+                name = "{}-{}-{}{}".format(stem, digest[:COLLISION_HASH_LENGTH], counter,
+                                           extension)
+            LOGGER.warning(NAME_COLLISION.format(source_path, owners[basename], name))
+        owners[name] = source_path
+        output_paths[source_path] = os.path.join(output_directory, name)
+    return output_paths
+
+@contextlib.contextmanager
+def lock_output(output_path):
+    """Context manager that holds an exclusive advisory lock on an output path. If another
+    process holds the lock, this waits until it is released. The lock file is removed when the
+    lock is released.
+
+    Args:
+        output_path (str): The output path.
+    Yields:
+        bool: True if the lock was held by another process when it was requested.
+    """
+    lock_path = _lock_path(output_path)
+    waited = False
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                waited = True
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            # the holder removes the lock file on release, so the lock is only valid if the
+            # file is still in place
+            if os.path.samestat(os.fstat(fd), os.stat(lock_path)):
+                break
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+    try:
+        yield waited
+    finally:
+        try:
+            os.remove(lock_path)
+        finally:
+            os.close(fd)
+
+def _lock_path(output_path):
+    directory, basename = os.path.split(output_path)
+    return os.path.join(directory, ".{}{}".format(basename, LOCK_SUFFIX))
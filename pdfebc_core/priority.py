@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""This module contains controls for running compression in the background on hosts that are
+shared with latency-sensitive services.
+
+A :py:class:`WorkerPriority` gives the nice level, I/O scheduling class and CPUs of the worker
+processes. It is applied to each worker when it starts, and is inherited by the Ghostscript
+processes that the worker runs. The I/O priority is set with the ``ioprio_set`` system call
+through ctypes, and only has an effect with I/O schedulers that support priorities (e.g. BFQ).
+
+A :py:class:`LoadAdaptiveLimit` lowers the amount of concurrent jobs while the load average of
+the host is above a threshold, and raises it again when the load has dropped. As the
+compression itself adds to the load, the threshold should leave room for the workers.
+
+.. module:: priority
+    :platform: Linux
+    :synopsis: Niceness, I/O priority, CPU affinity and load-adaptive concurrency.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import platform
+from collections import namedtuple
+import daiquiri
+
+IOPRIO_CLASS_NONE = 0
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IO_CLASSES = {IOPRIO_CLASS_RT, IOPRIO_CLASS_BE, IOPRIO_CLASS_IDLE}
+IOPRIO_LEVELS = range(8)
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+# Numbers of the ioprio_set and ioprio_get system calls per architecture.
+_IOPRIO_SYSCALLS = {'x86_64': (251, 252), 'i386': (289, 290), 'i686': (289, 290),
+                    'aarch64': (30, 31), 'armv7l': (314, 315), 'ppc64le': (273, 274),
+                    's390x': (282, 283)}
+
+NICE_LEVELS = range(-20, 20)
+# Default amount of seconds between two looks at the load average. The kernel updates it
+# every five seconds.
+LOAD_CHECK_INTERVAL = 5.0
+
+INVALID_NICE = "Nice level must be in [-20, 19], was {}"
+INVALID_IO_CLASS = "I/O class must be one of {}, was {}"
+INVALID_IO_LEVEL = "I/O priority level must be in [0, 7], was {}"
+INVALID_CPUS = "CPUs {} are not available, the available CPUs are {}"
+IOPRIO_UNSUPPORTED = "I/O priorities are not supported on {}"
+PRIORITY_NOT_APPLIED = "Could not apply {} to worker {}: {}"
+CONCURRENCY_LOWERED = "Load average {:.2f} is above {}, lowering concurrency to {}"
+CONCURRENCY_RAISED = "Load average {:.2f} is below {}, raising concurrency to {}"
+
+LOGGER = daiquiri.getLogger(__name__)
+
+WorkerPriority = namedtuple('WorkerPriority', ['nice', 'io_class', 'io_level', 'cpus'])
+WorkerPriority.__new__.__defaults__ = (None, None, None, None)
+WorkerPriority.__doc__ = """Priority of worker processes. Fields that are None are left as
+they are.
+
+Args:
+    nice (int): Nice level, from -20 (highest priority) to 19 (lowest priority). Levels below
+    the current one require privileges.
+    io_class (int): I/O scheduling class, :py:const:`IOPRIO_CLASS_IDLE`,
+    :py:const:`IOPRIO_CLASS_BE` or :py:const:`IOPRIO_CLASS_RT` (requires privileges).
+    io_level (int): Priority within the I/O class, from 0 (highest) to 7 (lowest).
+    cpus (set(int)): CPUs that the workers may run on.
+"""
+
+class LoadAdaptiveLimit:
+    """Concurrency limit that follows the load average of the host. The limit is lowered by
+    one job each time the 1-minute load average is found above the threshold, and raised by one
+    each time it is found below the threshold minus one, so it does not flap around the
+    threshold.
+
+    Args:
+        max_workers (int): The highest limit.
+        load_threshold (float): Load average above which the limit is lowered. Defaults to the
+        amount of CPUs.
+        min_workers (int): The lowest limit.
+        interval (float): Minimum amount of seconds between two changes of the limit.
+    """
+
+    def __init__(self, max_workers, load_threshold=None, min_workers=1,
+                 interval=LOAD_CHECK_INTERVAL):
+        self.max_workers = max_workers
+        self.load_threshold = load_threshold or os.cpu_count() or 1
+        self.min_workers = min(min_workers, max_workers)
+        self.interval = interval
+        self.current = max_workers
+        self._last_check = None
+
+    def limit(self):
+        """Return the current limit, after adjusting it to the load average if the interval
+        has passed since the last adjustment.
+
+        Returns:
+            int: The amount of jobs that may run concurrently.
+        """
+        now = time.monotonic()
+        if self._last_check is not None and now - self._last_check < self.interval:
+            return self.current
+        self._last_check = now
+        load = os.getloadavg()[0]
+        if load > self.load_threshold and self.current > self.min_workers:
+            self.current -= 1
+            LOGGER.info(CONCURRENCY_LOWERED.format(load, self.load_threshold, self.current))
+        elif load < self.load_threshold - 1 and self.current < self.max_workers:
+            self.current += 1
+            LOGGER.info(CONCURRENCY_RAISED.format(load, self.load_threshold, self.current))
+        return self.current
+
+def validate_priority(priority):
+    """Check that a priority can be applied on this host, before starting workers with it.
+
+    Args:
+        priority (WorkerPriority): The priority.
+    Raises:
+        ValueError
+    """
+    if priority.nice is not None and priority.nice not in NICE_LEVELS:
+        raise ValueError(INVALID_NICE.format(priority.nice))
+    if priority.io_class is not None:
+        if priority.io_class not in IO_CLASSES:
+            raise ValueError(INVALID_IO_CLASS.format(sorted(IO_CLASSES), priority.io_class))
+        if _ioprio_syscalls() is None:
+            raise ValueError(IOPRIO_UNSUPPORTED.format(platform.machine()))
+    if priority.io_level is not None and priority.io_level not in IOPRIO_LEVELS:
+        raise ValueError(INVALID_IO_LEVEL.format(priority.io_level))
+    if priority.cpus is not None:
+        available = os.sched_getaffinity(0)
+        unavailable = set(priority.cpus) - available
+        if unavailable or not priority.cpus:
+            raise ValueError(INVALID_CPUS.format(sorted(unavailable), sorted(available)))
+
+def apply_priority(priority, pid=0):
+    """Apply a priority to a process. Processes that it starts afterwards inherit it.
+
+    Args:
+        priority (WorkerPriority): The priority.
+        pid (int): The process. Defaults to the calling process.
+    Raises:
+        OSError
+    """
+    if priority.nice is not None:
+        os.setpriority(os.PRIO_PROCESS, pid, priority.nice)
+    if priority.io_class is not None or priority.io_level is not None:
+        io_class = priority.io_class
+        if io_class is None:
+            io_class = io_priority(pid)[0] or IOPRIO_CLASS_BE
+        set_io_priority(io_class, priority.io_level or 0, pid)
+    if priority.cpus is not None:
+        os.sched_setaffinity(pid, priority.cpus)
+
+def apply_worker_priority(priority):
+    """Apply a priority to the calling worker process, and log instead of raising if it can't
+    be applied, so that a worker pool is not broken by it. Called by workers before their first
+    job.
+
+    Args:
+        priority (WorkerPriority): The priority, or None to leave the priority as it is.
+    """
+    if priority is None:
+        return
+    try:
+        apply_priority(priority)
+    except OSError as exc:
+        LOGGER.warning(PRIORITY_NOT_APPLIED.format(priority, os.getpid(), exc))
+
+def set_io_priority(io_class, io_level=0, pid=0):
+    """Set the I/O scheduling class and priority of a process.
+
+    Args:
+        io_class (int): The I/O class.
+        io_level (int): The priority within the class.
+        pid (int): The process. Defaults to the calling process.
+    Raises:
+        OSError
+    """
+    _ioprio_call(0, pid, (io_class << _IOPRIO_CLASS_SHIFT) | io_level)
+
+def io_priority(pid=0):
+    """Return the I/O scheduling class and priority of a process.
+
+    Args:
+        pid (int): The process. Defaults to the calling process.
+    Returns:
+        (int, int): The I/O class and the priority within the class. The class is
+        :py:const:`IOPRIO_CLASS_NONE` if it has not been set.
+    Raises:
+        OSError
+    """
+    value = _ioprio_call(1, pid)
+    return value >> _IOPRIO_CLASS_SHIFT, value & ((1 << _IOPRIO_CLASS_SHIFT) - 1)
+
+def _ioprio_syscalls():
+    return _IOPRIO_SYSCALLS.get(platform.machine())
+
+def _ioprio_call(index, pid, *args):
+    syscalls = _ioprio_syscalls()
+    library = ctypes.util.find_library('c')
+    if syscalls is None or library is None:
+        raise OSError(errno.ENOSYS, IOPRIO_UNSUPPORTED.format(platform.machine()))
+    libc = ctypes.CDLL(library, use_errno=True)
+    result = libc.syscall(syscalls[index], _IOPRIO_WHO_PROCESS, pid, *args)
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
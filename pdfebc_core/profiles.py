@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""This module contains device profiles, which tune the Ghostscript compression to the screen
+of a known e-reader instead of the generic ``/ebook`` preset.
+
+A profile gives the resolution of the screen in dots per inch, whether it is grayscale, and
+optionally its size in pixels. Images are downsampled to the resolution, color is converted
+to gray for grayscale screens, and with a size, pages are scaled to fit the physical size of
+the screen, so that images end up with about one image pixel per screen pixel. Fonts are
+subset and compressed in all cases.
+
+Profiles are defined in the DEFAULTS section of the config file, and one of them may be
+selected as the default:
+
+| [DEFAULTS]
+| profile = kobo
+| profile.kobo = resolution=300, grayscale=yes, max_size=1264x1680
+| profile.tablet = resolution=264
+
+.. module:: profiles
+    :platform: Unix
+    :synopsis: Device profiles mapped to Ghostscript flags.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import configparser
+from collections import namedtuple
+from .config_utils import (DEFAULT_SECTION_KEY, PROFILE_KEY, PROFILE_KEY_PREFIX,
+                           ConfigurationError)
+
+RESOLUTION_KEY = "resolution"
+GRAYSCALE_KEY = "grayscale"
+MAX_SIZE_KEY = "max_size"
+PROFILE_KEYS = {RESOLUTION_KEY, GRAYSCALE_KEY, MAX_SIZE_KEY}
+POINTS_PER_INCH = 72
+# Monochrome images lose legibility quickly when downsampled, so they keep a higher resolution.
+MONO_RESOLUTION_FACTOR = 2
+
+MALFORMED_PROFILE = "Device profile '{}' is badly formed: {}"
+UNKNOWN_PROFILE = "Device profile '{}' is not defined in the {} section"
+
+DeviceProfile = namedtuple('DeviceProfile', ['name', 'resolution', 'grayscale', 'max_size'])
+
+def parse_profile(name, value):
+    """Parse the definition of a device profile, e.g.
+    ``resolution=300, grayscale=yes, max_size=1264x1680``. Only the resolution is required.
+
+    Args:
+        name (str): Name of the profile.
+        value (str): The definition.
+    Returns:
+        DeviceProfile: The profile. Its max_size is a (width, height) tuple in pixels, or None.
+    Raises:
+        ConfigurationError
+    """
+    settings = {}
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        key, separator, setting = (part.strip() for part in item.partition('='))
+        if not separator or key not in PROFILE_KEYS or key in settings:
+            raise ConfigurationError(MALFORMED_PROFILE.format(name, item))
+        settings[key] = setting.lower()
+    try:
+        resolution = int(settings[RESOLUTION_KEY])
+        grayscale = configparser.ConfigParser.BOOLEAN_STATES[
+            settings.get(GRAYSCALE_KEY, 'no')]
+        max_size = settings.get(MAX_SIZE_KEY)
+        if max_size is not None:
+            max_size = tuple(int(pixels) for pixels in max_size.split('x'))
+    except (KeyError, ValueError) as exc:
+        raise ConfigurationError(MALFORMED_PROFILE.format(name, value)) from exc
+    if resolution <= 0 or (max_size is not None and
+                           (len(max_size) != 2 or min(max_size) <= 0)):
+        raise ConfigurationError(MALFORMED_PROFILE.format(name, value))
+    return DeviceProfile(name=name, resolution=resolution, grayscale=grayscale,
+                         max_size=max_size)
+
+def profiles_from_config(config):
+    """Parse all device profiles defined in the DEFAULTS section of a config.
+
+    Args:
+        config (defaultdict): A defaultdict.
+    Returns:
+        dict(str, DeviceProfile): The profiles by name.
+    Raises:
+        ConfigurationError
+    """
+    section = config.get(DEFAULT_SECTION_KEY) or {}
+    return {key[len(PROFILE_KEY_PREFIX):]: parse_profile(key[len(PROFILE_KEY_PREFIX):], value)
+            for key, value in section.items() if key.startswith(PROFILE_KEY_PREFIX)}
+
+def profile_from_config(config, name=None):
+    """Get a device profile from the DEFAULTS section of a config.
+
+    Args:
+        config (defaultdict): A defaultdict.
+        name (str): Name of the profile. Defaults to the one selected by the profile key.
+    Returns:
+        DeviceProfile: The profile, or None if no name is given and none is selected.
+    Raises:
+        ConfigurationError
+    """
+    section = config.get(DEFAULT_SECTION_KEY) or {}
+    name = name or section.get(PROFILE_KEY)
+    if not name:
+        return None
+    value = section.get(PROFILE_KEY_PREFIX + name)
+    if value is None:
+        raise ConfigurationError(UNKNOWN_PROFILE.format(name, DEFAULT_SECTION_KEY))
+    return parse_profile(name, value)
+
+def ghostscript_flags(profile):
+    """Map a device profile to Ghostscript pdfwrite flags.
+
+    Args:
+        profile (DeviceProfile): The profile.
+    Returns:
+        list(str): The flags.
+    """
+    resolution = profile.resolution
+    flags = ["-dDownsampleColorImages=true", "-dDownsampleGrayImages=true",
+             "-dDownsampleMonoImages=true",
+             "-dColorImageDownsampleType=/Bicubic", "-dGrayImageDownsampleType=/Bicubic",
+             "-dColorImageResolution=%d" % resolution,
+             "-dGrayImageResolution=%d" % resolution,
+             "-dMonoImageResolution=%d" % (resolution * MONO_RESOLUTION_FACTOR),
+             "-dDetectDuplicateImages=true",
+             "-dEmbedAllFonts=true", "-dSubsetFonts=true", "-dCompressFonts=true"]
+    if profile.grayscale:
+        flags += ["-sColorConversionStrategy=Gray", "-dProcessColorModel=/DeviceGray"]
+    if profile.max_size is not None:
+        width, height = (pixels * POINTS_PER_INCH // resolution for pixels in profile.max_size)
+        flags += ["-dDEVICEWIDTHPOINTS=%d" % width, "-dDEVICEHEIGHTPOINTS=%d" % height,
+                  "-dFIXEDMEDIA", "-dPDFFitPage"]
+    return flags
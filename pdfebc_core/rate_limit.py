@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""This module contains a rate limiter for outbound email. Providers like Gmail throttle or lock
+accounts that send too many messages per minute, or too many bytes per day, so the email_utils
+functions can be given a :py:class:`SendLimiter` that holds sends back until they fit in the
+quotas.
+
+Each quota is a token bucket that holds at most one period's worth of tokens, and is refilled
+continuously. A send takes one token from the message bucket and one token per byte from the
+byte bucket. If there are not enough tokens, the send waits until there are, instead of failing.
+
+The state of a limiter can be persisted to a file, which lets several processes share the same
+quotas. The file is locked with ``fcntl.flock`` while it is read and updated.
+
+.. module:: rate_limit
+    :platform: Unix
+    :synopsis: Token bucket rate limiting of outbound email.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import json
+import time
+import fcntl
+import asyncio
+import contextlib
+import daiquiri
+
+MESSAGES_PERIOD = 60
+BYTES_PERIOD = 24 * 60 * 60
+MESSAGES_BUCKET = "messages"
+BYTES_BUCKET = "bytes"
+
+WAITING_FOR_QUOTA = "Send quota reached, waiting {:.1f} seconds"
+MESSAGE_OVER_QUOTA = "A message of {} bytes never fits in the quota of {} bytes per day"
+INVALID_CAPACITY = "A quota must be at least 1 per period, was {}"
+
+LOGGER = daiquiri.getLogger(__name__)
+
+class TokenBucket:
+    """A bucket of at most capacity tokens, refilled at a rate of capacity tokens per period.
+    A new bucket is full.
+
+    Args:
+        capacity (float): Maximum amount of tokens. Must be at least 1, as a bucket that can't
+        hold a whole token never lets anything through.
+        period (float): Amount of seconds it takes to refill an empty bucket.
+    Raises:
+        ValueError
+    """
+
+    def __init__(self, capacity, period):
+        if capacity < 1:
+            raise ValueError(INVALID_CAPACITY.format(capacity))
+        self.capacity = capacity
+        self.period = period
+        self.tokens = capacity
+        self.updated = None
+
+    def refill(self, now):
+        """Add the tokens that have been refilled since the last refill.
+
+        Args:
+            now (float): The current time in seconds.
+        """
+        if self.updated is not None:
+            elapsed = max(0, now - self.updated)
+            self.tokens = min(self.capacity,
+                              self.tokens + elapsed * self.capacity / self.period)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Return the amount of seconds until the bucket holds a given amount of tokens.
+
+        Args:
+            amount (float): The amount of tokens.
+        Returns:
+            float: The wait time, which is 0 if there are enough tokens now.
+        """
+        missing = amount - self.tokens
+        return max(0, missing * self.period / self.capacity)
+
+    def take(self, amount):
+        """Remove tokens from the bucket.
+
+        Args:
+            amount (float): The amount of tokens.
+        """
+        self.tokens -= amount
+
+class SendLimiter:
+    """Limiter of the amount of messages per minute and bytes per day that are sent. One
+    limiter can be shared by any amount of coroutines, which are let through in the order that
+    they call :py:meth:`acquire`.
+
+    Args:
+        messages_per_minute (float): Maximum amount of messages per minute, at least 1, or
+        None for no limit.
+        bytes_per_day (int): Maximum amount of bytes per day, or None for no limit.
+        state_path (str): Path to a file to persist the state of the quotas in, to share them
+        with other processes. Defaults to keeping the state in memory only.
+    Raises:
+        ValueError
+    """
+
+    def __init__(self, messages_per_minute=None, bytes_per_day=None, state_path=None):
+        self.buckets = {}
+        if messages_per_minute is not None:
+            self.buckets[MESSAGES_BUCKET] = TokenBucket(messages_per_minute, MESSAGES_PERIOD)
+        if bytes_per_day is not None:
+            self.buckets[BYTES_BUCKET] = TokenBucket(bytes_per_day, BYTES_PERIOD)
+        self.state_path = state_path
+        self._lock = None
+
+    async def acquire(self, size):
+        """Wait until a message of the given size can be sent within the quotas, and count it.
+
+        Args:
+            size (int): Size of the message in bytes.
+        Raises:
+            ValueError
+        """
+        bytes_bucket = self.buckets.get(BYTES_BUCKET)
+        if bytes_bucket and size > bytes_bucket.capacity:
+            raise ValueError(MESSAGE_OVER_QUOTA.format(size, bytes_bucket.capacity))
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                wait = self._try_take({MESSAGES_BUCKET: 1, BYTES_BUCKET: size})
+                if not wait:
+                    return
+                LOGGER.info(WAITING_FOR_QUOTA.format(wait))
+                await asyncio.sleep(wait)
+
+    def _try_take(self, amounts):
+        """Take tokens from all buckets if all of them have enough.
+
+        Args:
+            amounts (dict(str, float)): Amount of tokens to take from each bucket.
+        Returns:
+            float: 0 if the tokens were taken, otherwise the amount of seconds until there are
+            enough tokens.
+        """
+        with self._shared_state():
+            now = time.time()
+            wait = 0
+            for name, bucket in self.buckets.items():
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(amounts[name]))
+            if not wait:
+                for name, bucket in self.buckets.items():
+                    bucket.take(amounts[name])
+            return wait
+
+    @contextlib.contextmanager
+    def _shared_state(self):
+        """Context manager that loads the state of the buckets from the state file on entry,
+        and stores it on exit, with the file locked in between. Does nothing if there is no
+        state file.
+        """
+        if not self.state_path:
+            yield
+            return
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o600)
+        with open(fd, 'r+', encoding='utf-8') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                state = json.loads(file.read() or '{}')
+            except ValueError:
+                state = {}
+            for name, bucket in self.buckets.items():
+                if name in state:
+                    bucket.tokens, bucket.updated = state[name]
+            yield
+            state.update((name, [bucket.tokens, bucket.updated])
+                         for name, bucket in self.buckets.items())
+            file.seek(0)
+            file.truncate()
+            json.dump(state, file)
+            file.flush()
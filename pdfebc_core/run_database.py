@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""This module contains a local SQLite database of compression runs, for following the
+compression ratio and throughput over time and across Ghostscript versions and presets.
+
+A run is recorded by passing its events through :py:meth:`RunDatabase.record`, or by using a
+:py:class:`RunRecorder` as the callback of
+:py:func:`pdfebc_core.compress.compress_multiple_pdfs_with_callback`:
+
+.. code-block:: python
+
+    database = RunDatabase()
+    for event in database.record(compress_multiple_pdfs(src, out, gs), profile="/ebook"):
+        ...
+    database.statistics(group_by=PROFILE)
+
+The duration of a file is the elapsed time carried by its FileDone or Failed event, as measured
+by the producer, so time that the producer spends waiting for a slow consumer is not counted.
+If no Ghostscript version is given, it is probed from the Ghostscript binary when a run starts.
+
+.. module:: run_database
+    :platform: Unix
+    :synopsis: Historical database of compression runs.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import time
+import socket
+import sqlite3
+from collections import namedtuple
+import appdirs
+import subprocess
+import daiquiri
+from . import events
+from .ghostscript import probe_ghostscript
+from .outputs import ensure_directory
+
+DATABASE_FILENAME = "runs.sqlite3"
+DATABASE_PATH = os.path.join(appdirs.user_data_dir('pdfebc'), DATABASE_FILENAME)
+# Amount of file results that are written before they are committed.
+COMMIT_INTERVAL = 100
+DEFAULT_GHOSTSCRIPT_BINARY = "gs"
+
+DONE = "done"
+SKIPPED = "skipped"
+DEDUPLICATED = "deduplicated"
+FAILED = "failed"
+
+PROFILE = "profile"
+GHOSTSCRIPT_VERSION = "ghostscript_version"
+_GROUP_COLUMNS = {None: "NULL", PROFILE: "runs.profile",
+                  GHOSTSCRIPT_VERSION: "runs.ghostscript_version"}
+
+INVALID_GROUP = "Can't group by '{}', must be one of {}"
+RUN_RECORDED = "Recorded run {} with {} files in '{}'"
+VERSION_UNKNOWN = "Could not probe the version of Ghostscript binary '{}': {}"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    finished REAL,
+    source_directory TEXT,
+    output_directory TEXT,
+    profile TEXT,
+    ghostscript_version TEXT,
+    host TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    source_path TEXT NOT NULL,
+    output_path TEXT,
+    status TEXT NOT NULL,
+    input_size INTEGER,
+    output_size INTEGER,
+    duration REAL,
+    finished REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_run_id ON files (run_id);
+CREATE INDEX IF NOT EXISTS files_finished ON files (finished);
+"""
+
+LOGGER = daiquiri.getLogger(__name__)
+
+Run = namedtuple('Run', ['run_id', 'started', 'finished', 'source_directory',
+                         'output_directory', 'profile', 'ghostscript_version', 'host'])
+
+FileRecord = namedtuple('FileRecord', ['run_id', 'source_path', 'output_path', 'status',
+                                       'input_size', 'output_size', 'duration', 'finished'])
+
+Statistics = namedtuple('Statistics', ['key', 'window_start', 'files', 'input_size',
+                                       'output_size', 'ratio', 'duration', 'throughput'])
+
+class RunDatabase:
+    """A database of compression runs, stored in an SQLite file.
+
+    Args:
+        database_path (str): Path to the database file. It is created if it does not exist.
+    """
+
+    def __init__(self, database_path=DATABASE_PATH):
+        self.database_path = database_path
+        if database_path != ":memory:":
+            ensure_directory(os.path.dirname(os.path.abspath(database_path)))
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, run_events, profile=None, ghostscript_version=None,
+               ghostscript_binary=DEFAULT_GHOSTSCRIPT_BINARY):
+        """Record the events of a run while passing them on. This is a generator function that
+        yields each event it is given. The file results that are recorded are written even if
+        the run raises or is not iterated to the end.
+
+        Args:
+            run_events (iterable): Events of a run, e.g. from
+            :py:func:`pdfebc_core.compress.compress_multiple_pdfs`.
+            profile (str): Name of the preset or device profile of the run.
+            ghostscript_version (str): Version of the Ghostscript that the run used. Probed from
+            the Ghostscript binary if not given.
+            ghostscript_binary (str): Name of the Ghostscript binary to probe the version of.
+        """
+        recorder = RunRecorder(self, profile, ghostscript_version, ghostscript_binary)
+        try:
+            for event in run_events:
+                recorder(event)
+                yield event
+        finally:
+            recorder.close()
+
+    def runs(self, since=None, until=None):
+        """Return the recorded runs, oldest first.
+
+        Args:
+            since (float): Only runs started at or after this Unix time.
+            until (float): Only runs started before this Unix time.
+        Returns:
+            list(Run): The runs.
+        """
+        where, parameters = _time_window("started", since, until)
+        rows = self._connection.execute(
+            "SELECT id, started, finished, source_directory, output_directory, profile, "
+            "ghostscript_version, host FROM runs {} ORDER BY started, id".format(where),
+            parameters)
+        return [Run(*row) for row in rows]
+
+    def files(self, run_id):
+        """Return the file results of a run, in the order they finished.
+
+        Args:
+            run_id (int): The id of the run.
+        Returns:
+            list(FileRecord): The file results.
+        """
+        rows = self._connection.execute(
+            "SELECT run_id, source_path, output_path, status, input_size, output_size, "
+            "duration, finished FROM files WHERE run_id = ? ORDER BY rowid", (run_id,))
+        return [FileRecord(*row) for row in rows]
+
+    def statistics(self, group_by=None, window=None, since=None, until=None):
+        """Aggregate the compressed files of the recorded runs. Only files that were
+        compressed count, as skipped, deduplicated and failed files say nothing about the
+        speed or ratio of compression.
+
+        Args:
+            group_by (str): :py:const:`PROFILE` or :py:const:`GHOSTSCRIPT_VERSION` to get one
+            result per profile or version, or None for a single group.
+            window (float): If given, the files are also grouped into time windows of this
+            many seconds, by the time they finished.
+            since (float): Only files finished at or after this Unix time.
+            until (float): Only files finished before this Unix time.
+        Returns:
+            list(Statistics): The statistics of each group, ordered by window and key. The ratio
+            is the output size divided by the input size, and the throughput is input bytes per
+            second of compression.
+        Raises:
+            ValueError
+        """
+        if group_by not in _GROUP_COLUMNS:
+            raise ValueError(INVALID_GROUP.format(group_by, sorted(filter(None,
+                                                                          _GROUP_COLUMNS))))
+        key = _GROUP_COLUMNS[group_by]
+        window_start = "NULL" if window is None else \
+            "CAST(files.finished / :window AS INTEGER) * :window"
+        where, parameters = _time_window("files.finished", since, until)
+        where = "{} files.status = :done".format(where + " AND" if where else "WHERE")
+        parameters.update(done=DONE, window=window)
+        rows = self._connection.execute(
+            "SELECT {key}, {window_start}, COUNT(*), SUM(files.input_size), "
+            "SUM(files.output_size), SUM(files.duration) "
+            "FROM files JOIN runs ON runs.id = files.run_id {where} "
+            "GROUP BY 1, 2 ORDER BY 2, 1".format(key=key, window_start=window_start,
+                                                 where=where),
+            parameters)
+        return [Statistics(key=key, window_start=start, files=files, input_size=input_size,
+                           output_size=output_size,
+                           ratio=output_size / input_size if input_size else None,
+                           duration=duration,
+                           throughput=input_size / duration if duration else None)
+                for key, start, files, input_size, output_size, duration in rows]
+
+    def _start_run(self, started, source_directory, output_directory, profile,
+                   ghostscript_version):
+        cursor = self._connection.execute(
+            "INSERT INTO runs (started, source_directory, output_directory, profile, "
+            "ghostscript_version, host) VALUES (?, ?, ?, ?, ?, ?)",
+            (started, source_directory, output_directory, profile, ghostscript_version,
+             socket.gethostname()))
+        self._connection.commit()
+        return cursor.lastrowid
+
+    def _add_files(self, file_records):
+        self._connection.executemany(
+            "INSERT INTO files (run_id, source_path, output_path, status, input_size, "
+            "output_size, duration, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", file_records)
+        self._connection.commit()
+
+    def _finish_run(self, run_id, finished):
+        self._connection.execute("UPDATE runs SET finished = ? WHERE id = ?",
+                                 (finished, run_id))
+        self._connection.commit()
+
+class RunRecorder:
+    """Callable that records the events of runs in a :py:class:`RunDatabase`. Each Started
+    event begins a new run. File results are written in batches, and the last ones when the
+    run finishes or the recorder is closed. Close the recorder if a run may end without a
+    Finished event, e.g. when it raises.
+
+    Args:
+        database (RunDatabase): The database.
+        profile (str): Name of the preset or device profile of the runs.
+        ghostscript_version (str): Version of the Ghostscript that the runs use. Probed from
+        the Ghostscript binary when the first run starts if not given.
+        ghostscript_binary (str): Name of the Ghostscript binary to probe the version of.
+    """
+
+    def __init__(self, database, profile=None, ghostscript_version=None,
+                 ghostscript_binary=DEFAULT_GHOSTSCRIPT_BINARY):
+        self.database = database
+        self.profile = profile
+        self.ghostscript_version = ghostscript_version
+        self.ghostscript_binary = ghostscript_binary
+        self.run_id = None
+        self._pending = []
+        self._files = 0
+
+    def __call__(self, event):
+        if isinstance(event, events.Started):
+            if self.ghostscript_version is None:
+                self.ghostscript_version = _probe_version(self.ghostscript_binary)
+            self.run_id = self.database._start_run(time.time(), event.source_directory,
+                                                   event.output_directory, self.profile,
+                                                   self.ghostscript_version)
+            self._files = 0
+        elif isinstance(event, (events.FileDone, events.Skipped, events.Deduplicated,
+                                events.Failed)):
+            self._add_file(event)
+        elif isinstance(event, events.Finished):
+            self._flush()
+            self.database._finish_run(self.run_id, time.time())
+            LOGGER.info(RUN_RECORDED.format(self.run_id, self._files,
+                                            self.database.database_path))
+
+    def close(self):
+        """Write the file results that are not written yet."""
+        self._flush()
+
+    def _add_file(self, event):
+        duration = getattr(event, 'elapsed', None)
+        if isinstance(event, events.FileDone):
+            status, output_path = DONE, event.output_path
+            input_size, output_size = event.input_size, event.output_size
+        elif isinstance(event, events.Deduplicated):
+            status, output_path = DEDUPLICATED, event.output_path
+            input_size = output_size = event.saved_bytes
+        elif isinstance(event, events.Skipped):
+            status, output_path = SKIPPED, event.output_path
+            input_size, output_size = _size(event.source_path), _size(event.output_path)
+        else:
+            status, output_path = FAILED, None
+            input_size, output_size = _size(event.source_path), None
+        self._pending.append((self.run_id, event.source_path, output_path, status, input_size,
+                              output_size, duration, time.time()))
+        self._files += 1
+        if len(self._pending) >= COMMIT_INTERVAL:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self.database._add_files(self._pending)
+            self._pending = []
+
+def _time_window(column, since, until):
+    """Build a WHERE clause that limits a column to a time window."""
+    conditions = []
+    parameters = {}
+    if since is not None:
+        conditions.append("{} >= :since".format(column))
+        parameters['since'] = since
+    if until is not None:
+        conditions.append("{} < :until".format(column))
+        parameters['until'] = until
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, parameters
+
+def _probe_version(ghostscript_binary):
+    """Return the version of a Ghostscript binary, or None if it can't be probed."""
+    try:
+        return probe_ghostscript(ghostscript_binary).version
+    except (OSError, subprocess.SubprocessError) as exc:
+        LOGGER.warning(VERSION_UNKNOWN.format(ghostscript_binary, exc))
+        return None
+
+def _size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""This module contains a memory-aware scheduler for compression jobs. Running several
+Ghostscript processes on huge PDF files at the same time can exhaust the memory of the host even
+when there are CPUs to spare, so the scheduler only starts a job when its estimated memory use
+fits in a configured budget, together with the estimates of the jobs that are already running.
+
+Each job runs :py:func:`pdfebc_core.compress.compress_pdf` in a child Python process. When the
+child exits, it is reaped with ``os.wait4``, which gives the peak resident set size of the child
+and the processes it started (e.g. Ghostscript). The measurements are used to correct later
+estimates.
+
+.. module:: scheduling
+    :platform: Unix
+    :synopsis: Memory-aware admission control for compression jobs.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import sys
+import pickle
+import subprocess
+import threading
+import queue
+from collections import namedtuple
+import daiquiri
+from .inspection import inspect_pdf
+from .compress import compress_pdf
+from .priority import apply_worker_priority
+
+# Memory use of a job that does not depend on the input: the Python interpreter and the base
+# memory of Ghostscript.
+BASE_MEMORY_ESTIMATE = 64 * 1024**2
+# Additional memory per byte of input file and per page.
+MEMORY_PER_INPUT_BYTE = 1.0
+MEMORY_PER_PAGE = 512 * 1024
+# Weight of a new measurement when updating the correction factor of the estimates.
+CORRECTION_SMOOTHING = 0.3
+# Fraction of the physical memory used as budget when no budget is given.
+DEFAULT_BUDGET_FRACTION = 0.5
+# ru_maxrss is given in kilobytes on Linux, but in bytes on macOS.
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+JOB_OVER_BUDGET = """Job '{}' is estimated to use {} bytes, which exceeds the memory budget of
+{} bytes. Running it alone."""
+JOB_MEASURED = "Job '{}' was estimated to use {} bytes and peaked at {} bytes"
+
+LOGGER = daiquiri.getLogger(__name__)
+
+JobResult = namedtuple('JobResult', ['job', 'error', 'peak_rss'])
+
+class MemoryBudgetScheduler:
+    """Scheduler that runs compression jobs concurrently while their estimated memory use fits
+    in a budget.
+
+    Jobs are admitted in the order that they are given. A job that does not fit waits until
+    enough running jobs have finished, and jobs after it wait as well, so that a large job is
+    never starved by smaller ones. A job that would exceed the budget on its own is run alone.
+
+    Args:
+        memory_budget (int): Memory budget in bytes. Defaults to half of the physical memory.
+        max_workers (int): Maximum amount of concurrent jobs. Defaults to the amount of CPUs.
+        priority (pdfebc_core.priority.WorkerPriority): Priority of the child processes.
+        load_limit (pdfebc_core.priority.LoadAdaptiveLimit): Limit that lowers the amount of
+        concurrent jobs while the host is loaded.
+    """
+
+    def __init__(self, memory_budget=None, max_workers=None, priority=None, load_limit=None):
+        self.memory_budget = memory_budget or default_memory_budget()
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.priority = priority
+        self.load_limit = load_limit
+        self.correction = 1.0
+        self._lock = threading.Lock()
+
+    def raw_estimate(self, size, page_count):
+        """Estimate the memory use of a job from the uncorrected model.
+
+        Args:
+            size (int): Size of the input file in bytes.
+            page_count (int): Amount of pages of the input file, or None if unknown.
+        Returns:
+            float: The estimate in bytes.
+        """
+        return (BASE_MEMORY_ESTIMATE + size * MEMORY_PER_INPUT_BYTE
+                + (page_count or 0) * MEMORY_PER_PAGE)
+
+    def estimate(self, size, page_count):
+        """Estimate the memory use of a job, corrected by earlier measurements.
+
+        Args:
+            size (int): Size of the input file in bytes.
+            page_count (int): Amount of pages of the input file, or None if unknown.
+        Returns:
+            int: The estimate in bytes.
+        """
+        with self._lock:
+            correction = self.correction
+        return int(self.raw_estimate(size, page_count) * correction)
+
+    def record(self, size, page_count, peak_rss):
+        """Update the correction factor with a measured peak memory use.
+
+        Args:
+            size (int): Size of the input file in bytes.
+            page_count (int): Amount of pages of the input file, or None if unknown.
+            peak_rss (int): Measured peak resident set size in bytes.
+        """
+        ratio = peak_rss / self.raw_estimate(size, page_count)
+        with self._lock:
+            self.correction += CORRECTION_SMOOTHING * (ratio - self.correction)
+
+    def run(self, jobs, ghostscript_binary, engine=None):
+        """Run compression jobs. This is a generator function that yields a JobResult for each
+        job as it finishes.
+
+        Args:
+            jobs (iterable): Jobs with source_path, output_path and size attributes, e.g.
+            :py:class:`pdfebc_core.job_table.CompressionJob`. They are taken from the iterable
+            as they are started.
+            ghostscript_binary (str): Name of the Ghostscript binary.
+            engine (CompressionEngine or FastestEnginePolicy): Engine, or policy for selecting
+            an engine per file. Defaults to Ghostscript with the given binary.
+        """
+        jobs = iter(jobs)
+        # the page count of the next job is found once, when it is taken, as the job may wait
+        # several rounds for room in the budget
+        job, page_count = _take_job(jobs)
+        finished = queue.Queue()
+        running = {}
+        while job is not None or running:
+            max_workers = self.max_workers
+            if self.load_limit is not None:
+                max_workers = min(max_workers, self.load_limit.limit())
+            while job is not None and len(running) < max_workers:
+                estimate = self.estimate(job.size, page_count)
+                in_use = sum(running.values())
+                if running and in_use + estimate > self.memory_budget:
+                    break
+                if estimate > self.memory_budget:
+                    LOGGER.warning(JOB_OVER_BUDGET.format(job.source_path, estimate,
+                                                          self.memory_budget))
+                running[job] = estimate
+                thread = threading.Thread(
+                    target=self._run_job,
+                    args=(job, page_count, estimate, ghostscript_binary, engine, finished),
+                    daemon=True)
+                thread.start()
+                job, page_count = _take_job(jobs)
+            timeout = None if self.load_limit is None else self.load_limit.interval
+            try:
+                result = finished.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            del running[result.job]
+            yield result
+
+    def _run_job(self, job, page_count, estimate, ghostscript_binary, engine, finished):
+        try:
+            error, peak_rss = _run_in_child(job.source_path, job.output_path,
+                                            ghostscript_binary, engine, self.priority)
+        except Exception as exc:
+            error, peak_rss = exc, None
+        if peak_rss:
+            LOGGER.info(JOB_MEASURED.format(job.source_path, estimate, peak_rss))
+            self.record(job.size, page_count, peak_rss)
+        finished.put(JobResult(job=job, error=error, peak_rss=peak_rss))
+
+def default_memory_budget():
+    """Return the default memory budget, a fraction of the physical memory.
+
+    Returns:
+        int: The budget in bytes.
+    """
+    physical_memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    return int(physical_memory * DEFAULT_BUDGET_FRACTION)
+
+def _take_job(jobs):
+    """Take the next job from an iterator, and find its page count.
+
+    Returns:
+        (job, int): The job and its page count, or (None, None) if there are no more jobs.
+    """
+    job = next(jobs, None)
+    if job is None:
+        return None, None
+    return job, _page_count(job.source_path)
+
+def _page_count(filepath):
+    try:
+        inspection = inspect_pdf(filepath)
+    except OSError:
+        return None
+    return inspection.page_count if inspection else None
+
+def _run_in_child(source_path, output_path, ghostscript_binary, engine, priority=None):
+    """Compress a file in a child process and measure the peak memory use of the child and its
+    own children.
+
+    Returns:
+        (Exception, int): The error raised in the child, or None, and the peak resident set
+        size in bytes.
+    """
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        path for path in (package_parent, env.get('PYTHONPATH')) if path)
+    process = subprocess.Popen([sys.executable, '-m', __name__], env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    arguments = pickle.dumps((source_path, output_path, ghostscript_binary, engine, priority))
+    try:
+        process.stdin.write(arguments)
+        process.stdin.close()
+        output = process.stdout.read()
+        process.stdout.close()
+    finally:
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = _exit_code(status)
+    peak_rss = rusage.ru_maxrss * MAXRSS_UNIT
+    try:
+        error = pickle.loads(output)
+    except (pickle.UnpicklingError, EOFError):
+        error = subprocess.CalledProcessError(process.returncode, process.args)
+    return error, peak_rss
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _child_main():
+    """Entry point of the child processes. Reads the arguments to compress_pdf from stdin and
+    writes the raised exception, or None, to stdout.
+    """
+    result_file = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    # keep Ghostscript and anything else from writing into the result
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    source_path, output_path, ghostscript_binary, engine, priority = pickle.load(sys.stdin.buffer)
+    apply_worker_priority(priority)
+    try:
+        compress_pdf(source_path, output_path, ghostscript_binary, engine)
+        error = None
+    except Exception as exc:
+        error = exc
+    with result_file:
+        pickle.dump(error, result_file)
+    sys.exit(0 if error is None else 1)
+
+if __name__ == '__main__':
+    _child_main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""This module contains opt-in tracing of the phases of compressing and sending files, for
+finding out where the time of a slow batch goes.
+
+Tracing is off by default, and a span then costs one global lookup. When it is turned on, each
+span records its name, start time, duration, process and thread. Spans around external
+processes, such as the Ghostscript runs, also record the CPU time and peak memory of the
+children that finished during the span. The spans can be exported in the Chrome trace event
+format, which can be opened in ``chrome://tracing`` or https://ui.perfetto.dev:
+
+.. code-block:: python
+
+    with tracing() as tracer:
+        for event in compress_multiple_pdfs(src, out, gs):
+            ...
+    tracer.export("trace.json")
+
+Spans are only recorded in the process that turned tracing on, so files compressed in the
+worker processes of :py:mod:`pdfebc_core.batch` are not traced. The child resource usage is
+per process, so it includes all children that finished during the span, also those of other
+threads.
+
+.. module:: tracing
+    :platform: Unix
+    :synopsis: Opt-in tracing spans with Chrome trace export.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import json
+import time
+import resource
+import threading
+import contextlib
+import functools
+
+_tracer = None
+
+class Tracer:
+    """Collects spans as Chrome trace events. The times are in microseconds since the tracer
+    was created.
+    """
+
+    def __init__(self):
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self.events = []
+
+    @contextlib.contextmanager
+    def span(self, name, children=False, **args):
+        """Context manager that records a span around its body.
+
+        Args:
+            name (str): Name of the span.
+            children (bool): Whether to record the resource usage of child processes that
+            finished during the span.
+            **args: Arguments to show with the span.
+        """
+        if children:
+            usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            if children:
+                args.update(_children_usage(usage_before,
+                                            resource.getrusage(resource.RUSAGE_CHILDREN)))
+            event = {'name': name, 'ph': 'X', 'ts': (start - self._origin) * 1e6,
+                     'dur': (end - start) * 1e6, 'pid': os.getpid(),
+                     'tid': threading.get_ident(), 'args': args}
+            with self._lock:
+                self.events.append(event)
+
+    def export(self, path):
+        """Write the spans to a file in the Chrome trace event format.
+
+        Args:
+            path (str): Path to the file.
+        """
+        with self._lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(trace, file)
+
+def enable(tracer=None):
+    """Turn tracing on.
+
+    Args:
+        tracer (Tracer): The tracer to record spans with. Defaults to a new one.
+    Returns:
+        Tracer: The tracer.
+    """
+    global _tracer
+    _tracer = tracer or Tracer()
+    return _tracer
+
+def disable():
+    """Turn tracing off.
+
+    Returns:
+        Tracer: The tracer that was in use, or None if tracing was off.
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+@contextlib.contextmanager
+def tracing(tracer=None):
+    """Context manager that turns tracing on for its body.
+
+    Args:
+        tracer (Tracer): The tracer to record spans with. Defaults to a new one.
+    Yields:
+        Tracer: The tracer.
+    """
+    tracer = enable(tracer)
+    try:
+        yield tracer
+    finally:
+        disable()
+
+def span(name, children=False, **args):
+    """Context manager that records a span around its body if tracing is on. See
+    :py:meth:`Tracer.span`.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NO_SPAN
+    return tracer.span(name, children, **args)
+
+def traced(name, children=False):
+    """Decorator that records a span around each call of a function if tracing is on.
+
+    Args:
+        name (str): Name of the span.
+        children (bool): Whether to record the resource usage of child processes.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return function(*args, **kwargs)
+            with tracer.span(name, children):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _children_usage(before, after):
+    """Return the CPU times and peak memory of the children that finished between two
+    RUSAGE_CHILDREN measurements.
+    """
+    usage = {'children_user_time': after.ru_utime - before.ru_utime,
+             'children_system_time': after.ru_stime - before.ru_stime}
+    # ru_maxrss is the peak of the largest child ever, so it only says something about the
+    # span if it grew during it
+    if after.ru_maxrss > before.ru_maxrss:
+        usage['children_max_rss_kb'] = after.ru_maxrss
+    return usage
+
+class _NoSpan:
+    """Context manager that does nothing, used as the span while tracing is off.
+    contextlib.nullcontext would do, but it needs Python 3.7.
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_SPAN = _NoSpan()
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""This module contains a watcher that compresses PDF files as soon as they are dropped in a
+source directory, as an alternative to running the batch functions periodically.
+
+Changes in the source directory are detected with inotify where it is available, and by
+polling the directory otherwise. A changed file is only compressed once it is stable, that is
+when its size and modification time have not changed for a settle time, so files that are
+still being written are left alone. Every change restarts the settle time of the file, which
+also debounces the bursts of events that a single write causes.
+
+Stable files are compressed by a pool of worker processes. At most a bounded amount of files
+are handed to the pool at a time, and the rest wait in the watcher until there is room.
+Optionally, the outputs are mailed with :py:mod:`pdfebc_core.email_utils`. Outputs that finish
+close together are collected into one mail.
+
+.. module:: watch
+    :platform: Unix
+    :synopsis: Watch a directory and compress PDF files as they arrive.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import daiquiri
+from . import events, email_utils
+from .compress import compress_pdf, PDF_EXTENSION, _output_is_complete
+from .config_utils import (DEFAULT_SECTION_KEY, SRC_DEFAULT_DIR_KEY, OUT_DEFAULT_DIR_KEY,
+                           GS_DEFAULT_BINARY_KEY, get_attribute_from_config)
+from .outputs import ensure_directory
+from .engines import GhostscriptEngine
+from .profiles import profile_from_config
+
+# Default amount of seconds that a file must be unchanged before it is compressed.
+SETTLE_TIME = 2.0
+# Default amount of seconds between two scans of the directory when polling.
+POLL_INTERVAL = 1.0
+# Default amount of seconds without new outputs before the collected outputs are mailed.
+MAIL_DELAY = 30.0
+# Maximum amount of files in one mail.
+MAX_FILES_PER_MAIL = 10
+MAIL_SUBJECT = "PDF files from pdfebc"
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_INOTIFY_EVENT = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+WATCHING = "Watching '{}' with {}, compressing into '{}'"
+INOTIFY_UNAVAILABLE = "inotify is not available ({}), polling instead"
+FILE_FAILED = "Failed to compress '{}': {}"
+MAIL_FAILED = "Failed to mail {} files: {}"
+
+LOGGER = daiquiri.getLogger(__name__)
+
+class PollingWatcher:
+    """Detects changed files in a directory by comparing the sizes and modification times of its
+    files between scans.
+
+    Args:
+        directory (str): The directory.
+        interval (float): Amount of seconds between two scans.
+    """
+    name = "polling"
+
+    def __init__(self, directory, interval=POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._last_scan = time.monotonic()
+
+    def changes(self, timeout):
+        """Wait for changes for at most timeout seconds.
+
+        Args:
+            timeout (float): Maximum amount of seconds to wait.
+        Returns:
+            set(str): Names of the files that were created or changed.
+        """
+        time.sleep(max(0, min(timeout, self._last_scan + self.interval - time.monotonic())))
+        if time.monotonic() < self._last_scan + self.interval:
+            return set()
+        snapshot = self._scan()
+        self._last_scan = time.monotonic()
+        changed = {name for name, signature in snapshot.items()
+                   if self._snapshot.get(name) != signature}
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+    def _scan(self):
+        snapshot = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+class InotifyWatcher:
+    """Detects changed files in a directory with Linux's inotify, through ctypes.
+
+    Args:
+        directory (str): The directory.
+    Raises:
+        OSError
+    """
+    name = "inotify"
+
+    def __init__(self, directory):
+        self.directory = directory
+        library = ctypes.util.find_library('c')
+        if library is None:
+            raise OSError(errno.ENOSYS, "libc not found")
+        libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "libc has no inotify")
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, os.strerror(error), directory)
+
+    def changes(self, timeout):
+        """Wait for changes for at most timeout seconds. If the kernel's event queue has
+        overflowed, all files in the directory are reported.
+
+        Args:
+            timeout (float): Maximum amount of seconds to wait.
+        Returns:
+            set(str): Names of the files that were created or changed.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(os.listdir(self.directory))
+                elif name:
+                    changed.add(os.fsdecode(name))
+
+    def close(self):
+        os.close(self._fd)
+
+def create_watcher(directory, poll_interval=POLL_INTERVAL, use_inotify=True):
+    """Create an inotify watcher for a directory, or a polling watcher if inotify is not
+    available.
+
+    Args:
+        directory (str): The directory.
+        poll_interval (float): Amount of seconds between two scans when polling.
+        use_inotify (bool): Whether to try inotify.
+    Returns:
+        InotifyWatcher or PollingWatcher: The watcher.
+    """
+    if use_inotify:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError) as exc:
+            LOGGER.info(INOTIFY_UNAVAILABLE.format(exc))
+    return PollingWatcher(directory, poll_interval)
+
+class StabilityTracker:
+    """Keeps track of changed files until they have been unchanged for a settle time.
+
+    Args:
+        settle_time (float): Amount of seconds a file must be unchanged to be stable.
+    """
+
+    def __init__(self, settle_time=SETTLE_TIME):
+        self.settle_time = settle_time
+        self._candidates = {}
+
+    def __len__(self):
+        return len(self._candidates)
+
+    def touch(self, path, now):
+        """Register a possible change of a file. Restarts the settle time if the file has
+        changed since it was last seen, and forgets the file if it no longer exists.
+
+        Args:
+            path (str): Path to the file.
+            now (float): The current time in seconds.
+        """
+        signature = _signature(path)
+        if signature is None:
+            self._candidates.pop(path, None)
+            return
+        previous = self._candidates.get(path)
+        if previous is None or previous[0] != signature:
+            self._candidates[path] = (signature, now)
+
+    def pop_stable(self, now, limit=None):
+        """Remove and return files that have been unchanged for the settle time. The files are
+        checked again before they are returned, so a change that was not reported still
+        restarts the settle time.
+
+        Args:
+            now (float): The current time in seconds.
+            limit (int): Maximum amount of files to return.
+        Returns:
+            list(str): Paths to the stable files, the ones that settled first first.
+        """
+        stable = []
+        settled = sorted((since, path) for path, (_, since) in self._candidates.items()
+                         if now - since >= self.settle_time)
+        for _, path in settled:
+            if limit is not None and len(stable) >= limit:
+                break
+            signature, since = self._candidates[path]
+            current = _signature(path)
+            if current is None:
+                del self._candidates[path]
+            elif current != signature:
+                self._candidates[path] = (current, now)
+            else:
+                del self._candidates[path]
+                stable.append(path)
+        return stable
+
+    def next_deadline(self):
+        """Return the time at which the first file becomes stable, or None if there are no
+        files.
+        """
+        if not self._candidates:
+            return None
+        return min(since for _, since in self._candidates.values()) + self.settle_time
+
+class _MailBatcher:
+    """Collects outputs and mails them together once no new output has arrived for a delay."""
+
+    def __init__(self, config, delay, max_files):
+        self.config = config
+        self.delay = delay
+        self.max_files = max_files
+        self._filepaths = []
+        self._last_added = None
+
+    def add(self, filepath, now):
+        self._filepaths.append(filepath)
+        self._last_added = now
+
+    def send_if_due(self, now, force=False):
+        if not self._filepaths:
+            return
+        if not force and len(self._filepaths) < self.max_files \
+           and now - self._last_added < self.delay:
+            return
+        filepaths, self._filepaths = self._filepaths, []
+        for start in range(0, len(filepaths), self.max_files):
+            chunk = filepaths[start:start + self.max_files]
+            try:
+                _event_loop().run_until_complete(
+                    email_utils.send_with_attachments(MAIL_SUBJECT, "", chunk, self.config))
+            except Exception as exc:
+                LOGGER.error(MAIL_FAILED.format(len(chunk), exc))
+
+def watch_directory(source_directory, output_directory, ghostscript_binary, stop=None,
+                    callback=None, engine=None, max_workers=None, max_queued=None,
+                    settle_time=SETTLE_TIME, poll_interval=POLL_INTERVAL, use_inotify=True,
+                    mail_config=None, mail_delay=MAIL_DELAY):
+    """Watch a directory and compress PDF files that are added to it or changed, until stopped.
+    PDF files that are in the directory when the watch starts are compressed as well, unless
+    they have complete outputs already.
+
+    Args:
+        source_directory (str): The directory to watch.
+        output_directory (str): The directory to write the outputs to.
+        ghostscript_binary (str): Name of the Ghostscript binary.
+        stop (threading.Event): The watch stops when this is set. Defaults to watching until
+        interrupted.
+        callback (function): Called with a :py:class:`pdfebc_core.events.FileDone`,
+        :py:class:`pdfebc_core.events.Skipped` or :py:class:`pdfebc_core.events.Failed`
+        event for each file.
+        engine (CompressionEngine or FastestEnginePolicy): Engine, or policy for selecting an
+        engine per file. Defaults to Ghostscript with the given binary.
+        max_workers (int): Amount of worker processes. Defaults to the amount of CPUs.
+        max_queued (int): Maximum amount of files handed to the workers at a time. Defaults to
+        twice the amount of workers.
+        settle_time (float): Amount of seconds a file must be unchanged to be compressed.
+        poll_interval (float): Amount of seconds between two scans when polling.
+        use_inotify (bool): Whether to use inotify when it is available.
+        mail_config (defaultdict): If given, the outputs are mailed with the email settings of
+        this config.
+        mail_delay (float): Amount of seconds without new outputs before they are mailed.
+    """
+    stop = stop or threading.Event()
+    max_workers = max_workers or os.cpu_count() or 1
+    max_queued = max_queued or 2 * max_workers
+    ensure_directory(output_directory)
+    watcher = create_watcher(source_directory, poll_interval, use_inotify)
+    LOGGER.info(WATCHING.format(source_directory, watcher.name, output_directory))
+    tracker = StabilityTracker(settle_time)
+    mailer = _MailBatcher(mail_config, mail_delay, MAX_FILES_PER_MAIL) if mail_config else None
+    emit = callback if callable(callback) else lambda event: None
+    in_flight = {}
+    now = time.monotonic()
+    for name in os.listdir(source_directory):
+        if name.endswith(PDF_EXTENSION):
+            tracker.touch(os.path.join(source_directory, name), now - settle_time)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            while not stop.is_set():
+                timeout = _timeout(tracker, poll_interval, in_flight, max_queued)
+                if in_flight:
+                    done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                    timeout = 0
+                    for future in done:
+                        _report(future, in_flight.pop(future), emit, mailer)
+                now = time.monotonic()
+                for name in watcher.changes(timeout):
+                    if name.endswith(PDF_EXTENSION):
+                        tracker.touch(os.path.join(source_directory, name), now)
+                now = time.monotonic()
+                for source_path in tracker.pop_stable(now, max_queued - len(in_flight)):
+                    output_path = os.path.join(output_directory, os.path.basename(source_path))
+                    if _output_is_complete(source_path, output_path):
+                        continue
+                    emit(events.FileStarted(source_path, output_path))
+                    future = executor.submit(compress_pdf, source_path, output_path,
+                                             ghostscript_binary, engine)
+                    in_flight[future] = (source_path, output_path)
+                if mailer:
+                    mailer.send_if_due(now)
+            for future in wait(in_flight).done:
+                _report(future, in_flight.pop(future), emit, mailer)
+    finally:
+        watcher.close()
+        if mailer:
+            mailer.send_if_due(time.monotonic(), force=True)
+
+def watch(config, stop=None, callback=None, mail=False, **kwargs):
+    """Watch the source directory of the DEFAULTS section of a config, and compress PDF files
+    into the output directory of the section as they arrive. If the section selects a device
+    profile, and no engine is given, Ghostscript is tuned to the profile. See
+    :py:func:`watch_directory`.
+
+    Args:
+        config (defaultdict): A defaultdict.
+        stop (threading.Event): The watch stops when this is set.
+        callback (function): Called with an event for each file.
+        mail (bool): Whether to mail the outputs with the email settings of the config.
+        **kwargs: Further arguments to :py:func:`watch_directory`.
+    Raises:
+        ConfigurationError
+    """
+    source_directory = get_attribute_from_config(config, DEFAULT_SECTION_KEY,
+                                                 SRC_DEFAULT_DIR_KEY)
+    output_directory = get_attribute_from_config(config, DEFAULT_SECTION_KEY,
+                                                 OUT_DEFAULT_DIR_KEY)
+    ghostscript_binary = get_attribute_from_config(config, DEFAULT_SECTION_KEY,
+                                                   GS_DEFAULT_BINARY_KEY)
+    profile = profile_from_config(config)
+    if profile is not None and kwargs.get('engine') is None:
+        kwargs['engine'] = GhostscriptEngine(ghostscript_binary, profile)
+    watch_directory(source_directory, output_directory, ghostscript_binary, stop, callback,
+                    mail_config=config if mail else None, **kwargs)
+
+def _timeout(tracker, poll_interval, in_flight, max_queued):
+    """Return how long to wait for changes before the watcher needs to act again."""
+    timeout = poll_interval
+    deadline = tracker.next_deadline()
+    if deadline is not None and len(in_flight) < max_queued:
+        timeout = min(timeout, max(0, deadline - time.monotonic()))
+    return timeout
+
+def _report(future, paths, emit, mailer):
+    """Emit the event for a finished compression, and hand the output to the mailer."""
+    source_path, output_path = paths
+    try:
+        result = future.result()
+    except Exception as exc:
+        LOGGER.error(FILE_FAILED.format(source_path, exc))
+        emit(events.Failed(source_path, exc))
+        return
+    if result.skip_reason:
+        emit(events.Skipped(source_path, output_path, result.skip_reason))
+    else:
+        emit(events.FileDone(source_path, output_path, result.input_size, result.output_size,
+                             result.elapsed))
+    if mailer:
+        mailer.add(output_path, time.monotonic())
+
+def _event_loop():
+    """Return the event loop of the current thread, creating one if the thread has none, as
+    is the case when watching from a thread other than the main thread.
+    """
+    try:
+        return asyncio.get_event_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+def _signature(path):
+    """Return the size and modification time of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
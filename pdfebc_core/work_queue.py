@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""This module contains a coordinator and workers that spread compression jobs over several
+hosts through a queue directory on a shared filesystem.
+
+The queue directory has three subdirectories, and a job is a JSON file that moves between them:
+
+| pending/  Jobs waiting for a worker.
+| leased/   Jobs that a worker is compressing.
+| done/     Result records of finished jobs.
+
+The name of a job file starts with the zero-padded position of the job in the order that it
+was submitted in, and workers lease the pending job that comes first by name. A worker lists
+the pending directory once for a batch of jobs, and keeps the first names of the listing to
+lease from until they run out.
+
+A worker leases a job by renaming it from pending to leased, which only one worker can succeed
+with. The leased file gets a name of its own for each lease, e.g. ``<job id>.<token>.json``, so
+a worker only ever touches its own lease. While compressing, the worker touches the leased file
+at regular intervals. The coordinator moves a leased job back to pending when its file has not
+been touched for the lease timeout, which happens when the worker has died or lost access to
+the queue. The coordinator measures this with its own clock, so the clocks of the hosts need
+not agree.
+
+A worker that finishes a job first claims its lease by renaming the leased file again. The
+claim fails if the lease has expired and the job has been moved back to pending, and the
+worker then leaves the result to the new holder of the job. At most one result record is
+stored per job, and the coordinator removes the records as it collects them.
+
+All files are written to a temporary name and renamed into place, so a reader never sees a
+partially written job or record. Workers can be started with
+``python -m pdfebc_core.work_queue <queue_directory> [ghostscript_binary]``.
+
+.. module:: work_queue
+    :platform: Unix
+    :synopsis: Distributed compression through a shared queue directory.
+
+.. moduleauthor:: Simon Larsén <slarse@kth.se>
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import heapq
+import socket
+import threading
+from collections import namedtuple, deque
+import daiquiri
+from .compress import compress_pdf
+from .outputs import ensure_directory
+from .priority import validate_priority, apply_priority
+
+PENDING_DIRECTORY = "pending"
+LEASED_DIRECTORY = "leased"
+DONE_DIRECTORY = "done"
+JOB_EXTENSION = ".json"
+# Default amount of seconds after which a job whose lease is not renewed is handed out again.
+LEASE_TIMEOUT = 60
+# Default amount of times a job is handed out before it is given up on.
+MAX_ATTEMPTS = 3
+# Default amount of seconds between two looks at the queue directory.
+POLL_INTERVAL = 1.0
+
+# Amount of digits of the order that job ids start with.
+ORDER_WIDTH = 12
+# Amount of pending jobs that a worker keeps the names of, to lease from without listing the
+# pending directory for each job.
+LEASE_BATCH_SIZE = 64
+# Length of the tag that coordinate gives the jobs of a run.
+RUN_TAG_LENGTH = 16
+
+# Suffix of a leased file that its worker has claimed to store the result of the job.
+CLAIMED_SUFFIX = "-claimed"
+LEASE_TOKEN_LENGTH = 16
+
+LEASE_EXPIRED = "Lease of '{}' by worker '{}' expired, handing it out again"
+LEASE_LOST = "Worker '{}' lost the lease of '{}', discarding its result"
+JOB_GIVEN_UP = "Gave up on '{}' after {} attempts"
+WORKER_STARTED = "Worker '{}' taking jobs from '{}'"
+WORKER_JOB_DONE = "Worker '{}' finished '{}'"
+
+LOGGER = daiquiri.getLogger(__name__)
+
+Lease = namedtuple('Lease', ['job_id', 'path', 'job'])
+
+JobRecord = namedtuple('JobRecord', ['job_id', 'source_path', 'output_path', 'worker',
+                                     'attempts', 'input_size', 'output_size', 'skip_reason',
+                                     'error'])
+
+class WorkQueue:
+    """A queue of compression jobs in a directory, shared by a coordinator and its workers.
+
+    Args:
+        queue_directory (str): Path to the queue directory. It is created if it does not
+        exist.
+    """
+
+    def __init__(self, queue_directory):
+        self.queue_directory = queue_directory
+        self.pending_directory = os.path.join(queue_directory, PENDING_DIRECTORY)
+        self.leased_directory = os.path.join(queue_directory, LEASED_DIRECTORY)
+        self.done_directory = os.path.join(queue_directory, DONE_DIRECTORY)
+        for directory in (self.pending_directory, self.leased_directory, self.done_directory):
+            ensure_directory(directory)
+        self._submitted = 0
+        self._candidates = deque()
+
+    def submit(self, source_path, output_path, ghostscript_binary, order=None, tag=None):
+        """Add a job to the queue. Jobs are handed out in the order of their order, and jobs
+        with the same order in the order of their tags.
+
+        Args:
+            source_path (str): Path to the PDF file. Must be reachable from the workers.
+            output_path (str): Output path. Must be reachable from the workers.
+            ghostscript_binary (str): Name of the Ghostscript binary on the workers.
+            order (int): Position of the job in the queue. Defaults to the amount of jobs
+            submitted through this WorkQueue before it.
+            tag (str): Tag to tell jobs with the same order apart. Defaults to a random one.
+        Returns:
+            str: The id of the job.
+        """
+        if order is None:
+            order = self._submitted
+        self._submitted += 1
+        job_id = "{:0{}d}-{}".format(order, ORDER_WIDTH, tag or uuid.uuid4().hex)
+        job = {'source_path': source_path, 'output_path': output_path,
+               'ghostscript_binary': ghostscript_binary, 'attempts': 0, 'worker': None}
+        _write_json(os.path.join(self.pending_directory, job_id + JOB_EXTENSION), job)
+        return job_id
+
+    def lease(self, worker):
+        """Take the first pending job, if there is one. The pending directory is only listed
+        when the names kept from the previous listing run out, so a job that is moved back to
+        pending meanwhile may be handed out after jobs that come later.
+
+        Args:
+            worker (str): Name of the worker taking the job.
+        Returns:
+            Lease: The lease, or None if there are no pending jobs.
+        """
+        while True:
+            if not self._candidates:
+                self._candidates.extend(heapq.nsmallest(LEASE_BATCH_SIZE, (
+                    filename for filename in os.listdir(self.pending_directory)
+                    if filename.endswith(JOB_EXTENSION) and not filename.startswith("."))))
+                if not self._candidates:
+                    return None
+            filename = self._candidates.popleft()
+            job_id = filename[:-len(JOB_EXTENSION)]
+            token = uuid.uuid4().hex[:LEASE_TOKEN_LENGTH]
+            path = os.path.join(self.leased_directory,
+                                "{}.{}{}".format(job_id, token, JOB_EXTENSION))
+            try:
+                os.rename(os.path.join(self.pending_directory, filename), path)
+            except FileNotFoundError:
+                # another worker got it first
+                continue
+            job = _read_json(path)
+            job['attempts'] += 1
+            job['worker'] = worker
+            _write_json(path, job)
+            return Lease(job_id=job_id, path=path, job=job)
+
+    def renew(self, lease):
+        """Renew a lease, so that the job is not handed out again.
+
+        Args:
+            lease (Lease): The lease.
+        Returns:
+            bool: False if the lease has already been taken away.
+        """
+        try:
+            os.utime(lease.path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, lease, result=None, error=None):
+        """Store the result record of a leased job, and end the lease. Nothing is stored if
+        the lease has expired and the job has been handed out again.
+
+        Args:
+            lease (Lease): The lease.
+            result (pdfebc_core.compress.CompressionResult): The result, if the job succeeded.
+            error (Exception): The error, if the job failed.
+        Returns:
+            bool: False if the lease had been taken away.
+        """
+        claimed_path = _claimed_path(lease.path)
+        try:
+            os.rename(lease.path, claimed_path)
+        except FileNotFoundError:
+            LOGGER.warning(LEASE_LOST.format(lease.job['worker'], lease.job['source_path']))
+            return False
+        # the claim counts as a renewal, in case the coordinator is about to expire the lease
+        os.utime(claimed_path)
+        self._finish(lease.job_id, lease.job, result, error)
+        _remove_if_exists(claimed_path)
+        return True
+
+    def leased_jobs(self):
+        """Return the ids and modification times of the leased jobs.
+
+        Returns:
+            dict(str, int): The modification time in nanoseconds of each leased job.
+        """
+        return {job_id: mtime for job_id, (_, mtime) in self._leased_files().items()}
+
+    def requeue(self, job_id, max_attempts=MAX_ATTEMPTS):
+        """Move a leased job back to pending, or finish it as failed if it has been handed out
+        too many times.
+
+        Args:
+            job_id (str): The id of the job.
+            max_attempts (int): Maximum amount of times to hand out the job.
+        """
+        filename = job_id + JOB_EXTENSION
+        leased_file = self._leased_files().get(job_id)
+        if leased_file is None:
+            return
+        path = leased_file[0]
+        try:
+            job = _read_json(path)
+        except FileNotFoundError:
+            return
+        LOGGER.warning(LEASE_EXPIRED.format(job['source_path'], job['worker']))
+        if job['attempts'] >= max_attempts:
+            LOGGER.error(JOB_GIVEN_UP.format(job['source_path'], job['attempts']))
+            claimed_path = _claimed_path(path)
+            try:
+                # claim the lease, so that its worker can't complete it meanwhile
+                os.rename(path, claimed_path)
+            except FileNotFoundError:
+                return
+            self._finish(job_id, job, None, TimeoutError(JOB_GIVEN_UP.format(
+                job['source_path'], job['attempts'])))
+            _remove_if_exists(claimed_path)
+            return
+        try:
+            os.rename(path, os.path.join(self.pending_directory, filename))
+        except FileNotFoundError:
+            pass
+
+    def records(self, seen=()):
+        """Read the result records of finished jobs.
+
+        Args:
+            seen (set(str)): Ids of jobs whose records need not be read.
+        Returns:
+            dict(str, JobRecord): The record of each finished job.
+        """
+        records = {}
+        for filename in os.listdir(self.done_directory):
+            if filename.endswith(JOB_EXTENSION) and \
+                    filename[:-len(JOB_EXTENSION)] not in seen:
+                record = _read_json(os.path.join(self.done_directory, filename))
+                records[record['job_id']] = JobRecord(**record)
+        return records
+
+    def remove_record(self, job_id):
+        """Remove the result record of a job, once it has been collected.
+
+        Args:
+            job_id (str): The id of the job.
+        """
+        _remove_if_exists(os.path.join(self.done_directory, job_id + JOB_EXTENSION))
+
+    def _leased_files(self):
+        """Find the leased files, including claimed ones.
+
+        Returns:
+            dict(str, (str, int)): The path and the modification time in nanoseconds of the
+            leased file of each job.
+        """
+        leased = {}
+        for filename in os.listdir(self.leased_directory):
+            if filename.endswith(JOB_EXTENSION) and not filename.startswith("."):
+                path = os.path.join(self.leased_directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                leased[filename.split(".", 1)[0]] = (path, stat.st_mtime_ns)
+        return leased
+
+    def _finish(self, job_id, job, result, error):
+        record = JobRecord(job_id=job_id, source_path=job['source_path'],
+                           output_path=job['output_path'], worker=job['worker'],
+                           attempts=job['attempts'],
+                           input_size=result.input_size if result else None,
+                           output_size=result.output_size if result else None,
+                           skip_reason=result.skip_reason if result else None,
+                           error=None if error is None else repr(error))
+        _write_json(os.path.join(self.done_directory, job_id + JOB_EXTENSION),
+                    record._asdict(), replace=False)
+
+def coordinate(jobs, queue_directory, ghostscript_binary, lease_timeout=LEASE_TIMEOUT,
+               max_attempts=MAX_ATTEMPTS, poll_interval=POLL_INTERVAL):
+    """Hand out compression jobs to workers through a queue directory, and collect their
+    results. This is a generator function that yields a JobRecord for each job as it finishes.
+    It returns when all jobs are finished.
+
+    The jobs are handed out in the given order, so jobs from
+    :py:func:`pdfebc_core.batch.plan_jobs` are handed out with the largest file first. The
+    jobs are taken from the iterable as they are submitted, e.g. from
+    :py:meth:`pdfebc_core.job_table.JobTable.pending`, and only one byte per job is kept to
+    track which jobs are finished. Records of other runs in the queue are left as they are.
+
+    Args:
+        jobs (iterable): Jobs with source_path and output_path attributes, e.g.
+        :py:class:`pdfebc_core.batch.CompressionJob`.
+        queue_directory (str): Path to the queue directory.
+        ghostscript_binary (str): Name of the Ghostscript binary on the workers.
+        lease_timeout (float): Amount of seconds after which a lease that is not renewed
+        expires.
+        max_attempts (int): Maximum amount of times to hand out a job.
+        poll_interval (float): Amount of seconds between two looks at the queue directory.
+    """
+    queue = WorkQueue(queue_directory)
+    run_tag = uuid.uuid4().hex[:RUN_TAG_LENGTH]
+    # one byte per job, set while the job is not finished
+    unfinished = bytearray()
+    for order, job in enumerate(jobs):
+        queue.submit(job.source_path, job.output_path, ghostscript_binary, order, run_tag)
+        unfinished.append(1)
+    remaining = len(unfinished)
+    last_renewals = {}
+    foreign_records = set()
+    while remaining:
+        records = queue.records(foreign_records)
+        for job_id in sorted(records.keys()):
+            order = _job_order(job_id, run_tag, unfinished)
+            if order is None:
+                # left by another run, e.g. an interrupted one
+                foreign_records.add(job_id)
+                continue
+            unfinished[order] = 0
+            remaining -= 1
+            queue.remove_record(job_id)
+            yield records[job_id]
+        now = time.monotonic()
+        leased = queue.leased_jobs()
+        for job_id, mtime in leased.items():
+            if _job_order(job_id, run_tag, unfinished) is None:
+                continue
+            previous = last_renewals.get(job_id)
+            if previous is None or previous[0] != mtime:
+                last_renewals[job_id] = (mtime, now)
+            elif now - previous[1] > lease_timeout:
+                del last_renewals[job_id]
+                queue.requeue(job_id, max_attempts)
+        for job_id in set(last_renewals) - leased.keys():
+            del last_renewals[job_id]
+        if remaining:
+            time.sleep(poll_interval)
+
+def run_worker(queue_directory, ghostscript_binary=None, worker=None,
+               lease_timeout=LEASE_TIMEOUT, poll_interval=POLL_INTERVAL, stop_when_idle=False,
+               priority=None):
+    """Take jobs from a queue directory and compress them, until stopped.
+
+    Args:
+        queue_directory (str): Path to the queue directory.
+        ghostscript_binary (str): Name of the Ghostscript binary. Defaults to the one given
+        in each job.
+        worker (str): Name of the worker. Defaults to the host name and pid.
+        lease_timeout (float): The lease timeout of the coordinator. Leases are renewed three
+        times per timeout.
+        poll_interval (float): Amount of seconds to wait when there are no pending jobs.
+        stop_when_idle (bool): Whether to return when there are no pending jobs, instead of
+        waiting for more.
+        priority (pdfebc_core.priority.WorkerPriority): Priority to run the worker, and the
+        Ghostscript processes it starts, with.
+    Returns:
+        int: The amount of jobs that the worker finished.
+    Raises:
+        ValueError
+        OSError
+    """
+    if priority is not None:
+        validate_priority(priority)
+        apply_priority(priority)
+    queue = WorkQueue(queue_directory)
+    worker = worker or "{}:{}".format(socket.gethostname(), os.getpid())
+    LOGGER.info(WORKER_STARTED.format(worker, queue_directory))
+    finished = 0
+    while True:
+        lease = queue.lease(worker)
+        if lease is None:
+            if stop_when_idle:
+                return finished
+            time.sleep(poll_interval)
+            continue
+        stop_renewing = threading.Event()
+        renewer = threading.Thread(target=_renew_until_stopped,
+                                   args=(queue, lease, lease_timeout / 3, stop_renewing),
+                                   daemon=True)
+        renewer.start()
+        result = error = None
+        try:
+            result = compress_pdf(lease.job['source_path'], lease.job['output_path'],
+                                  ghostscript_binary or lease.job['ghostscript_binary'])
+        except Exception as exc:
+            error = exc
+        finally:
+            stop_renewing.set()
+            renewer.join()
+        queue.complete(lease, result, error)
+        LOGGER.info(WORKER_JOB_DONE.format(worker, lease.job['source_path']))
+        finished += 1
+
+def _renew_until_stopped(queue, lease, interval, stop):
+    while not stop.wait(interval):
+        if not queue.renew(lease):
+            return
+
+def _write_json(path, content, replace=True):
+    """Write a JSON file atomically. Without replace, an existing file is left as it is."""
+    directory, basename = os.path.split(path)
+    temporary_path = os.path.join(directory, ".{}.{}.tmp".format(basename, uuid.uuid4().hex))
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(content, file)
+    if replace:
+        os.replace(temporary_path, path)
+        return
+    try:
+        os.link(temporary_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temporary_path)
+
+def _job_order(job_id, run_tag, unfinished):
+    """Return the order of an unfinished job of a run, or None if the job is of another run or
+    is finished.
+    """
+    order, _, tag = job_id.partition("-")
+    if tag != run_tag or not order.isdigit() or int(order) >= len(unfinished):
+        return None
+    return int(order) if unfinished[int(order)] else None
+
+def _claimed_path(path):
+    return path[:-len(JOB_EXTENSION)] + CLAIMED_SUFFIX + JOB_EXTENSION
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _read_json(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+def _worker_main():
+    """Entry point of ``python -m pdfebc_core.work_queue``."""
+    if len(sys.argv) not in (2, 3):
+        sys.exit("usage: python -m pdfebc_core.work_queue <queue_directory> "
+                 "[ghostscript_binary]")
+    run_worker(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else None)
+
+if __name__ == '__main__':
+    _worker_main()
@@ -6,3 +6,19 @@ import pdfebc_core.compress
 import pdfebc_core.misc_utils
 import pdfebc_core.email_utils
 import pdfebc_core.config_utils
+import pdfebc_core.engines
+import pdfebc_core.inspection
+import pdfebc_core.batch
+import pdfebc_core.scheduling
+import pdfebc_core.events
+import pdfebc_core.rate_limit
+import pdfebc_core.ghostscript
+import pdfebc_core.outputs
+import pdfebc_core.work_queue
+import pdfebc_core.watch
+import pdfebc_core.run_database
+import pdfebc_core.tracing
+import pdfebc_core.disk_space
+import pdfebc_core.priority
+import pdfebc_core.profiles
+import pdfebc_core.job_table
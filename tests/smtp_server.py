@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Module containing a local SMTP server for testing the email_utils module against.
+
+The server runs in-process and needs no network access. Faults can be injected into the
+commands it handles with a :py:class:`FaultPlan`: latency before each command, temporary
+errors, and dropped connections. The size of messages can be limited, and the server can
+require a login.
+
+Author: Simon Larsén
+"""
+import socket
+import asyncio
+from collections import Counter
+import aiosmtplib
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import SMTP, AuthResult, LoginPassword
+
+TRANSIENT_ERROR = '451 4.3.0 Temporary failure, try again later'
+MESSAGE_TOO_BIG = '552 Error: Too much mail data'
+
+class FaultPlan:
+    """Faults to inject into the commands that an SMTPServer handles. The counts are shared by
+    all connections, so a client that tries again, or reconnects, gets past a fault.
+
+    Args:
+        latency (float or dict(str, float)): Seconds to wait before handling each command, or
+        the seconds per command name, e.g. {'DATA': 0.1}.
+        transient_errors (dict(str, int)): Amount of times to reply to a command with a
+        temporary error before handling it, per command name.
+        drops (dict(str, int)): Amount of times to drop the connection when a command is
+        received, per command name.
+    """
+    def __init__(self, latency=0, transient_errors=None, drops=None):
+        self.latency = latency
+        self.transient_errors = Counter(transient_errors or {})
+        self.drops = Counter(drops or {})
+
+    def delay(self, command):
+        """Return the amount of seconds to wait before handling a command."""
+        if isinstance(self.latency, dict):
+            return self.latency.get(command, 0)
+        return self.latency
+
+    @staticmethod
+    def take(faults, command):
+        """Use up one of the faults of a command. Returns True if there was one."""
+        if faults[command] <= 0:
+            return False
+        faults[command] -= 1
+        return True
+
+class RecordingHandler:
+    """aiosmtpd handler that stores the received messages.
+
+    Args:
+        chunking (bool): Whether to advertise the CHUNKING and PIPELINING extensions.
+        refused (list(str)): Recipient addresses to refuse.
+    """
+    def __init__(self, chunking=False, refused=()):
+        self.chunking = chunking
+        self.refused = set(refused)
+        self.messages = []
+        self.bdat_sizes = []
+        self.commands = Counter()
+        self.connections = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        if self.chunking:
+            responses[-1:-1] = ['250-PIPELINING', '250-CHUNKING']
+        return responses
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refused:
+            return '550 No such user'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((envelope.mail_from, list(envelope.rcpt_tos),
+                              envelope.original_content))
+        return '250 OK'
+
+class ChunkingSMTP(SMTP):
+    """aiosmtpd SMTP protocol with support for the BDAT command of the CHUNKING extension."""
+
+    async def smtp_BDAT(self, arg):
+        if await self.check_helo_needed():
+            return
+        args = arg.split()
+        if not args or not args[0].isdigit() or args[1:] not in ([], ['LAST']):
+            await self.push('501 Syntax: BDAT size [LAST]')
+            return
+        chunk = await self._reader.readexactly(int(args[0]))
+        if not self.envelope.rcpt_tos:
+            await self.push('503 Error: need RCPT command')
+            return
+        size = len(self.envelope.original_content or b'') + len(chunk)
+        if self.data_size_limit and size > self.data_size_limit:
+            self._set_post_data_state()
+            await self.push(MESSAGE_TOO_BIG)
+            return
+        self.event_handler.bdat_sizes.append(len(chunk))
+        self.envelope.original_content = (self.envelope.original_content or b'') + chunk
+        if args[1:] != ['LAST']:
+            await self.push('250 {} octets received'.format(len(chunk)))
+            return
+        self.envelope.content = self.envelope.original_content
+        status = await self._call_handler_hook('DATA')
+        self._set_post_data_state()
+        await self.push(status)
+
+class SMTPServer(Controller):
+    """A local SMTP server running in a separate thread. Use it as a context manager.
+
+    Args:
+        chunking (bool): Whether to support the BDAT command and advertise the CHUNKING and
+        PIPELINING extensions.
+        refused (list(str)): Recipient addresses to refuse.
+        faults (FaultPlan): Faults to inject. Defaults to none.
+        data_size_limit (int): Maximum size of a message in bytes, advertised with the SIZE
+        extension. None for no limit.
+        credentials ((str, str)): User and password to accept a login with. Defaults to
+        accepting any login. The login is allowed without TLS.
+    """
+    def __init__(self, chunking=False, refused=(), faults=None, data_size_limit=None,
+                 credentials=None):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self.faults = faults or FaultPlan()
+        self.credentials = credentials
+        super().__init__(RecordingHandler(chunking, refused), hostname='127.0.0.1', port=port,
+                         data_size_limit=data_size_limit, auth_require_tls=False,
+                         authenticator=self._authenticate)
+
+    def factory(self):
+        smtp_class = ChunkingSMTP if self.handler.chunking else SMTP
+        smtp = smtp_class(self.handler, **self.SMTP_kwargs)
+        self.handler.connections += 1
+        smtp._smtp_methods = {command: self._inject_faults(smtp, command, method)
+                              for command, method in smtp._smtp_methods.items()}
+        return smtp
+
+    def _inject_faults(self, smtp, command, method):
+        async def handle(arg):
+            self.handler.commands[command] += 1
+            await asyncio.sleep(self.faults.delay(command))
+            if FaultPlan.take(self.faults.drops, command):
+                smtp.transport.close()
+                # stop reading what the client has already sent
+                raise ConnectionResetError("Connection dropped by fault plan")
+            elif FaultPlan.take(self.faults.transient_errors, command):
+                if command == 'BDAT':
+                    # the chunk follows the command, and must be read to stay in sync
+                    await smtp._reader.readexactly(int(arg.split()[0]))
+                    smtp._set_post_data_state()
+                await smtp.push(TRANSIENT_ERROR)
+            else:
+                await method(arg)
+        return handle
+
+    def _authenticate(self, server, session, envelope, mechanism, auth_data):
+        accepted = isinstance(auth_data, LoginPassword) and (
+            self.credentials is None or
+            (auth_data.login.decode(), auth_data.password.decode()) == self.credentials)
+        return AuthResult(success=accepted, handled=False)
+
+    def __enter__(self):
+        self.start()
+        # the server is checked with a connection of its own when it starts
+        self.handler.connections = 0
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+class LocalSMTP(aiosmtplib.SMTP):
+    """aiosmtplib client for code that creates its own clients and upgrades them with STARTTLS,
+    such as :py:func:`pdfebc_core.email_utils._connect`. Patch ``aiosmtplib.SMTP`` with it to
+    point such code at an SMTPServer. STARTTLS is skipped, as the local server has no
+    certificate, and the loop argument of older aiosmtplib versions is ignored.
+    """
+    def __init__(self, *args, loop=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    async def starttls(self, *args, **kwargs):
+        return None
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the batch module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import os
+from .context import pdfebc_core
+
+def create_pdf_files(directory, sizes):
+    """Create PDF files of the given sizes in a directory.
+
+    Args:
+        directory (str): Path to the directory.
+        sizes ([int]): Size of each file.
+    Returns:
+        [str]: Paths to the files.
+    """
+    paths = []
+    for index, size in enumerate(sizes):
+        path = os.path.join(directory, 'file{}.pdf'.format(index))
+        with open(path, 'wb') as file:
+            file.write(b'0' * size)
+        paths.append(path)
+    return paths
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory_pairs = []
+        for name in ('a', 'b'):
+            source = os.path.join(self.tmpdir.name, 'src_' + name)
+            output = os.path.join(self.tmpdir.name, 'out_' + name)
+            os.mkdir(source)
+            os.mkdir(output)
+            self.directory_pairs.append((source, output))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_plan_jobs_orders_largest_file_first(self):
+        create_pdf_files(self.directory_pairs[0][0], [10, 300])
+        create_pdf_files(self.directory_pairs[1][0], [200, 20])
+        jobs = pdfebc_core.batch.plan_jobs(self.directory_pairs)
+        self.assertEqual([job.size for job in jobs], [300, 200, 20, 10])
+        self.assertEqual([job.directory_index for job in jobs], [0, 1, 1, 0])
+
+    def test_plan_jobs_with_missing_source_directory(self):
+        os.rmdir(self.directory_pairs[1][0])
+        with self.assertRaises(ValueError):
+            pdfebc_core.batch.plan_jobs(self.directory_pairs)
+
+    def test_compress_directories_reports_progress_and_totals(self):
+        # the files are below the size limit, so they are copied without Ghostscript
+        create_pdf_files(self.directory_pairs[0][0], [10, 30, 20])
+        create_pdf_files(self.directory_pairs[1][0], [40])
+        results = list(pdfebc_core.batch.compress_directories(self.directory_pairs, 'gs',
+                                                              max_workers=2))
+        progress, summary = results[:-1], results[-1]
+        self.assertEqual(len(progress), 4)
+        self.assertFalse(any(record.error for record in progress))
+        directory_a_progress = [record for record in progress
+                                if record.source_directory == self.directory_pairs[0][0]]
+        self.assertEqual(sorted(record.done for record in directory_a_progress), [1, 2, 3])
+        self.assertTrue(all(record.total == 3 for record in directory_a_progress))
+        self.assertEqual(summary.files, 4)
+        self.assertEqual(summary.failed, 0)
+        self.assertEqual(summary.input_bytes, 100)
+        self.assertEqual(summary.output_bytes, 100)
+        for source, output in self.directory_pairs:
+            self.assertEqual(sorted(os.listdir(source)), sorted(os.listdir(output)))
+
+    def test_compress_directories_with_memory_budget(self):
+        create_pdf_files(self.directory_pairs[0][0], [10, 30])
+        create_pdf_files(self.directory_pairs[1][0], [40])
+        results = list(pdfebc_core.batch.compress_directories(
+            self.directory_pairs, 'gs', max_workers=2, memory_budget=1024**3))
+        summary = results[-1]
+        self.assertEqual(summary.files, 3)
+        self.assertEqual(summary.failed, 0)
+        self.assertEqual(summary.output_bytes, 80)
+
+    def test_same_named_files_into_shared_output_directory(self):
+        shared_output = os.path.join(self.tmpdir.name, 'shared', 'out')
+        directory_pairs = [(source, shared_output) for source, _ in self.directory_pairs]
+        create_pdf_files(directory_pairs[0][0], [10])
+        create_pdf_files(directory_pairs[1][0], [20])
+        jobs = pdfebc_core.batch.plan_jobs(directory_pairs)
+        self.assertEqual(len({job.output_path for job in jobs}), 2)
+        self.assertEqual(pdfebc_core.batch.plan_jobs(directory_pairs), jobs)
+        summary = list(pdfebc_core.batch.compress_directories(directory_pairs, 'gs',
+                                                              max_workers=2))[-1]
+        self.assertEqual(summary.failed, 0)
+        self.assertEqual(sorted(os.path.getsize(os.path.join(shared_output, name))
+                                for name in os.listdir(shared_output)), [10, 20])
@@ -6,7 +6,11 @@ Author: Simon Larsén
 import unittest
 import tempfile
 import os
-from unittest.mock import Mock, patch
+import time
+import errno
+import socket
+import subprocess
+from unittest.mock import Mock, patch, DEFAULT, ANY
 from .context import pdfebc_core
 
 PDF_FILE_EXTENSION = '.pdf'
@@ -15,6 +19,23 @@ OTHER_FILE_EXTENSIONS = ['.png', '.bmp', '.txt', '.sh', '.py']
 class ExitTestException(Exception):
     pass
 
+def fake_popen_writing_output(mock_popen):
+    """Make a mocked subprocess.Popen create the file given by Ghostscript's -sOutputFile option
+    or as the last argument, and exit successfully.
+
+    Args:
+        mock_popen (Mock): A mock of subprocess.Popen.
+    """
+    def create_output(args, *rest, **kwargs):
+        output_args = [arg[len("-sOutputFile="):] for arg in args
+                       if arg.startswith("-sOutputFile=")]
+        output_path = output_args[0] if output_args else args[-1]
+        with open(output_path, 'wb') as file:
+            file.write(b"%PDF-1.4\n%%EOF\n")
+        return DEFAULT
+    mock_popen.side_effect = create_output
+    mock_popen.return_value.returncode = 0
+
 def create_temporary_files_with_suffixes(directory, suffixes=[PDF_FILE_EXTENSION],
                                          files_per_suffix=20, delete=False):
     """Create an arbitrary amount of tempfile.NamedTemporaryFile files with given suffixes.
@@ -114,6 +135,7 @@ class CoreTest(unittest.TestCase):
     def test_compress_adequately_sized_pdf(self, mock_popen, mock_logger):
         # change the lower limit for file size, is reset in the setUp method
         pdfebc_core.compress.FILE_SIZE_LOWER_LIMIT = 0
+        fake_popen_writing_output(mock_popen)
         with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
             pdf_file = create_temporary_files_with_suffixes(self.trash_can.name,
                                                             files_per_suffix=1)[0]
@@ -125,8 +147,71 @@ class CoreTest(unittest.TestCase):
             mock_logger.info.assert_any_call(expected_compressing_message)
             mock_logger.info.assert_any_call(expected_done_message)
             mock_popen.assert_called_once()
-            mock_popen_instance = mock_popen([])
+            mock_popen_instance = mock_popen.return_value
             mock_popen_instance.communicate.assert_called_once()
+            self.assertEqual(os.listdir(tmpoutdir), [os.path.basename(output_path)])
+
+    @patch('subprocess.Popen', autospec=True)
+    def test_compress_failing_engine_leaves_no_output(self, mock_popen):
+        # change the lower limit for file size, is reset in the setUp method
+        pdfebc_core.compress.FILE_SIZE_LOWER_LIMIT = 0
+        fake_popen_writing_output(mock_popen)
+        mock_popen.return_value.returncode = 1
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            pdf_file = create_temporary_files_with_suffixes(self.trash_can.name,
+                                                            files_per_suffix=1)[0]
+            pdf_file.close()
+            output_path = os.path.join(tmpoutdir, os.path.basename(pdf_file.name))
+            with self.assertRaises(subprocess.CalledProcessError):
+                pdfebc_core.compress.compress_pdf(pdf_file.name, output_path, self.gs_binary)
+            self.assertFalse(os.listdir(tmpoutdir))
+
+    @patch('pdfebc_core.compress.LOGGER')
+    @patch('pdfebc_core.compress.inspect_pdf')
+    @patch('subprocess.Popen', autospec=True)
+    def test_compress_unpromising_pdf(self, mock_popen, mock_inspect, mock_logger):
+        # change the lower limit for file size, is reset in the setUp method
+        pdfebc_core.compress.FILE_SIZE_LOWER_LIMIT = 0
+        fake_popen_writing_output(mock_popen)
+        mock_inspect.return_value = pdfebc_core.inspection.PdfInspection(
+            file_size=1000, page_count=1, page_size=(612, 792), uses_object_streams=True,
+            image_count=1, image_bytes=900, raw_image_bytes=0, dct_image_bytes=900,
+            flate_image_bytes=0, max_image_dpi=100)
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            pdf_file = create_temporary_files_with_suffixes(self.trash_can.name,
+                                                            files_per_suffix=1)[0]
+            pdf_file.close()
+            output_path = os.path.join(tmpoutdir, os.path.basename(pdf_file.name))
+            pdfebc_core.compress.compress_pdf(pdf_file.name, output_path, self.gs_binary)
+            mock_popen.assert_not_called()
+            with open(pdf_file.name, 'rb') as source, open(output_path, 'rb') as output:
+                self.assertEqual(source.read(), output.read())
+            not_compressing_calls = [call for call in mock_logger.info.call_args_list
+                                     if call[0][0].startswith("Not compressing")]
+            self.assertEqual(len(not_compressing_calls), 1)
+
+    def test_failing_copy_leaves_no_output(self):
+        def copyfile(source_path, output_path):
+            with open(output_path, 'wb') as file:
+                file.write(b"%PDF-1.4\n")
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpsrcdir, \
+                tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            source_path = os.path.join(tmpsrcdir, 'a.pdf')
+            with open(source_path, 'wb') as file:
+                file.write(b"%PDF-1.4\n%%EOF\n")
+            output_path = os.path.join(tmpoutdir, 'a.pdf')
+            with patch('shutil.copyfile', side_effect=copyfile):
+                with self.assertRaises(OSError):
+                    pdfebc_core.compress.compress_pdf(source_path, output_path, self.gs_binary)
+                self.assertEqual(os.listdir(tmpoutdir), [])
+                compress_events = list(pdfebc_core.compress.compress_multiple_pdfs(
+                    tmpsrcdir, tmpoutdir, self.gs_binary))
+            self.assertEqual(os.listdir(tmpoutdir), [])
+        self.assertIsInstance(compress_events[-2], pdfebc_core.events.Failed)
+        self.assertEqual(compress_events[-1].failed, 1)
+        self.assertEqual(compress_events[-1].skipped, 0)
 
     def test_compress_multiple_pdfs_with_missing_source_dir(self):
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -160,8 +245,9 @@ class CoreTest(unittest.TestCase):
                 compress_gen = pdfebc_core.compress.compress_pdf(pdf_file.name, output_path, self.gs_binary)
                 status_msgs = [stat for stat in compress_gen]
 
+    @patch('pdfebc_core.compress.check_ghostscript', autospec=True)
     @patch('pdfebc_core.compress.compress_pdf', autospec=True)
-    def test_compress_multiple_valid_pdfs(self, mock_compress):
+    def test_compress_multiple_valid_pdfs(self, mock_compress, mock_check):
         # change the lower limit for file size, is reset in the setUp method
         pdfebc_core.compress.FILE_SIZE_LOWER_LIMIT = 0
         with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
@@ -174,10 +260,149 @@ class CoreTest(unittest.TestCase):
                 output_path = os.path.join(tmpoutdir, os.path.basename(file.name))
                 output_paths.append(output_path)
             compress_gen = pdfebc_core.compress.compress_multiple_pdfs(self.trash_can.name, tmpoutdir,
-                                                                       self.gs_binary)
+                                                                       self.gs_binary,
+                                                                       deduplicate=False)
             status_msgs = [status for status in compress_gen]
             for source_path, output_path in zip(source_paths, output_paths):
-                mock_compress.assert_any_call(source_path, output_path, self.gs_binary)
+                mock_compress.assert_any_call(source_path, output_path, self.gs_binary, None, ANY)
+            mock_check.assert_called_once_with(self.gs_binary)
+
+    def test_compress_multiple_pdfs_checks_ghostscript_before_starting(self):
+        # change the lower limit for file size, is reset in the setUp method
+        pdfebc_core.compress.FILE_SIZE_LOWER_LIMIT = 0
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            create_temporary_files_with_suffixes(self.trash_can.name, files_per_suffix=2)
+            received = []
+            with patch('pdfebc_core.compress.compress_pdf') as mock_compress:
+                with self.assertRaises(FileNotFoundError):
+                    pdfebc_core.compress.compress_multiple_pdfs_with_callback(
+                        self.trash_can.name, tmpoutdir, 'not-ghostscript', received.append)
+            self.assertFalse(mock_compress.called)
+            self.assertFalse(received)
+
+    @patch('pdfebc_core.compress.compress_pdf', autospec=True)
+    def test_compress_multiple_pdfs_resume_skips_complete_outputs(self, mock_compress):
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            pdf_files = create_temporary_files_with_suffixes(self.trash_can.name,
+                                                             files_per_suffix=2)
+            for file in pdf_files:
+                file.close()
+            done_source, incomplete_source = (file.name for file in pdf_files)
+            done_output = os.path.join(tmpoutdir, os.path.basename(done_source))
+            incomplete_output = os.path.join(tmpoutdir, os.path.basename(incomplete_source))
+            with open(done_output, 'wb') as file:
+                file.write(b"%PDF-1.4\n%%EOF\n")
+            with open(incomplete_output, 'wb') as file:
+                file.write(b"%PDF-1.4\n")
+            compress_gen = pdfebc_core.compress.compress_multiple_pdfs(
+                self.trash_can.name, tmpoutdir, self.gs_binary, resume=True, deduplicate=False)
+            mock_compress.return_value = pdfebc_core.compress.CompressionResult(
+                incomplete_source, incomplete_output, 0, 0, None, 2.5)
+            compress_events = list(compress_gen)
+            skipped = [event for event in compress_events
+                       if isinstance(event, pdfebc_core.events.Skipped)]
+            done = [event for event in compress_events
+                    if isinstance(event, pdfebc_core.events.FileDone)]
+            self.assertEqual([event.output_path for event in skipped], [done_output])
+            self.assertEqual([(event.output_path, event.elapsed) for event in done],
+                             [(incomplete_output, 2.5)])
+            mock_compress.assert_called_once_with(incomplete_source, incomplete_output,
+                                                  self.gs_binary, None, ANY)
+
+    def test_compress_multiple_pdfs_resume_removes_stale_temporary_outputs(self):
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            live_temporary = pdfebc_core.compress._temporary_output_path(
+                os.path.join(tmpoutdir, 'live.pdf'))
+            # pid 2**22 + 1 is above the Linux pid limit, so it can't be a running process
+            stale_temporary = os.path.join(tmpoutdir, '.stale.pdf.{}-0@{}{}'.format(
+                2**22 + 1, socket.gethostname(), pdfebc_core.compress.TEMPORARY_OUTPUT_SUFFIX))
+            for path in (live_temporary, stale_temporary):
+                open(path, 'w').close()
+            with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpsrcdir:
+                list(pdfebc_core.compress.compress_multiple_pdfs(tmpsrcdir, tmpoutdir,
+                                                                 self.gs_binary, resume=True))
+            self.assertEqual(os.listdir(tmpoutdir), [os.path.basename(live_temporary)])
+
+    def test_resume_judges_temporary_outputs_of_other_hosts_by_age(self):
+        suffix = pdfebc_core.compress.TEMPORARY_OUTPUT_SUFFIX
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            # the pid of this process is running here, but says nothing about the other host
+            recent, old, legacy = (os.path.join(tmpoutdir, name.format(os.getpid(), suffix))
+                                   for name in ('.recent.pdf.{}-0@other-host{}',
+                                                '.old.pdf.{}-0@other-host{}',
+                                                '.legacy.pdf.{}-0{}'))
+            for path in (recent, old, legacy):
+                open(path, 'w').close()
+            long_ago = time.time() - pdfebc_core.compress.STALE_TEMPORARY_OUTPUT_AGE - 60
+            for path in (old, legacy):
+                os.utime(path, (long_ago, long_ago))
+            pdfebc_core.compress._remove_stale_temporary_outputs(tmpoutdir)
+            self.assertEqual(os.listdir(tmpoutdir), [os.path.basename(recent)])
+
+    def test_compress_multiple_pdfs_event_sequence(self):
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            pdf_files = create_temporary_files_with_suffixes(self.trash_can.name,
+                                                             files_per_suffix=3)
+            for file in pdf_files:
+                file.close()
+            compress_events = list(pdfebc_core.compress.compress_multiple_pdfs(
+                self.trash_can.name, tmpoutdir, self.gs_binary, deduplicate=False))
+        event_types = [type(event) for event in compress_events]
+        self.assertEqual(event_types[0], pdfebc_core.events.Started)
+        self.assertEqual(compress_events[0].total, 3)
+        self.assertEqual(event_types[-1], pdfebc_core.events.Finished)
+        # the files are empty, so they are below the size limit and are skipped
+        self.assertEqual(event_types.count(pdfebc_core.events.FileStarted), 3)
+        self.assertEqual(event_types.count(pdfebc_core.events.Skipped), 3)
+        self.assertEqual(compress_events[-1].skipped, 3)
+
+    def test_compress_multiple_pdfs_deduplicates_identical_files(self):
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            contents = [b"%PDF-1.4 a", b"%PDF-1.4 b", b"%PDF-1.4 a", b"%PDF-1.4 a"]
+            source_paths = []
+            for index, content in enumerate(contents):
+                source_path = os.path.join(self.trash_can.name, '{}.pdf'.format(index))
+                with open(source_path, 'wb') as file:
+                    file.write(content)
+                source_paths.append(source_path)
+            with patch('pdfebc_core.compress.compress_pdf',
+                       wraps=pdfebc_core.compress.compress_pdf) as mock_compress:
+                compress_events = list(pdfebc_core.compress.compress_multiple_pdfs(
+                    self.trash_can.name, tmpoutdir, self.gs_binary))
+            self.assertEqual(mock_compress.call_count, 2)
+            for source_path, content in zip(source_paths, contents):
+                with open(os.path.join(tmpoutdir, os.path.basename(source_path)), 'rb') as file:
+                    self.assertEqual(file.read(), content)
+        deduplicated = [event for event in compress_events
+                        if isinstance(event, pdfebc_core.events.Deduplicated)]
+        self.assertEqual(len(deduplicated), 2)
+        finished = compress_events[-1]
+        self.assertEqual(finished.deduplicated, 2)
+        self.assertEqual(finished.saved_bytes, 2 * len(contents[0]))
+
+    def test_compress_multiple_pdfs_with_callback_reports_failures(self):
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            pdf_file = create_temporary_files_with_suffixes(self.trash_can.name,
+                                                            files_per_suffix=1)[0]
+            pdf_file.close()
+            # a directory in place of the output can't be replaced by the output file
+            os.mkdir(os.path.join(tmpoutdir, os.path.basename(pdf_file.name)))
+            received = []
+            pdfebc_core.compress.compress_multiple_pdfs_with_callback(
+                self.trash_can.name, tmpoutdir, self.gs_binary, received.append)
+        failed = [event for event in received if isinstance(event, pdfebc_core.events.Failed)]
+        self.assertEqual([event.source_path for event in failed], [pdf_file.name])
+        self.assertEqual(received[-1].failed, 1)
+
+    def test_compress_multiple_pdfs_creates_output_directory(self):
+        with tempfile.TemporaryDirectory(dir=self.trash_can.name) as tmpoutdir:
+            pdf_file = create_temporary_files_with_suffixes(self.trash_can.name,
+                                                            files_per_suffix=1)[0]
+            pdf_file.close()
+            output_directory = os.path.join(tmpoutdir, 'nested', 'out')
+            list(pdfebc_core.compress.compress_multiple_pdfs(self.trash_can.name,
+                                                             output_directory, self.gs_binary))
+            self.assertEqual(os.listdir(output_directory), [os.path.basename(pdf_file.name)])
 
     def assert_filepaths_match_file_names(self, filepaths, temporary_files):
         """Assert that a list of filepaths match a list of temporary files.
@@ -114,6 +114,24 @@ class ConfigUtilsTest(UtilsTestABC):
         self.temp_config_file.close()
         self.assertFalse(pdfebc_core.config_utils.valid_config_exists(self.temp_config_file.name))
 
+    def test_valid_config_exists_with_device_profiles(self):
+        config = configparser.ConfigParser()
+        config.read_dict(self.valid_config)
+        defaults = config[pdfebc_core.config_utils.DEFAULT_SECTION_KEY]
+        defaults['profile'] = 'kobo'
+        defaults['profile.kobo'] = 'resolution=300, grayscale=yes'
+        config.write(self.temp_config_file)
+        self.temp_config_file.close()
+        self.assertTrue(pdfebc_core.config_utils.valid_config_exists(self.temp_config_file.name))
+
+    def test_valid_config_exists_with_unknown_option(self):
+        config = configparser.ConfigParser()
+        config.read_dict(self.valid_config)
+        config[pdfebc_core.config_utils.DEFAULT_SECTION_KEY]['resolution'] = '300'
+        config.write(self.temp_config_file)
+        self.temp_config_file.close()
+        self.assertFalse(pdfebc_core.config_utils.valid_config_exists(self.temp_config_file.name))
+
     def test_run_config_diagnostics_valid_config(self):
         self.valid_config.write(self.temp_config_file)
         self.temp_config_file.close()
@@ -182,3 +200,69 @@ class ConfigUtilsTest(UtilsTestABC):
         with self.assertRaises(pdfebc_core.config_utils.ConfigurationError):
             pdfebc_core.config_utils.get_attribute_from_config(config_dict, self.email_section_key,
                                                   non_existing_section)
+
+    def test_validate_config_returns_config_and_diagnostics(self):
+        config = configparser.ConfigParser()
+        config.read_dict(self.valid_config)
+        config[self.default_section_key]['resolution'] = '300'
+        config[self.email_section_key][self.receiver_key] = ''
+        config.write(self.temp_config_file)
+        self.temp_config_file.close()
+        with patch('configparser.ConfigParser.read', autospec=True,
+                   side_effect=configparser.ConfigParser.read) as read:
+            diagnostics = pdfebc_core.config_utils.validate_config(self.temp_config_file.name)
+        self.assertEqual(read.call_count, 1)
+        self.assertFalse(diagnostics.valid)
+        self.assertEqual(diagnostics.config[self.default_section_key]['resolution'], '300')
+        self.assertEqual(diagnostics.unknown_entries, {self.default_section_key: {'resolution'}})
+        self.assertEqual(diagnostics.malformed_entries, {self.email_section_key: {self.receiver_key}})
+        self.assertFalse(diagnostics.missing_sections)
+        self.assertIsNone(diagnostics.error)
+
+    def test_validate_config_reports_profile_errors(self):
+        config = configparser.ConfigParser()
+        config.read_dict(self.valid_config)
+        defaults = config[self.default_section_key]
+        defaults['profile.kindle'] = 'resolution=300, max_size=1264x1680'
+        defaults['profile.broken'] = 'resolution=high'
+        defaults['profile'] = 'kobo'
+        config.write(self.temp_config_file)
+        self.temp_config_file.close()
+        diagnostics = pdfebc_core.config_utils.validate_config(self.temp_config_file.name)
+        self.assertFalse(diagnostics.valid)
+        self.assertEqual(set(diagnostics.profile_errors), {'broken', 'kobo'})
+        self.assertTrue(all(isinstance(error, pdfebc_core.config_utils.ConfigurationError)
+                            for error in diagnostics.profile_errors.values()))
+        self.assertFalse(diagnostics.unknown_entries)
+
+    def test_validate_config_with_well_formed_profiles(self):
+        config = configparser.ConfigParser()
+        config.read_dict(self.valid_config)
+        config[self.default_section_key]['profile.kindle'] = 'resolution=300'
+        config[self.default_section_key]['profile'] = 'kindle'
+        config.write(self.temp_config_file)
+        self.temp_config_file.close()
+        diagnostics = pdfebc_core.config_utils.validate_config(self.temp_config_file.name)
+        self.assertTrue(diagnostics.valid)
+        self.assertEqual(diagnostics.profile_errors, {})
+
+    def test_validate_config_directory(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, config in (('valid.cnf', self.valid_config),
+                                 ('invalid.cnf', self.invalid_config)):
+                with open(os.path.join(tmpdir, name), 'w') as file:
+                    config.write(file)
+            with open(os.path.join(tmpdir, 'broken.cnf'), 'w') as file:
+                file.write("user = nobody\n")
+            with open(os.path.join(tmpdir, 'notes.txt'), 'w') as file:
+                file.write("not a config")
+            results = pdfebc_core.config_utils.validate_config_directory(tmpdir, max_workers=2)
+        self.assertEqual([os.path.basename(path) for path in results],
+                         ['broken.cnf', 'invalid.cnf', 'valid.cnf'])
+        broken, invalid, valid = results.values()
+        self.assertIsInstance(broken.error, configparser.MissingSectionHeaderError)
+        self.assertIsNone(broken.config)
+        self.assertEqual(invalid.missing_sections, {self.default_section_key})
+        self.assertTrue(valid.valid)
+        with self.assertRaises(ValueError):
+            pdfebc_core.config_utils.validate_config_directory(os.path.join(tmpdir, 'gone'))
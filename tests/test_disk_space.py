@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the disk_space module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import errno
+import os
+import subprocess
+from unittest.mock import patch
+from .context import pdfebc_core
+
+disk_space = pdfebc_core.disk_space
+events = pdfebc_core.events
+
+class DiskSpaceGuardTest(unittest.TestCase):
+    def test_free_space_of_real_directory(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertGreater(disk_space.free_space(tmpdir), 0)
+
+    def test_estimate_output_size(self):
+        self.assertEqual(disk_space.estimate_output_size(100, 0.5, 1000), 100)
+        self.assertEqual(disk_space.estimate_output_size(3001, 0.5, 1000), 1501)
+
+    def test_check_raises_below_watermark(self):
+        guard = disk_space.DiskSpaceGuard(low_watermark=100)
+        with patch('pdfebc_core.disk_space.free_space', return_value=1000):
+            guard.check('out', 900)
+            with self.assertRaises(disk_space.DiskSpaceError) as context:
+                guard.check('out', 901)
+        self.assertEqual(context.exception.errno, errno.ENOSPC)
+        self.assertTrue(disk_space.is_out_of_space(context.exception))
+
+    def test_wait_for_room_resumes_when_space_is_freed(self):
+        guard = disk_space.DiskSpaceGuard(low_watermark=100, poll_interval=0.01, max_wait=5)
+        with patch('pdfebc_core.disk_space.free_space', side_effect=[50, 50, 50, 500, 500]):
+            self.assertTrue(guard.wait_for_room('out', 10))
+
+    def test_wait_for_room_gives_up(self):
+        guard = disk_space.DiskSpaceGuard(low_watermark=100, poll_interval=0.01, max_wait=0.05)
+        with patch('pdfebc_core.disk_space.free_space', return_value=50):
+            self.assertFalse(guard.wait_for_room('out', 10))
+
+class SpaceGuardedBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source_directory = os.path.join(self.tmpdir.name, 'src')
+        self.output_directory = os.path.join(self.tmpdir.name, 'out')
+        os.mkdir(self.source_directory)
+        # the files are below the size limit, so they are copied without Ghostscript, and
+        # each output needs 105 bytes
+        for name in ('a.pdf', 'b.pdf', 'c.pdf'):
+            with open(os.path.join(self.source_directory, name), 'wb') as file:
+                file.write(name.encode() * 20 + b'%%EOF')
+        self.guard = disk_space.DiskSpaceGuard(low_watermark=1000, poll_interval=0.01,
+                                               max_wait=0.05)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def compress(self, resume=False):
+        return list(pdfebc_core.compress.compress_multiple_pdfs(
+            self.source_directory, self.output_directory, 'gs', resume=resume,
+            space_guard=self.guard))
+
+    def test_preflight_refuses_batch_that_does_not_fit(self):
+        with patch('pdfebc_core.disk_space.free_space', return_value=1300):
+            with self.assertRaises(disk_space.DiskSpaceError):
+                self.compress()
+        self.assertEqual(os.listdir(self.output_directory), [])
+
+    def test_batch_stops_cleanly_and_resumes(self):
+        # room for the batch at first, but the space runs out after the first file
+        free = iter([1400, 1400])
+        with patch('pdfebc_core.disk_space.free_space',
+                   side_effect=lambda directory: next(free, 0)):
+            compression_events = self.compress()
+        stopped, = [event for event in compression_events if isinstance(event, events.Stopped)]
+        self.assertEqual(stopped.remaining, 2)
+        self.assertIsInstance(compression_events[-1], events.Finished)
+        self.assertEqual(len(os.listdir(self.output_directory)), 1)
+        with patch('pdfebc_core.disk_space.free_space', return_value=10**6):
+            compression_events = self.compress(resume=True)
+        self.assertFalse(any(isinstance(event, events.Stopped) for event in compression_events))
+        self.assertEqual(sorted(os.listdir(self.output_directory)), ['a.pdf', 'b.pdf', 'c.pdf'])
+
+    def test_full_volume_stops_batch_without_guard(self):
+        def copyfile(filepath, output_path):
+            with open(output_path, 'wb') as file:
+                file.write(b'%PDF')
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        with patch('shutil.copyfile', side_effect=copyfile):
+            compression_events = list(pdfebc_core.compress.compress_multiple_pdfs(
+                self.source_directory, self.output_directory, 'gs'))
+        failed = [event for event in compression_events if isinstance(event, events.Failed)]
+        stopped, = [event for event in compression_events if isinstance(event, events.Stopped)]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(stopped.remaining, 2)
+        self.assertEqual(os.listdir(self.output_directory), [])
+
+    def test_failing_engine_on_full_volume_stops_batch(self):
+        # the engine really fails, with an exit status instead of an ENOSPC error, and the
+        # free space is found below the watermark afterwards
+        free = iter([10**6, 10**6])
+        with patch('pdfebc_core.compress.FILE_SIZE_LOWER_LIMIT', 0), \
+                patch('pdfebc_core.disk_space.free_space',
+                      side_effect=lambda directory: next(free, 0)):
+            compression_events = list(pdfebc_core.compress.compress_multiple_pdfs(
+                self.source_directory, self.output_directory, 'gs',
+                engine=pdfebc_core.engines.QpdfEngine('false'), space_guard=self.guard))
+        failed, = [event for event in compression_events if isinstance(event, events.Failed)]
+        self.assertIsInstance(failed.error, subprocess.CalledProcessError)
+        stopped, = [event for event in compression_events if isinstance(event, events.Stopped)]
+        self.assertEqual(stopped.remaining, 2)
+        self.assertEqual(os.listdir(self.output_directory), [])
+
+    def test_failing_engine_with_room_does_not_stop_batch(self):
+        with patch('pdfebc_core.compress.FILE_SIZE_LOWER_LIMIT', 0), \
+                patch('pdfebc_core.disk_space.free_space', return_value=10**6):
+            compression_events = list(pdfebc_core.compress.compress_multiple_pdfs(
+                self.source_directory, self.output_directory, 'gs',
+                engine=pdfebc_core.engines.QpdfEngine('false'), space_guard=self.guard))
+        self.assertFalse(any(isinstance(event, events.Stopped) for event in compression_events))
+        self.assertEqual(compression_events[-1].failed, 3)
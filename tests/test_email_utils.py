@@ -4,12 +4,19 @@
 Author: Simon Larsén
 """
 import os
+import time
 import email
+import tempfile
 import asyncio
+import unittest
+import aiosmtplib
 import asynctest
 from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 from unittest.mock import patch, Mock
+from collections import Counter
 from .utils_test_abc import UtilsTestABC
+from .smtp_server import SMTPServer, FaultPlan, LocalSMTP
 from .context import pdfebc_core
 
 class EmailUtilsTest(UtilsTestABC):
@@ -20,6 +27,7 @@ class EmailUtilsTest(UtilsTestABC):
         mock_smtp_instance.login = asynctest.CoroutineMock()
         mock_smtp_instance.quit = asynctest.CoroutineMock()
         mock_smtp_instance.send_message = asynctest.CoroutineMock()
+        mock_smtp_instance.supports_extension = Mock(return_value=False)
         return mock_smtp_instance
 
     def test_attach_valid_files(self):
@@ -85,3 +93,371 @@ class EmailUtilsTest(UtilsTestABC):
         mock_smtp_instance.login.assert_called_once_with(self.user, self.password)
         mock_smtp_instance.send_message.assert_called_once()
         mock_smtp_instance.quit.assert_called_once()
+
+    def write_attachment_contents(self, contents):
+        for filename, content in zip(self.attachment_filenames, contents):
+            with open(filename, 'wb') as file:
+                file.write(content)
+
+    def test_deduplicate_attachments_note_policy(self):
+        self.write_attachment_contents([b'a', b'b', b'a'])
+        filepaths = self.attachment_filenames[:3]
+        unique, notes = pdfebc_core.email_utils._deduplicate_attachments(
+            filepaths, pdfebc_core.email_utils.DUPLICATES_NOTE)
+        self.assertEqual(unique, filepaths[:2])
+        self.assertEqual(len(notes), 1)
+        self.assertIn(os.path.basename(filepaths[2]), notes[0])
+
+    def test_deduplicate_attachments_first_policy_with_repeated_path(self):
+        self.write_attachment_contents([b'a', b'b'])
+        filepaths = self.attachment_filenames[:2] + self.attachment_filenames[:1]
+        unique, notes = pdfebc_core.email_utils._deduplicate_attachments(
+            filepaths, pdfebc_core.email_utils.DUPLICATES_FIRST)
+        self.assertEqual(unique, self.attachment_filenames[:2])
+        self.assertFalse(notes)
+
+    def test_deduplicate_attachments_keep_policy(self):
+        unique, notes = pdfebc_core.email_utils._deduplicate_attachments(
+            self.attachment_filenames, pdfebc_core.email_utils.DUPLICATES_KEEP)
+        self.assertEqual(unique, self.attachment_filenames)
+        self.assertFalse(notes)
+
+    def test_deduplicate_attachments_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            pdfebc_core.email_utils._deduplicate_attachments(self.attachment_filenames, 'drop')
+
+    def test_mapped_attachment_encodes_lazily(self):
+        content = os.urandom(10000)
+        self.write_attachment_contents([content])
+        part = pdfebc_core.email_utils.MappedAttachment(self.attachment_filenames[0],
+                                                        Name='test.pdf')
+        self.assertIsNone(part._encoded)
+        email_ = MIMEMultipart()
+        email_.attach(part)
+        parsed = email.message_from_bytes(email_.as_bytes())
+        attachment, = [part for part in parsed.walk()
+                       if part.get_content_maintype() == 'application']
+        self.assertEqual(attachment.get_payload(decode=True), content)
+        self.assertIsNone(part._mapped)
+
+    def test_mapped_attachment_of_empty_file(self):
+        part = pdfebc_core.email_utils.MappedAttachment(self.attachment_filenames[0])
+        self.assertEqual(part.get_payload(decode=True), b'')
+
+    def test_attach_files_concurrently_preserves_order(self):
+        contents = [os.urandom(1000 + index) for index in range(3)]
+        self.write_attachment_contents(contents)
+        email_ = MIMEMultipart()
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(pdfebc_core.email_utils._attach_files_concurrently(
+            self.attachment_filenames[:3], email_))
+        payloads = [part.get_payload(decode=True)
+                    for part in email.message_from_bytes(email_.as_bytes()).walk()
+                    if part.get_content_maintype() == 'application']
+        self.assertEqual(payloads, contents)
+
+    def test_attach_files_concurrently_attaches_valid_files(self):
+        email_ = MIMEMultipart()
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(pdfebc_core.email_utils._attach_files_concurrently(
+            self.attachment_filenames, email_, loop=loop))
+        loop.close()
+        part_dispositions = [part.get('Content-Disposition')
+                             for part in email.message_from_bytes(email_.as_bytes()).walk()
+                             if part.get_content_maintype() == 'application']
+        self.assertEqual(len(part_dispositions), len(self.attachment_filenames))
+        for filename_base in map(os.path.basename, self.attachment_filenames):
+            self.assertTrue(
+                any(map(lambda disp: filename_base in disp, part_dispositions)))
+
+    def test_attach_files_concurrently_encodes_in_executor(self):
+        email_ = MIMEMultipart()
+        executor = Mock()
+        loop = asyncio.new_event_loop()
+        with patch.object(loop, 'run_in_executor',
+                          side_effect=lambda executor, func, *args:
+                          asyncio.ensure_future(_as_coroutine(func(*args)), loop=loop)) \
+                as mock_run_in_executor:
+            loop.run_until_complete(pdfebc_core.email_utils._attach_files_concurrently(
+                self.attachment_filenames, email_, executor=executor, loop=loop))
+        loop.close()
+        self.assertEqual(mock_run_in_executor.call_count, len(self.attachment_filenames))
+        for call in mock_run_in_executor.call_args_list:
+            self.assertIs(call[0][0], executor)
+        for part in email_.get_payload():
+            self.assertIsNotNone(part._encoded)
+
+async def _as_coroutine(value):
+    return value
+
+class DeliverTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.email_ = MIMEMultipart()
+        self.email_['From'] = 'sender@localhost'
+        self.email_['To'] = 'receiver@localhost'
+        self.email_['Subject'] = 'Test e-mail'
+        # a line starting with a dot must survive both DATA and BDAT
+        self.email_.attach(MIMEText('first line\n.second line\n' + ('x' * 70 + '\n') * 100))
+
+    def tearDown(self):
+        self.loop.close()
+
+    def deliver(self, smtp_server, chunk_size):
+        async def deliver():
+            server = aiosmtplib.SMTP(hostname=smtp_server.hostname, port=smtp_server.port)
+            await server.connect()
+            await server.ehlo()
+            await pdfebc_core.email_utils._deliver(server, self.email_, chunk_size)
+            await server.quit()
+        self.loop.run_until_complete(deliver())
+
+    def assert_message_received(self, smtp_server):
+        (sender, recipients, content), = smtp_server.handler.messages
+        self.assertEqual(sender, 'sender@localhost')
+        self.assertEqual(recipients, ['receiver@localhost'])
+        received = email.message_from_bytes(content)
+        self.assertEqual(received.get_payload(0).get_payload().replace('\r\n', '\n'),
+                         self.email_.get_payload(0).get_payload())
+
+    def test_deliver_with_bdat_when_chunking_is_supported(self):
+        with SMTPServer(chunking=True) as smtp_server:
+            self.deliver(smtp_server, chunk_size=2048)
+        self.assert_message_received(smtp_server)
+        sizes = smtp_server.handler.bdat_sizes
+        self.assertGreater(len(sizes), 1)
+        self.assertTrue(all(size == 2048 for size in sizes[:-1]))
+        self.assertEqual(sum(sizes), len(smtp_server.handler.messages[0][2]))
+
+    def test_deliver_with_data_when_chunking_is_not_supported(self):
+        with SMTPServer(chunking=False) as smtp_server:
+            self.deliver(smtp_server, chunk_size=2048)
+        self.assert_message_received(smtp_server)
+        self.assertFalse(smtp_server.handler.bdat_sizes)
+
+    def test_deliver_with_bdat_takes_envelope_from_headers(self):
+        del self.email_['From']
+        self.email_['From'] = 'first@localhost, second@localhost'
+        self.email_['Bcc'] = 'hidden@localhost'
+        with SMTPServer(chunking=True) as smtp_server:
+            self.deliver(smtp_server, chunk_size=2048)
+        (sender, recipients, content), = smtp_server.handler.messages
+        self.assertEqual(sender, 'first@localhost')
+        self.assertEqual(recipients, ['receiver@localhost', 'hidden@localhost'])
+        self.assertNotIn(b'hidden@localhost', content)
+
+    def test_envelope_prefers_sender_header(self):
+        self.email_['Sender'] = 'secretary@localhost'
+        self.assertEqual(pdfebc_core.email_utils._envelope(self.email_),
+                         ('secretary@localhost', ['receiver@localhost']))
+
+    def test_envelope_without_sender_raises(self):
+        del self.email_['From']
+        with self.assertRaises(ValueError):
+            pdfebc_core.email_utils._envelope(self.email_)
+
+    def test_deliver_with_data_when_raw_data_can_not_be_sent(self):
+        with SMTPServer(chunking=True) as smtp_server, \
+             patch('pdfebc_core.email_utils._can_send_raw', return_value=False):
+            self.deliver(smtp_server, chunk_size=2048)
+        self.assert_message_received(smtp_server)
+        self.assertFalse(smtp_server.handler.bdat_sizes)
+
+class SendBulkTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filepaths = []
+        for index in range(2):
+            filepath = os.path.join(self.tmpdir.name, 'file{}.pdf'.format(index))
+            with open(filepath, 'wb') as file:
+                file.write(os.urandom(5000))
+            self.filepaths.append(filepath)
+        self.config = {pdfebc_core.config_utils.EMAIL_SECTION_KEY: {
+            pdfebc_core.config_utils.USER_KEY: 'sender@localhost'}}
+        self.connections = 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def send_bulk(self, smtp_server, recipients, **kwargs):
+        async def connect(config, loop=None):
+            self.connections += 1
+            server = aiosmtplib.SMTP(hostname=smtp_server.hostname, port=smtp_server.port)
+            await server.connect()
+            await server.ehlo()
+            return server
+        with patch('pdfebc_core.email_utils._connect', side_effect=connect):
+            return self.loop.run_until_complete(pdfebc_core.email_utils.send_bulk(
+                recipients, self.filepaths, self.config, **kwargs))
+
+    def test_send_bulk_personalizes_messages_over_pooled_connections(self):
+        recipients = [pdfebc_core.email_utils.Recipient(
+            'reader{}@localhost'.format(index), 'Subject {}'.format(index),
+            'Hello reader {}'.format(index)) for index in range(6)]
+        with SMTPServer(chunking=True) as smtp_server:
+            results = self.send_bulk(smtp_server, recipients, connections=2)
+        self.assertEqual([result.address for result in results],
+                         [recipient.address for recipient in recipients])
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertEqual(self.connections, 2)
+        received = {}
+        for _, (address,), content in smtp_server.handler.messages:
+            received[address] = email.message_from_bytes(content)
+        for recipient in recipients:
+            message = received[recipient.address]
+            self.assertEqual(message['Subject'], recipient.subject)
+            text, *attachments = message.get_payload()
+            self.assertEqual(text.get_payload(), recipient.message)
+            self.assertEqual(len(attachments), 2)
+        attachment_bodies = Counter(part.get_payload() for message in received.values()
+                                    for part in message.get_payload()[1:])
+        self.assertEqual(set(attachment_bodies.values()), {6})
+
+    def test_send_bulk_reports_refused_recipient_and_continues(self):
+        recipients = [pdfebc_core.email_utils.Recipient(address, 'Subject', 'Message')
+                      for address in ('a@localhost', 'refused@localhost', 'b@localhost')]
+        with SMTPServer(refused=['refused@localhost']) as smtp_server:
+            results = self.send_bulk(smtp_server, recipients, connections=1)
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, aiosmtplib.SMTPException)
+        self.assertIsNone(results[2].error)
+        self.assertEqual(self.connections, 1)
+        self.assertEqual(len(smtp_server.handler.messages), 2)
+
+    def test_send_bulk_limits_rate(self):
+        recipients = [pdfebc_core.email_utils.Recipient('{}@localhost'.format(index), 'S', 'M')
+                      for index in range(3)]
+        with SMTPServer() as smtp_server:
+            start = time.monotonic()
+            results = self.send_bulk(smtp_server, recipients, connections=3, rate=10)
+            elapsed = time.monotonic() - start
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertGreaterEqual(elapsed, 0.2)
+
+class LocalServerTest(unittest.TestCase):
+    """End-to-end tests against a local SMTP server, from composing the email to logging in and
+    sending it, that run without network access.
+    """
+    FILE_SIZE = 1024**2
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filepaths = []
+        self.contents = []
+        for index in range(4):
+            filepath = os.path.join(self.tmpdir.name, 'file{}.pdf'.format(index))
+            content = os.urandom(self.FILE_SIZE)
+            with open(filepath, 'wb') as file:
+                file.write(content)
+            self.filepaths.append(filepath)
+            self.contents.append(content)
+        self.credentials = ('sender@localhost', 'secret')
+        smtp_patcher = patch('aiosmtplib.SMTP', LocalSMTP)
+        smtp_patcher.start()
+        self.addCleanup(smtp_patcher.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def email_section(self, smtp_server):
+        config_utils = pdfebc_core.config_utils
+        return {config_utils.USER_KEY: self.credentials[0],
+                config_utils.PASSWORD_KEY: self.credentials[1],
+                config_utils.RECEIVER_KEY: 'receiver@localhost',
+                config_utils.SMTP_SERVER_KEY: smtp_server.hostname,
+                config_utils.SMTP_PORT_KEY: str(smtp_server.port)}
+
+    def send_with_attachments(self, smtp_server, filepaths=None):
+        config = {pdfebc_core.config_utils.EMAIL_SECTION_KEY: self.email_section(smtp_server)}
+        start = time.monotonic()
+        self.loop.run_until_complete(pdfebc_core.email_utils.send_with_attachments(
+            'Subject', 'Message', filepaths or self.filepaths, config))
+        return time.monotonic() - start
+
+    def assert_attachments_received(self, content):
+        attachments = [part.get_payload(decode=True)
+                       for part in email.message_from_bytes(content).walk()
+                       if part.get_content_maintype() == 'application']
+        self.assertEqual(attachments, self.contents)
+
+    def test_send_with_attachments_throughput(self):
+        for chunking in (True, False):
+            with SMTPServer(chunking=chunking, credentials=self.credentials) as smtp_server:
+                elapsed = self.send_with_attachments(smtp_server)
+            (sender, recipients, content), = smtp_server.handler.messages
+            self.assertEqual((sender, recipients), ('sender@localhost', ['receiver@localhost']))
+            self.assert_attachments_received(content)
+            self.assertEqual(bool(smtp_server.handler.bdat_sizes), chunking)
+            # a few MB over loopback should take well below a second on any machine
+            self.assertLess(elapsed, 10, msg="chunking={}".format(chunking))
+
+    def test_send_with_attachments_keeps_duplicates_by_default(self):
+        with open(self.filepaths[1], 'wb') as file:
+            file.write(self.contents[0])
+        self.contents[1] = self.contents[0]
+        with SMTPServer(credentials=self.credentials) as smtp_server:
+            self.send_with_attachments(smtp_server)
+        (_, _, content), = smtp_server.handler.messages
+        self.assert_attachments_received(content)
+
+    def test_command_latency_adds_to_send_time(self):
+        faults = FaultPlan(latency={'MAIL': 0.2, 'RCPT': 0.2})
+        with SMTPServer(faults=faults) as smtp_server:
+            elapsed = self.send_with_attachments(smtp_server, self.filepaths[:1])
+        self.assertEqual(len(smtp_server.handler.messages), 1)
+        self.assertGreaterEqual(elapsed, 0.4)
+
+    def test_send_files_preconf(self):
+        config_path = os.path.join(self.tmpdir.name, 'pdfebc', 'config.cnf')
+        with SMTPServer(chunking=True, credentials=self.credentials) as smtp_server:
+            config_utils = pdfebc_core.config_utils
+            config = config_utils.create_config(
+                [config_utils.EMAIL_SECTION_KEY], [self.email_section(smtp_server)])
+            config_utils.write_config(config, config_path)
+            self.loop.run_until_complete(
+                pdfebc_core.email_utils.send_files_preconf(self.filepaths, config_path))
+        (_, _, content), = smtp_server.handler.messages
+        self.assertEqual(email.message_from_bytes(content)['Subject'], "PDF files from pdfebc")
+        self.assert_attachments_received(content)
+
+    def test_wrong_password_is_refused(self):
+        with SMTPServer(credentials=(self.credentials[0], 'other')) as smtp_server:
+            with self.assertRaises(aiosmtplib.SMTPAuthenticationError):
+                self.send_with_attachments(smtp_server)
+        self.assertFalse(smtp_server.handler.messages)
+
+    def test_transient_error_fails_send_and_retry_succeeds(self):
+        for chunking in (True, False):
+            faults = FaultPlan(transient_errors={'MAIL': 1})
+            with SMTPServer(chunking=chunking, faults=faults) as smtp_server:
+                with self.assertRaises(aiosmtplib.SMTPException):
+                    self.send_with_attachments(smtp_server)
+                self.send_with_attachments(smtp_server)
+            self.assertEqual(len(smtp_server.handler.messages), 1)
+            self.assertEqual(smtp_server.handler.connections, 2)
+
+    def test_message_over_size_limit_is_refused(self):
+        for chunking in (True, False):
+            with SMTPServer(chunking=chunking, data_size_limit=self.FILE_SIZE) as smtp_server:
+                with self.assertRaises(aiosmtplib.SMTPException):
+                    self.send_with_attachments(smtp_server, self.filepaths[:1])
+            self.assertFalse(smtp_server.handler.messages, msg="chunking={}".format(chunking))
+
+    def test_send_bulk_replaces_dropped_connection(self):
+        config = {pdfebc_core.config_utils.EMAIL_SECTION_KEY: None}
+        recipients = [pdfebc_core.email_utils.Recipient('{}@localhost'.format(index), 'S', 'M')
+                      for index in range(3)]
+        with SMTPServer(chunking=True, faults=FaultPlan(drops={'BDAT': 1})) as smtp_server:
+            config[pdfebc_core.config_utils.EMAIL_SECTION_KEY] = self.email_section(smtp_server)
+            results = self.loop.run_until_complete(pdfebc_core.email_utils.send_bulk(
+                recipients, self.filepaths[:1], config, connections=1))
+        self.assertIsInstance(results[0].error, (aiosmtplib.SMTPException, OSError))
+        self.assertEqual([result.error for result in results[1:]], [None, None])
+        self.assertEqual(smtp_server.handler.connections, 2)
+        self.assertEqual(len(smtp_server.handler.messages), 2)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the engines module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import os
+from unittest.mock import patch
+from .context import pdfebc_core
+
+class FakeEngine(pdfebc_core.engines.CompressionEngine):
+    def __init__(self, name, relative_speed, ratio, available=True):
+        self.name = name
+        self.relative_speed = relative_speed
+        self.default_ratio = ratio
+        self.available = available
+
+    def is_available(self):
+        return self.available
+
+    def expected_ratio(self, inspection):
+        return self.default_ratio
+
+class EnginesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pdf_path = os.path.join(self.tmpdir.name, 'test.pdf')
+        with open(self.pdf_path, 'wb') as file:
+            file.write(b'%PDF-1.4\n' + b'0' * 4096 + b'\ntrailer\n<< /Size 1 >>\n%%EOF\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_policy_picks_fastest_engine_reaching_target(self):
+        slow = FakeEngine('slow', 1.0, 0.3)
+        medium = FakeEngine('medium', 5.0, 0.7)
+        fast = FakeEngine('fast', 10.0, 0.95)
+        policy = pdfebc_core.engines.FastestEnginePolicy(0.8, engines=[slow, fast, medium])
+        self.assertIs(policy.select(self.pdf_path), medium)
+
+    def test_policy_skips_unavailable_engines(self):
+        slow = FakeEngine('slow', 1.0, 0.3)
+        fast = FakeEngine('fast', 10.0, 0.3, available=False)
+        policy = pdfebc_core.engines.FastestEnginePolicy(0.8, engines=[slow, fast])
+        self.assertIs(policy.select(self.pdf_path), slow)
+
+    def test_policy_uses_fallback_when_no_engine_reaches_target(self):
+        fallback = FakeEngine('fallback', 1.0, 0.5)
+        fast = FakeEngine('fast', 10.0, 0.9)
+        policy = pdfebc_core.engines.FastestEnginePolicy(0.5, engines=[fast], fallback=fallback)
+        self.assertIs(policy.select(self.pdf_path), fallback)
+
+    def test_policy_default_fallback_uses_given_ghostscript_binary(self):
+        fast = FakeEngine('fast', 10.0, 0.9)
+        policy = pdfebc_core.engines.FastestEnginePolicy(0.5, engines=[fast])
+        engine = pdfebc_core.engines.resolve_engine(policy, self.pdf_path, '/opt/gs/bin/gs')
+        self.assertIsInstance(engine, pdfebc_core.engines.GhostscriptEngine)
+        self.assertEqual(engine.binary, '/opt/gs/bin/gs')
+
+    def test_policy_given_fallback_is_kept_with_ghostscript_binary(self):
+        fallback = FakeEngine('fallback', 1.0, 0.5)
+        policy = pdfebc_core.engines.FastestEnginePolicy(0.5, engines=[], fallback=fallback)
+        self.assertIs(pdfebc_core.engines.resolve_engine(policy, self.pdf_path, 'gs9'),
+                      fallback)
+
+    def test_policy_with_invalid_target_ratio(self):
+        with self.assertRaises(ValueError):
+            pdfebc_core.engines.FastestEnginePolicy(0)
+
+    def test_engine_expected_ratio_without_inspection(self):
+        engine = pdfebc_core.engines.QpdfEngine()
+        self.assertEqual(engine.expected_ratio(None), engine.default_ratio)
+
+    def test_lossless_engine_expects_smaller_gain_than_ghostscript(self):
+        inspection = pdfebc_core.inspection.inspect_pdf(self.pdf_path)
+        lossless = pdfebc_core.engines.QpdfEngine().expected_ratio(inspection)
+        lossy = pdfebc_core.engines.GhostscriptEngine().expected_ratio(inspection)
+        self.assertGreaterEqual(lossless, lossy)
+
+    def test_resolve_engine_defaults_to_ghostscript(self):
+        engine = pdfebc_core.engines.resolve_engine(None, self.pdf_path, 'gs-test')
+        self.assertIsInstance(engine, pdfebc_core.engines.GhostscriptEngine)
+        self.assertEqual(engine.binary, 'gs-test')
+
+    @patch('subprocess.Popen', side_effect=FileNotFoundError(), autospec=True)
+    def test_subprocess_engine_binary_not_found(self, mock_popen):
+        engine = pdfebc_core.engines.MutoolEngine('not-mutool')
+        with self.assertRaises(FileNotFoundError) as context:
+            engine.compress(self.pdf_path, os.path.join(self.tmpdir.name, 'out.pdf'))
+        self.assertIn('not-mutool', str(context.exception))
+
+    def test_ghostscript_engine_reports_page_progress(self):
+        fake_gs = os.path.join(self.tmpdir.name, 'fake_gs')
+        with open(fake_gs, 'w') as file:
+            file.write('#!/bin/sh\n'
+                       'for arg in "$@"; do\n'
+                       '  case "$arg" in -sOutputFile=*) out="${arg#-sOutputFile=}";; esac\n'
+                       'done\n'
+                       'echo "GPL Ghostscript"\n'
+                       'echo "Processing pages 1 through 3."\n'
+                       'for page in 1 2 3; do echo "Page $page"; done\n'
+                       'echo "%PDF-1.4" > "$out"\n')
+        os.chmod(fake_gs, 0o755)
+        progress = []
+        engine = pdfebc_core.engines.GhostscriptEngine(fake_gs)
+        output_path = os.path.join(self.tmpdir.name, 'out.pdf')
+        engine.compress(self.pdf_path, output_path,
+                        progress=lambda page, pages: progress.append((page, pages)))
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+        self.assertTrue(os.path.isfile(output_path))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the events module.
+
+Author: Simon Larsén
+"""
+import unittest
+import asyncio
+import threading
+from .context import pdfebc_core
+
+events = pdfebc_core.events
+
+def producer_of(produced_events, error=None):
+    def producer(emit):
+        for event in produced_events:
+            emit(event)
+        if error:
+            raise error
+    return producer
+
+class EventsTest(unittest.TestCase):
+    def test_throttle_drops_progress_within_interval(self):
+        emitted = []
+        throttle = events.ProgressThrottle(emitted.append, interval=10)
+        for page in range(1, 6):
+            throttle(events.FileProgress('a.pdf', page, 5))
+        self.assertEqual([event.page for event in emitted], [1, 5])
+
+    def test_throttle_is_per_file(self):
+        emitted = []
+        throttle = events.ProgressThrottle(emitted.append, interval=10)
+        throttle(events.FileProgress('a.pdf', 1, 5))
+        throttle(events.FileProgress('b.pdf', 1, 5))
+        self.assertEqual(len(emitted), 2)
+
+    def test_throttle_lets_other_events_through(self):
+        emitted = []
+        throttle = events.ProgressThrottle(emitted.append, interval=10)
+        produced = [events.FileStarted('a.pdf', 'out.pdf'),
+                    events.FileDone('a.pdf', 'out.pdf', 2, 1),
+                    events.Finished('out', 1, 0, 0, 0, 0)]
+        for event in produced:
+            throttle(event)
+        self.assertEqual(emitted, produced)
+
+    def test_iterate_yields_events_in_order(self):
+        produced = [events.Started('src', 'out', 0), events.Finished('out', 0, 0, 0, 0, 0)]
+        self.assertEqual(list(events.iterate(producer_of(produced))), produced)
+
+    def test_iterate_reraises_producer_error(self):
+        produced = [events.Started('src', 'out', 0)]
+        iterator = events.iterate(producer_of(produced, ValueError("test")))
+        self.assertEqual(next(iterator), produced[0])
+        with self.assertRaises(ValueError):
+            next(iterator)
+
+    def test_iterate_stops_producer_when_closed_early(self):
+        produced = []
+        threads = []
+
+        def producer(emit):
+            threads.append(threading.current_thread())
+            for index in range(events.MAX_QUEUED_EVENTS * 4):
+                emit(events.Started('src', 'out', index))
+                produced.append(index)
+
+        iterator = events.iterate(producer)
+        next(iterator)
+        iterator.close()
+        producer_thread, = threads
+        self.assertFalse(producer_thread.is_alive())
+        # the producer stopped at an event, instead of blocking on the full queue
+        self.assertLess(len(produced), events.MAX_QUEUED_EVENTS * 4)
+
+    def test_aiterate_yields_events_in_order(self):
+        produced = [events.Started('src', 'out', 0), events.Finished('out', 0, 0, 0, 0, 0)]
+
+        async def consume():
+            return [event async for event in events.aiterate(producer_of(produced))]
+
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(consume()), produced)
+        finally:
+            loop.close()
+
+    def test_with_callback_ignores_uncallable_callback(self):
+        events.with_callback(producer_of([events.Started('src', 'out', 0)]), None)
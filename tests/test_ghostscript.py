@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the ghostscript module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import os
+from .context import pdfebc_core
+
+FAKE_GS = """#!/bin/sh
+echo "$1" >> "{calls}"
+case "$1" in
+  --version) echo "{version}";;
+  -h) printf 'GPL Ghostscript {version}\\nUsage: gs [switches] [file1.ps file2.ps ...]\\n'
+      printf 'Available devices:\\n   alc1900 bmp16 pdfwrite\\n   png16m txtwrite\\n'
+      printf 'Search path:\\n   /usr/share/ghostscript\\n';;
+esac
+"""
+
+class GhostscriptTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.calls_path = os.path.join(self.tmpdir.name, 'calls')
+        self.gs_path = os.path.join(self.tmpdir.name, 'fake-gs')
+        self.write_fake_gs('9.50')
+        pdfebc_core.ghostscript.clear_cache()
+
+    def tearDown(self):
+        pdfebc_core.ghostscript.clear_cache()
+        self.tmpdir.cleanup()
+
+    def write_fake_gs(self, version):
+        with open(self.gs_path, 'w') as file:
+            file.write(FAKE_GS.format(calls=self.calls_path, version=version))
+        os.chmod(self.gs_path, 0o755)
+
+    def probe_calls(self):
+        if not os.path.isfile(self.calls_path):
+            return 0
+        with open(self.calls_path) as file:
+            return len(file.readlines())
+
+    def test_probe_reports_version_and_devices(self):
+        info = pdfebc_core.ghostscript.probe_ghostscript(self.gs_path)
+        self.assertEqual(info.path, self.gs_path)
+        self.assertEqual(info.version, '9.50')
+        self.assertEqual(info.devices, {'alc1900', 'bmp16', 'pdfwrite', 'png16m', 'txtwrite'})
+
+    def test_probe_is_cached_until_binary_changes(self):
+        pdfebc_core.ghostscript.probe_ghostscript(self.gs_path)
+        pdfebc_core.ghostscript.probe_ghostscript(self.gs_path)
+        self.assertEqual(self.probe_calls(), 2)
+        self.write_fake_gs('10.0')
+        stat = os.stat(self.gs_path)
+        os.utime(self.gs_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        info = pdfebc_core.ghostscript.probe_ghostscript(self.gs_path)
+        self.assertEqual(info.version, '10.0')
+        self.assertEqual(self.probe_calls(), 4)
+
+    def test_probe_missing_binary(self):
+        with self.assertRaises(FileNotFoundError):
+            pdfebc_core.ghostscript.probe_ghostscript(
+                os.path.join(self.tmpdir.name, 'not-gs'))
+
+    def test_check_missing_device(self):
+        with self.assertRaises(ValueError):
+            pdfebc_core.ghostscript.check_ghostscript(self.gs_path, 'x11')
+
+    def test_resolve_binary_searches_path_once(self):
+        old_path = os.environ['PATH']
+        os.environ['PATH'] = self.tmpdir.name
+        try:
+            path = pdfebc_core.ghostscript.resolve_binary('fake-gs')
+        finally:
+            os.environ['PATH'] = old_path
+        self.assertEqual(path, self.gs_path)
+        # the cached path is used even though the directory is no longer on PATH
+        self.assertEqual(pdfebc_core.ghostscript.resolve_binary('fake-gs'), self.gs_path)
+
+    def test_ghostscript_engine_launches_resolved_path(self):
+        pdfebc_core.ghostscript.resolve_binary(self.gs_path)
+        engine = pdfebc_core.engines.GhostscriptEngine(self.gs_path)
+        self.assertEqual(engine.command('in.pdf', 'out.pdf')[0], self.gs_path)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the inspection module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import os
+import zlib
+from .context import pdfebc_core
+
+IMAGE_DATA_SIZE = 300000
+
+def build_pdf(image_dicts, use_xref_stream=False, media_box=b"[0 0 612 792]"):
+    """Build a minimal PDF with one page and the given image XObjects.
+
+    Args:
+        image_dicts ([bytes]): Image dictionary entries (without << >>, /Type, /Subtype and
+        /Length), one per image. Each image gets IMAGE_DATA_SIZE bytes of data.
+        use_xref_stream (bool): Whether to use a compressed xref stream with a PNG predictor
+        instead of a classic xref table.
+        media_box (bytes): The MediaBox of the page.
+    Returns:
+        bytes: The PDF.
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+               b"<< /Type /Page /Parent 2 0 R /MediaBox " + media_box + b" >>"]
+    for image_dict in image_dicts:
+        objects.append(b"<< /Type /XObject /Subtype /Image " + image_dict
+                       + b" /Length %d >>\nstream\n" % IMAGE_DATA_SIZE
+                       + bytes(IMAGE_DATA_SIZE) + b"\nendstream")
+    data = bytearray(b"%PDF-1.5\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref_position = len(data)
+    size = len(objects) + 1
+    if use_xref_stream:
+        rows = [bytes([0, 0, 0, 0])] + [bytes([1]) + offset.to_bytes(3, 'big')
+                                        for offset in offsets]
+        rows.append(bytes([1]) + xref_position.to_bytes(3, 'big'))
+        previous = bytes(4)
+        encoded = bytearray()
+        for row in rows:
+            encoded += bytes([2]) + bytes((a - b) & 0xff for a, b in zip(row, previous))
+            previous = row
+        stream = zlib.compress(bytes(encoded))
+        data += (b"%d 0 obj\n<< /Type /XRef /Size %d /W [1 3 0] /Filter /FlateDecode "
+                 b"/DecodeParms << /Columns 4 /Predictor 12 >> /Root 1 0 R /Length %d >>\n"
+                 b"stream\n" % (size, size + 1, len(stream)))
+        data += stream + b"\nendstream\nendobj\n"
+    else:
+        data += b"xref\n0 %d\n0000000000 65535 f \n" % size
+        for offset in offsets:
+            data += b"%010d 00000 n \n" % offset
+        data += b"trailer\n<< /Size %d /Root 1 0 R >>\n" % size
+    data += b"startxref\n%d\n%%%%EOF\n" % xref_position
+    return bytes(data)
+
+def build_hybrid_pdf():
+    """Build a hybrid-reference PDF with an incremental update. The update replaces the image
+    of the original, a 100 DPI one, with a 300 DPI one that is only listed in the xref stream
+    of the update, while the previous section still lists the old image.
+
+    Returns:
+        (bytes, int): The PDF and the offset of the new image.
+    """
+    data = bytearray(build_pdf([b"/Width 850 /Height 1100"]))
+    previous_xref = int(data[data.rindex(b"startxref") + 10:].split()[0])
+    new_image = len(data)
+    data += (b"4 0 obj\n<< /Type /XObject /Subtype /Image /Width 2550 /Height 3300 "
+             b"/Length %d >>\nstream\n" % IMAGE_DATA_SIZE + bytes(IMAGE_DATA_SIZE)
+             + b"\nendstream\nendobj\n")
+    xref_stream = len(data)
+    row = bytes([1]) + new_image.to_bytes(4, 'big')
+    data += (b"5 0 obj\n<< /Type /XRef /Size 6 /W [1 4 0] /Index [4 1] /Length %d >>\n"
+             b"stream\n" % len(row) + row + b"\nendstream\nendobj\n")
+    xref_table = len(data)
+    data += b"xref\n0 1\n0000000000 65535 f \n"
+    data += (b"trailer\n<< /Size 6 /Root 1 0 R /Prev %d /XRefStm %d >>\n"
+             % (previous_xref, xref_stream))
+    data += b"startxref\n%d\n%%%%EOF\n" % xref_table
+    return bytes(data), new_image
+
+class InspectionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pdf_path = os.path.join(self.tmpdir.name, 'test.pdf')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_pdf(self, data):
+        with open(self.pdf_path, 'wb') as file:
+            file.write(data)
+
+    def test_inspect_empty_file(self):
+        self.write_pdf(b"")
+        self.assertIsNone(pdfebc_core.inspection.inspect_pdf(self.pdf_path))
+
+    def test_inspect_xref_table(self):
+        self.write_pdf(build_pdf([b"/Width 2550 /Height 3300 /Filter /DCTDecode"]))
+        inspection = pdfebc_core.inspection.inspect_pdf(self.pdf_path)
+        self.assertEqual(inspection.page_count, 1)
+        self.assertEqual(inspection.image_count, 1)
+        self.assertEqual(inspection.dct_image_bytes, IMAGE_DATA_SIZE)
+        self.assertFalse(inspection.uses_object_streams)
+        self.assertAlmostEqual(inspection.max_image_dpi, 300)
+
+    def test_inspect_xref_stream(self):
+        self.write_pdf(build_pdf([b"/Width 850 /Height 1100 /Filter [/FlateDecode]"],
+                                 use_xref_stream=True))
+        inspection = pdfebc_core.inspection.inspect_pdf(self.pdf_path)
+        self.assertEqual(inspection.image_count, 1)
+        self.assertEqual(inspection.flate_image_bytes, IMAGE_DATA_SIZE)
+        self.assertAlmostEqual(inspection.max_image_dpi, 100)
+
+    def test_inspect_hybrid_file_reads_xref_stream_before_previous_section(self):
+        data, new_image = build_hybrid_pdf()
+        offsets, _ = pdfebc_core.inspection._read_xref(data)
+        self.assertEqual(offsets[4], new_image)
+        self.write_pdf(data)
+        inspection = pdfebc_core.inspection.inspect_pdf(self.pdf_path)
+        self.assertEqual(inspection.image_count, 1)
+        self.assertAlmostEqual(inspection.max_image_dpi, 300)
+
+    def test_inspect_falls_back_to_scanning_with_broken_xref(self):
+        data = build_pdf([b"/Width 850 /Height 1100"])
+        data = data.replace(b"startxref", b"startxrfe")
+        self.write_pdf(data)
+        inspection = pdfebc_core.inspection.inspect_pdf(self.pdf_path)
+        self.assertEqual(inspection.image_count, 1)
+        self.assertEqual(inspection.raw_image_bytes, IMAGE_DATA_SIZE)
+
+    def test_estimate_high_dpi_raw_images_compress_well(self):
+        self.write_pdf(build_pdf([b"/Width 5100 /Height 6600"]))
+        inspection = pdfebc_core.inspection.inspect_pdf(self.pdf_path)
+        lossy_ratio, lossless_ratio = pdfebc_core.inspection.estimate_ratios(inspection)
+        self.assertLess(lossy_ratio, 0.1)
+        self.assertLess(lossless_ratio, 0.6)
+
+    def test_estimate_low_dpi_jpeg_images_compress_poorly(self):
+        self.write_pdf(build_pdf([b"/Width 600 /Height 800 /Filter /DCTDecode"]))
+        inspection = pdfebc_core.inspection.inspect_pdf(self.pdf_path)
+        lossy_ratio, lossless_ratio = pdfebc_core.inspection.estimate_ratios(inspection)
+        self.assertGreater(lossy_ratio, 0.8)
+        self.assertGreater(lossless_ratio, 0.95)
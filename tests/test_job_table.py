@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the job_table module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import os
+from unittest.mock import patch
+from .context import pdfebc_core
+from .test_batch import create_pdf_files
+
+job_table = pdfebc_core.job_table
+
+class JobTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = job_table.JobTable([('src', 'out')])
+        self.table.add('src/a.pdf', 'out/a.pdf', 10, 0)
+        self.table.add('src/sub/b\udcff.pdf', 'out/b-1234.pdf', 30, 0)
+        self.table.add('src/c.pdf', 'out/c.pdf', 20, 0)
+
+    def test_jobs_are_rebuilt_from_columns(self):
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(self.table[1], job_table.CompressionJob(
+            'src/sub/b\udcff.pdf', 'out/b-1234.pdf', 30, 0, 1))
+        self.assertEqual(self.table[-1].source_path, 'src/c.pdf')
+        with self.assertRaises(IndexError):
+            self.table[3]
+        self.assertEqual([job.output_path for job in self.table],
+                         ['out/a.pdf', 'out/b-1234.pdf', 'out/c.pdf'])
+
+    def test_sort_by_size_keeps_states_with_their_jobs(self):
+        self.table.set_state(2, job_table.DONE)
+        self.table.sort_by_size()
+        self.assertEqual([job.size for job in self.table], [30, 20, 10])
+        self.assertEqual([job.job_index for job in self.table], [0, 1, 2])
+        self.assertEqual([job.size for job in self.table.pending()], [30, 10])
+
+    def test_sort_by_size_in_chunks_is_stable(self):
+        table = job_table.JobTable()
+        sizes = [5, 7, 5, 1, 7, 5, 9, 1, 5, 7]
+        for index, size in enumerate(sizes):
+            table.add('src/{}.pdf'.format(index), 'out/{}.pdf'.format(index), size, 0)
+        with patch('pdfebc_core.job_table.SORT_CHUNK_SIZE', 3):
+            table.sort_by_size()
+        expected = sorted(range(len(sizes)), key=sizes.__getitem__, reverse=True)
+        self.assertEqual([job.source_path for job in table],
+                         ['src/{}.pdf'.format(index) for index in expected])
+        self.assertEqual([job.size for job in table], sorted(sizes, reverse=True))
+
+    def test_invalid_state(self):
+        with self.assertRaises(ValueError):
+            self.table.set_state(0, 7)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'jobs')
+            self.table.save(path)
+            self.table.set_state(0, job_table.DONE)
+            self.table.set_state(1, job_table.FAILED)
+            self.table.save_states(path)
+            loaded = job_table.JobTable.load(path)
+            self.assertEqual(list(loaded), list(self.table))
+            self.assertEqual(loaded.directory_pairs, [('src', 'out')])
+            self.assertEqual([job.job_index for job in loaded.pending()], [1, 2])
+            self.assertEqual(loaded.count(job_table.DONE), 1)
+            loaded.add('src/d.pdf', 'out/d.pdf', 5, 0)
+            self.assertEqual(loaded[3].output_path, 'out/d.pdf')
+            with open(path, 'wb') as file:
+                file.write(b'not a table')
+            with self.assertRaises(ValueError):
+                job_table.JobTable.load(path)
+
+class ResumableBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source_directory = os.path.join(self.tmpdir.name, 'src')
+        self.output_directory = os.path.join(self.tmpdir.name, 'out')
+        self.table_path = os.path.join(self.tmpdir.name, 'jobs')
+        os.mkdir(self.source_directory)
+        create_pdf_files(self.source_directory, [10, 20, 30, 40])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def compress(self, directory_pairs=None):
+        return pdfebc_core.batch.compress_directories(
+            directory_pairs or [(self.source_directory, self.output_directory)], 'gs',
+            max_workers=2, job_table_path=self.table_path)
+
+    def test_interrupted_batch_continues_from_job_table(self):
+        batch = self.compress()
+        next(batch)
+        batch.close()
+        table = job_table.JobTable.load(self.table_path)
+        self.assertEqual(table.count(job_table.DONE), 1)
+        results = list(self.compress())
+        self.assertEqual(results[-1].files, 3)
+        self.assertEqual(results[-1].failed, 0)
+        self.assertEqual(len(os.listdir(self.output_directory)), 4)
+        table = job_table.JobTable.load(self.table_path)
+        self.assertEqual(table.count(job_table.DONE), 4)
+
+    def test_job_table_of_another_batch(self):
+        list(self.compress())
+        with self.assertRaises(ValueError):
+            list(self.compress([(self.source_directory, self.tmpdir.name)]))
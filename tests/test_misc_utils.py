@@ -3,6 +3,8 @@
 
 Author: Simon Larsén
 """
+import os
+import tempfile
 from unittest.mock import patch, Mock
 from .context import pdfebc_core
 from .utils_test_abc import UtilsTestABC
@@ -50,3 +52,34 @@ class MiscUtilsTest(UtilsTestABC):
             three_args_formattable_string,
             *args)
         self.assertFalse(mock_callback.called)
+
+    def test_group_identical_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            contents = [b"a", b"bb", b"a", b"cc", b"bb"]
+            filepaths = []
+            for index, content in enumerate(contents):
+                filepath = os.path.join(tmpdir, str(index))
+                with open(filepath, 'wb') as file:
+                    file.write(content)
+                filepaths.append(filepath)
+            with patch('pdfebc_core.misc_utils.file_digest',
+                       wraps=pdfebc_core.misc_utils.file_digest) as mock_digest:
+                groups = pdfebc_core.misc_utils.group_identical_files(filepaths)
+        self.assertEqual(groups, [[filepaths[0], filepaths[2]],
+                                  [filepaths[1], filepaths[4]],
+                                  [filepaths[3]]])
+        # all files share their size with another file
+        self.assertEqual(mock_digest.call_count, 5)
+
+    def test_group_identical_files_only_hashes_size_collisions(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepaths = []
+            for index in range(3):
+                filepath = os.path.join(tmpdir, str(index))
+                with open(filepath, 'wb') as file:
+                    file.write(b"x" * index)
+                filepaths.append(filepath)
+            with patch('pdfebc_core.misc_utils.file_digest') as mock_digest:
+                groups = pdfebc_core.misc_utils.group_identical_files(filepaths)
+        self.assertEqual(groups, [[filepath] for filepath in filepaths])
+        self.assertFalse(mock_digest.called)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the outputs module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import multiprocessing
+import time
+import os
+from .context import pdfebc_core
+
+def hold_lock(output_path, locked, release):
+    with pdfebc_core.outputs.lock_output(output_path):
+        locked.set()
+        release.wait(10)
+
+def release_after(release, seconds):
+    time.sleep(seconds)
+    release.set()
+
+class OutputsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_ensure_directory_is_idempotent(self):
+        directory = os.path.join(self.tmpdir.name, 'a', 'b')
+        pdfebc_core.outputs.ensure_directory(directory)
+        pdfebc_core.outputs.ensure_directory(directory)
+        self.assertTrue(os.path.isdir(directory))
+
+    def test_plan_output_paths_without_collisions(self):
+        output_paths = pdfebc_core.outputs.plan_output_paths(['/a/x.pdf', '/a/y.pdf'], '/out')
+        self.assertEqual(output_paths, {'/a/x.pdf': '/out/x.pdf', '/a/y.pdf': '/out/y.pdf'})
+
+    def test_plan_output_paths_resolves_collisions_deterministically(self):
+        sources = ['/c/x.pdf', '/a/x.pdf', '/b/x.pdf']
+        output_paths = pdfebc_core.outputs.plan_output_paths(sources, '/out')
+        self.assertEqual(output_paths['/a/x.pdf'], '/out/x.pdf')
+        self.assertEqual(len(set(output_paths.values())), 3)
+        self.assertEqual(pdfebc_core.outputs.plan_output_paths(reversed(sources), '/out'),
+                         output_paths)
+        # the names of colliding files do not depend on the other colliding files
+        self.assertEqual(
+            pdfebc_core.outputs.plan_output_paths(['/a/x.pdf', '/c/x.pdf'], '/out')['/c/x.pdf'],
+            output_paths['/c/x.pdf'])
+
+    def test_lock_output_removes_lock_file(self):
+        output_path = os.path.join(self.tmpdir.name, 'out.pdf')
+        with pdfebc_core.outputs.lock_output(output_path) as waited:
+            self.assertFalse(waited)
+            self.assertEqual(len(os.listdir(self.tmpdir.name)), 1)
+        self.assertFalse(os.listdir(self.tmpdir.name))
+
+    def test_lock_output_waits_for_other_process(self):
+        output_path = os.path.join(self.tmpdir.name, 'out.pdf')
+        locked, release = multiprocessing.Event(), multiprocessing.Event()
+        holder = multiprocessing.Process(target=hold_lock, args=(output_path, locked, release))
+        holder.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            start = time.monotonic()
+            releaser = multiprocessing.Process(target=release_after, args=(release, 0.2))
+            releaser.start()
+            with pdfebc_core.outputs.lock_output(output_path) as waited:
+                self.assertTrue(waited)
+                self.assertGreaterEqual(time.monotonic() - start, 0.2)
+            releaser.join()
+        finally:
+            release.set()
+            holder.join()
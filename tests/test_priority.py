@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the priority module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import multiprocessing
+import os
+from unittest.mock import patch
+from .context import pdfebc_core
+
+priority = pdfebc_core.priority
+
+def report_priority(worker_priority, results):
+    priority.apply_priority(worker_priority)
+    results.put((os.getpriority(os.PRIO_PROCESS, 0), priority.io_priority(),
+                 os.sched_getaffinity(0)))
+
+class PriorityTest(unittest.TestCase):
+    def test_validate_rejects_invalid_priorities(self):
+        for invalid in (priority.WorkerPriority(nice=20),
+                        priority.WorkerPriority(io_class=7),
+                        priority.WorkerPriority(io_level=8),
+                        priority.WorkerPriority(cpus=set()),
+                        priority.WorkerPriority(cpus={os.cpu_count() + 1000})):
+            with self.assertRaises(ValueError):
+                priority.validate_priority(invalid)
+        priority.validate_priority(priority.WorkerPriority())
+
+    def test_apply_priority_in_worker(self):
+        cpu = min(os.sched_getaffinity(0))
+        worker_priority = priority.WorkerPriority(
+            nice=max(os.getpriority(os.PRIO_PROCESS, 0), 10),
+            io_class=priority.IOPRIO_CLASS_BE, io_level=7, cpus={cpu})
+        try:
+            priority.validate_priority(worker_priority)
+        except ValueError:
+            self.skipTest("I/O priorities are not supported here")
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=report_priority,
+                                         args=(worker_priority, results))
+        worker.start()
+        nice, io, cpus = results.get(timeout=10)
+        worker.join()
+        self.assertEqual(nice, worker_priority.nice)
+        self.assertEqual(io, (priority.IOPRIO_CLASS_BE, 7))
+        self.assertEqual(cpus, {cpu})
+
+    def test_apply_worker_priority_logs_instead_of_raising(self):
+        with patch('pdfebc_core.priority.apply_priority', side_effect=PermissionError()):
+            priority.apply_worker_priority(priority.WorkerPriority(nice=-20))
+
+class LoadAdaptiveLimitTest(unittest.TestCase):
+    def test_limit_follows_load_with_hysteresis(self):
+        limit = priority.LoadAdaptiveLimit(max_workers=3, load_threshold=4, interval=0)
+        loads = [5.0, 5.0, 5.0, 3.5, 2.9, 2.0, 1.0]
+        with patch('pdfebc_core.priority.os.getloadavg',
+                   side_effect=[(load, 0, 0) for load in loads]):
+            self.assertEqual([limit.limit() for _ in loads], [2, 1, 1, 1, 2, 3, 3])
+
+    def test_limit_is_only_adjusted_once_per_interval(self):
+        limit = priority.LoadAdaptiveLimit(max_workers=3, load_threshold=4, interval=60)
+        with patch('pdfebc_core.priority.os.getloadavg', return_value=(10.0, 0, 0)):
+            self.assertEqual([limit.limit() for _ in range(3)], [2, 2, 2])
+
+class PrioritizedBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_batch(self, memory_budget):
+        source_directory = os.path.join(self.tmpdir.name, 'src')
+        output_directory = os.path.join(self.tmpdir.name, 'out')
+        os.mkdir(source_directory)
+        for index in range(5):
+            with open(os.path.join(source_directory, '{}.pdf'.format(index)), 'wb') as file:
+                file.write(b'%PDF-1.4 ' + str(index).encode())
+        with patch('pdfebc_core.priority.os.getloadavg', return_value=(1000.0, 0, 0)):
+            results = list(pdfebc_core.batch.compress_directories(
+                [(source_directory, output_directory)], 'gs', max_workers=2,
+                memory_budget=memory_budget, priority=priority.WorkerPriority(nice=19),
+                load_threshold=1))
+        summary = results[-1]
+        self.assertEqual((summary.files, summary.failed), (5, 0))
+        self.assertEqual(len(os.listdir(output_directory)), 5)
+
+    def test_batch_with_priority_and_load_threshold(self):
+        self.check_batch(memory_budget=None)
+
+    def test_scheduled_batch_with_priority_and_load_threshold(self):
+        self.check_batch(memory_budget=10 * 1024**3)
+
+    def test_priority_is_applied_once_per_worker(self):
+        with patch('pdfebc_core.batch._priority_applied', False), \
+             patch('pdfebc_core.batch.apply_worker_priority') as apply, \
+             patch('pdfebc_core.batch.compress_pdf', return_value='result') as compress:
+            worker_priority = priority.WorkerPriority(nice=19)
+            for _ in range(2):
+                self.assertEqual(pdfebc_core.batch._compress_in_worker(
+                    worker_priority, 'a.pdf', 'out/a.pdf', 'gs', None), 'result')
+        apply.assert_called_once_with(worker_priority)
+        self.assertEqual(compress.call_count, 2)
+
+    def test_pool_is_created_without_initializer(self):
+        # ProcessPoolExecutor only takes an initializer from Python 3.7
+        with patch('pdfebc_core.batch.ProcessPoolExecutor',
+                   wraps=pdfebc_core.batch.ProcessPoolExecutor) as executor:
+            self.check_batch(memory_budget=None)
+        self.assertNotIn('initializer', executor.call_args[1])
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the profiles module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import os
+from unittest.mock import patch
+from .context import pdfebc_core
+
+profiles = pdfebc_core.profiles
+ConfigurationError = pdfebc_core.config_utils.ConfigurationError
+
+class ProfilesTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {pdfebc_core.config_utils.DEFAULT_SECTION_KEY: {
+            'gs_binary': 'gs', 'src': 'src', 'out': 'out', 'profile': 'kobo',
+            'profile.kobo': 'resolution=300, grayscale=yes, max_size=1264x1680',
+            'profile.tablet': 'resolution=264'}}
+
+    def test_parse_profile(self):
+        profile = profiles.parse_profile('kobo', ' resolution = 300 , grayscale=Yes,'
+                                                 'max_size=1264x1680')
+        self.assertEqual(profile, profiles.DeviceProfile('kobo', 300, True, (1264, 1680)))
+        self.assertEqual(profiles.parse_profile('tablet', 'resolution=264'),
+                         profiles.DeviceProfile('tablet', 264, False, None))
+
+    def test_parse_malformed_profiles(self):
+        for value in ('', 'grayscale=yes', 'resolution=0', 'resolution=high',
+                      'resolution=300, grayscale=maybe', 'resolution=300, max_size=1264',
+                      'resolution=300, max_size=0x10', 'resolution=300, depth=8',
+                      'resolution=300, resolution=200', 'resolution'):
+            with self.assertRaises(ConfigurationError, msg=value):
+                profiles.parse_profile('broken', value)
+
+    def test_profiles_from_config(self):
+        self.assertEqual(sorted(profiles.profiles_from_config(self.config)), ['kobo', 'tablet'])
+        self.assertEqual(profiles.profile_from_config(self.config).name, 'kobo')
+        self.assertEqual(profiles.profile_from_config(self.config, 'tablet').resolution, 264)
+        with self.assertRaises(ConfigurationError):
+            profiles.profile_from_config(self.config, 'phone')
+        del self.config[pdfebc_core.config_utils.DEFAULT_SECTION_KEY]['profile']
+        self.assertIsNone(profiles.profile_from_config(self.config))
+
+    def test_ghostscript_flags(self):
+        flags = profiles.ghostscript_flags(profiles.profile_from_config(self.config))
+        self.assertIn("-dColorImageResolution=300", flags)
+        self.assertIn("-dMonoImageResolution=600", flags)
+        self.assertIn("-sColorConversionStrategy=Gray", flags)
+        self.assertIn("-dSubsetFonts=true", flags)
+        # 1264 pixels at 300 dpi is 4.21 inches, or 303 points
+        self.assertIn("-dDEVICEWIDTHPOINTS=303", flags)
+        self.assertIn("-dPDFFitPage", flags)
+        flags = profiles.ghostscript_flags(profiles.profile_from_config(self.config, 'tablet'))
+        self.assertNotIn("-sColorConversionStrategy=Gray", flags)
+        self.assertNotIn("-dPDFFitPage", flags)
+
+    def test_ghostscript_command_with_profile(self):
+        profile = profiles.profile_from_config(self.config)
+        engine = pdfebc_core.engines.GhostscriptEngine('gs', profile)
+        command = engine.command('in.pdf', 'out.pdf')
+        self.assertEqual(command[-2:], ['-sOutputFile=out.pdf', 'in.pdf'])
+        self.assertLess(command.index('-dPDFSETTINGS=/ebook'),
+                        command.index('-dColorImageResolution=300'))
+        self.assertNotIn('-dColorImageResolution=300',
+                         pdfebc_core.engines.GhostscriptEngine('gs').command('in.pdf', 'out.pdf'))
+
+    def test_compress_pdf_with_profile(self):
+        profile = profiles.profile_from_config(self.config)
+        commands = []
+
+        def compress(engine, filepath, output_path, progress=None):
+            commands.append(engine.command(filepath, output_path))
+            with open(output_path, 'wb') as file:
+                file.write(b'%PDF-1.4 %%EOF')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source_path = os.path.join(tmpdir, 'in.pdf')
+            with open(source_path, 'wb') as file:
+                file.write(b'%PDF-1.4' + b'\0' * pdfebc_core.compress.FILE_SIZE_LOWER_LIMIT)
+            with patch('pdfebc_core.engines.GhostscriptEngine.compress', autospec=True,
+                       side_effect=compress):
+                result = pdfebc_core.compress.compress_pdf(
+                    source_path, os.path.join(tmpdir, 'out.pdf'), 'gs', profile=profile)
+        self.assertIsNone(result.skip_reason)
+        command, = commands
+        self.assertIn('-dColorImageResolution=300', command)
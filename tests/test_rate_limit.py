@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the rate_limit module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import asyncio
+import os
+from unittest.mock import patch
+from .context import pdfebc_core
+
+class FakeClock:
+    """A clock that only advances when something sleeps."""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TokenBucketTest(unittest.TestCase):
+    def test_refill_is_proportional_to_elapsed_time_and_capped(self):
+        bucket = pdfebc_core.rate_limit.TokenBucket(10, 60)
+        bucket.refill(0)
+        bucket.take(10)
+        bucket.refill(30)
+        self.assertAlmostEqual(bucket.tokens, 5)
+        bucket.refill(600)
+        self.assertEqual(bucket.tokens, 10)
+
+    def test_wait_time(self):
+        bucket = pdfebc_core.rate_limit.TokenBucket(10, 60)
+        bucket.refill(0)
+        self.assertEqual(bucket.wait_time(10), 0)
+        bucket.take(10)
+        self.assertAlmostEqual(bucket.wait_time(2), 12)
+
+    def test_capacity_below_one_token(self):
+        with self.assertRaises(ValueError):
+            pdfebc_core.rate_limit.TokenBucket(0.5, 60)
+
+class SendLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.clock = FakeClock()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        patchers = [patch('pdfebc_core.rate_limit.time.time', self.clock.time),
+                    patch('pdfebc_core.rate_limit.asyncio.sleep', self.clock.sleep)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def acquire_all(self, limiter, sizes):
+        order = []
+
+        async def acquire(index, size):
+            await limiter.acquire(size)
+            order.append((index, self.clock.now))
+
+        async def acquire_concurrently():
+            await asyncio.gather(*[acquire(index, size) for index, size in enumerate(sizes)])
+
+        self.loop.run_until_complete(acquire_concurrently())
+        return order
+
+    def test_sends_over_message_quota_are_queued_in_order(self):
+        limiter = pdfebc_core.rate_limit.SendLimiter(messages_per_minute=2)
+        order = self.acquire_all(limiter, [10] * 4)
+        self.assertEqual([index for index, _ in order], [0, 1, 2, 3])
+        times = [now - 1000 for _, now in order]
+        self.assertEqual(times[:2], [0, 0])
+        self.assertAlmostEqual(times[2], 30)
+        self.assertAlmostEqual(times[3], 60)
+
+    def test_sends_over_byte_quota_wait(self):
+        day = pdfebc_core.rate_limit.BYTES_PERIOD
+        limiter = pdfebc_core.rate_limit.SendLimiter(bytes_per_day=100)
+        order = self.acquire_all(limiter, [60, 60])
+        self.assertAlmostEqual(order[1][1] - 1000, day * 0.2)
+
+    def test_message_larger_than_daily_quota(self):
+        limiter = pdfebc_core.rate_limit.SendLimiter(bytes_per_day=100)
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(limiter.acquire(101))
+
+    def test_message_rate_below_one_per_minute(self):
+        for messages_per_minute in (0.5, 0, -1):
+            with self.assertRaises(ValueError):
+                pdfebc_core.rate_limit.SendLimiter(messages_per_minute=messages_per_minute)
+
+    def test_state_file_is_shared_between_limiters(self):
+        state_path = os.path.join(self.tmpdir.name, 'quota.json')
+        first = pdfebc_core.rate_limit.SendLimiter(messages_per_minute=1,
+                                                   state_path=state_path)
+        second = pdfebc_core.rate_limit.SendLimiter(messages_per_minute=1,
+                                                    state_path=state_path)
+        self.acquire_all(first, [10])
+        self.acquire_all(second, [10])
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertAlmostEqual(self.clock.now - 1000, 60)
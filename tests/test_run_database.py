@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the run_database module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import os
+from unittest.mock import patch
+from .context import pdfebc_core
+
+events = pdfebc_core.events
+
+class FakeTime:
+    """Stands in for the time module, with a clock that only moves when told to."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+class RunDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.database = pdfebc_core.run_database.RunDatabase(
+            os.path.join(self.tmpdir.name, 'data', 'runs.sqlite3'))
+        self.clock = FakeTime()
+        patcher = patch('pdfebc_core.run_database.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.probe = patch('pdfebc_core.run_database.probe_ghostscript',
+                           side_effect=FileNotFoundError('gs')).start()
+        self.addCleanup(patch.stopall)
+
+    def tearDown(self):
+        self.database.close()
+        self.tmpdir.cleanup()
+
+    def run_events(self, files, duration=1.0):
+        """Yield the events of a run where each file takes the given amount of seconds."""
+        yield events.Started('src', 'out', len(files))
+        for source_path, input_size, output_size in files:
+            yield events.FileStarted(source_path, 'out/' + source_path)
+            self.clock.now += duration
+            yield events.FileDone(source_path, 'out/' + source_path, input_size, output_size,
+                                  duration)
+        yield events.Finished('out', len(files), 0, 0, 0, 0)
+
+    def record(self, files, duration=1.0, profile=None, ghostscript_version=None):
+        return list(self.database.record(self.run_events(files, duration), profile,
+                                         ghostscript_version))
+
+    def test_record_passes_events_through_and_stores_run(self):
+        recorded = self.record([('a.pdf', 100, 40)], profile='/ebook',
+                               ghostscript_version='10.02.1')
+        self.assertIsInstance(recorded[0], events.Started)
+        self.assertIsInstance(recorded[-1], events.Finished)
+        run, = self.database.runs()
+        self.assertEqual((run.profile, run.ghostscript_version), ('/ebook', '10.02.1'))
+        self.assertEqual(run.finished - run.started, 1.0)
+        record, = self.database.files(run.run_id)
+        self.assertEqual((record.status, record.input_size, record.output_size, record.duration),
+                         (pdfebc_core.run_database.DONE, 100, 40, 1.0))
+
+    def test_duration_is_elapsed_time_of_event(self):
+        recorder = pdfebc_core.run_database.RunRecorder(self.database, ghostscript_version='10')
+        recorder(events.Started('src', 'out', 1))
+        recorder(events.FileStarted('a.pdf', 'out/a.pdf'))
+        # a slow consumer receives the final event long after the file was done
+        self.clock.now += 30
+        recorder(events.FileDone('a.pdf', 'out/a.pdf', 100, 40, 0.5))
+        recorder(events.Finished('out', 1, 0, 0, 0, 0))
+        record, = self.database.files(recorder.run_id)
+        self.assertEqual(record.duration, 0.5)
+
+    def test_ghostscript_version_is_probed(self):
+        self.probe.side_effect = None
+        self.probe.return_value = pdfebc_core.ghostscript.GhostscriptInfo(
+            path='/usr/bin/gs', version='10.03.0', devices=frozenset())
+        self.record([('a.pdf', 100, 40)])
+        self.probe.assert_called_once_with('gs')
+        run, = self.database.runs()
+        self.assertEqual(run.ghostscript_version, '10.03.0')
+
+    def test_ghostscript_version_is_empty_if_probe_fails(self):
+        self.record([('a.pdf', 100, 40)])
+        run, = self.database.runs()
+        self.assertIsNone(run.ghostscript_version)
+
+    def test_pending_files_are_written_if_run_raises(self):
+        def failing_run():
+            yield from list(self.run_events([('a.pdf', 100, 40), ('b.pdf', 100, 40)]))[:-1]
+            raise OSError("disk failure")
+        with self.assertRaises(OSError):
+            list(self.database.record(failing_run()))
+        run, = self.database.runs()
+        self.assertIsNone(run.finished)
+        self.assertEqual([record.source_path for record in self.database.files(run.run_id)],
+                         ['a.pdf', 'b.pdf'])
+
+    def test_statistics_by_profile(self):
+        self.record([('a.pdf', 100, 50), ('b.pdf', 300, 50)], duration=2, profile='/ebook')
+        self.record([('c.pdf', 100, 10)], duration=1, profile='/screen')
+        ebook, screen = self.database.statistics(group_by=pdfebc_core.run_database.PROFILE)
+        self.assertEqual((ebook.key, ebook.files, ebook.input_size, ebook.output_size),
+                         ('/ebook', 2, 400, 100))
+        self.assertEqual(ebook.ratio, 0.25)
+        self.assertEqual(ebook.throughput, 100)
+        self.assertEqual((screen.key, screen.ratio, screen.throughput), ('/screen', 0.1, 100))
+
+    def test_statistics_by_time_window(self):
+        self.record([('a.pdf', 100, 50)])
+        self.clock.now = 5000.0
+        self.record([('b.pdf', 100, 20)])
+        first, second = self.database.statistics(window=3600)
+        self.assertEqual((first.window_start, first.ratio), (0, 0.5))
+        self.assertEqual((second.window_start, second.ratio), (3600, 0.2))
+        only_second, = self.database.statistics(since=3600)
+        self.assertEqual(only_second.input_size, 100)
+        self.assertEqual(self.database.runs(until=3600)[0].source_directory, 'src')
+
+    def test_statistics_only_count_compressed_files(self):
+        recorder = pdfebc_core.run_database.RunRecorder(self.database)
+        for event in [events.Started('src', 'out', 2),
+                      events.FileStarted('x.pdf', 'out/x.pdf'),
+                      events.Failed('x.pdf', OSError()),
+                      events.FileStarted('y.pdf', 'out/y.pdf'),
+                      events.Deduplicated('y.pdf', 'out/y.pdf', 'x.pdf', 10),
+                      events.Finished('out', 0, 0, 1, 1, 10)]:
+            recorder(event)
+        statuses = [record.status for record in self.database.files(recorder.run_id)]
+        self.assertEqual(statuses, [pdfebc_core.run_database.FAILED,
+                                    pdfebc_core.run_database.DEDUPLICATED])
+        self.assertEqual(self.database.statistics(), [])
+
+    def test_invalid_group_raises(self):
+        with self.assertRaises(ValueError):
+            self.database.statistics(group_by='host')
+
+    def test_records_compress_multiple_pdfs(self):
+        source_directory = os.path.join(self.tmpdir.name, 'src')
+        os.mkdir(source_directory)
+        for name in ('a.pdf', 'b.pdf'):
+            with open(os.path.join(source_directory, name), 'wb') as file:
+                file.write(b'%PDF-1.4 ' + name.encode())
+        output_directory = os.path.join(self.tmpdir.name, 'out')
+        list(self.database.record(pdfebc_core.compress.compress_multiple_pdfs(
+            source_directory, output_directory, 'gs')))
+        run, = self.database.runs()
+        self.assertEqual(run.source_directory, source_directory)
+        records = self.database.files(run.run_id)
+        self.assertEqual(sorted(os.path.basename(record.source_path) for record in records),
+                         ['a.pdf', 'b.pdf'])
+        self.assertTrue(all(record.status == pdfebc_core.run_database.SKIPPED
+                            and record.input_size == record.output_size == 14
+                            for record in records))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the scheduling module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import threading
+import time
+import os
+from collections import namedtuple
+from unittest.mock import patch
+from .context import pdfebc_core
+
+MEGABYTE = 1024**2
+
+Job = namedtuple('Job', ['source_path', 'output_path', 'size'])
+
+class SchedulingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def create_job(self, name, size):
+        source_path = os.path.join(self.tmpdir.name, name + '.pdf')
+        with open(source_path, 'wb') as file:
+            file.write(b'0' * size)
+        return Job(source_path, os.path.join(self.tmpdir.name, name + '_out.pdf'), size)
+
+    def test_record_moves_estimates_towards_measurements(self):
+        scheduler = pdfebc_core.scheduling.MemoryBudgetScheduler(1024 * MEGABYTE, 1)
+        raw_estimate = scheduler.raw_estimate(10 * MEGABYTE, 10)
+        for _ in range(20):
+            scheduler.record(10 * MEGABYTE, 10, 2 * raw_estimate)
+        self.assertAlmostEqual(scheduler.estimate(10 * MEGABYTE, 10), 2 * raw_estimate,
+                               delta=raw_estimate * 0.01)
+
+    def test_run_keeps_estimated_memory_within_budget(self):
+        base = pdfebc_core.scheduling.BASE_MEMORY_ESTIMATE
+        # room for two of the jobs, but not three
+        scheduler = pdfebc_core.scheduling.MemoryBudgetScheduler(int(2.5 * base), 4)
+        jobs = [self.create_job(str(index), 10) for index in range(6)]
+        lock = threading.Lock()
+        concurrency = [0, 0]
+
+        def fake_run_in_child(*args):
+            with lock:
+                concurrency[0] += 1
+                concurrency[1] = max(concurrency)
+            time.sleep(0.05)
+            with lock:
+                concurrency[0] -= 1
+            return None, base
+
+        with patch('pdfebc_core.scheduling._run_in_child', side_effect=fake_run_in_child):
+            results = list(scheduler.run(jobs, 'gs'))
+        self.assertEqual(sorted(result.job for result in results), sorted(jobs))
+        self.assertEqual(concurrency[1], 2)
+
+    def test_run_inspects_each_job_once(self):
+        base = pdfebc_core.scheduling.BASE_MEMORY_ESTIMATE
+        # the jobs run one at a time, so each waits several rounds for room in the budget
+        scheduler = pdfebc_core.scheduling.MemoryBudgetScheduler(int(1.5 * base), 4)
+        jobs = [self.create_job(str(index), 10) for index in range(4)]
+
+        def fake_run_in_child(*args):
+            time.sleep(0.02)
+            return None, base
+
+        with patch('pdfebc_core.scheduling._run_in_child', side_effect=fake_run_in_child), \
+             patch('pdfebc_core.scheduling._page_count', return_value=None) as page_count:
+            results = list(scheduler.run(jobs, 'gs'))
+        self.assertEqual(len(results), 4)
+        self.assertEqual(sorted(call[0][0] for call in page_count.call_args_list),
+                         sorted(job.source_path for job in jobs))
+
+    def test_run_admits_job_larger_than_budget_alone(self):
+        scheduler = pdfebc_core.scheduling.MemoryBudgetScheduler(1, 4)
+        jobs = [self.create_job(str(index), 10) for index in range(2)]
+        with patch('pdfebc_core.scheduling._run_in_child', return_value=(None, 1)):
+            results = list(scheduler.run(jobs, 'gs'))
+        self.assertEqual(len(results), 2)
+
+    def test_run_measures_peak_rss_of_child(self):
+        # the file is below the size limit, so it is copied without Ghostscript
+        job = self.create_job('small', 10)
+        scheduler = pdfebc_core.scheduling.MemoryBudgetScheduler(1024 * MEGABYTE, 1)
+        result, = scheduler.run([job], 'gs')
+        self.assertIsNone(result.error)
+        self.assertGreater(result.peak_rss, MEGABYTE)
+        self.assertTrue(os.path.isfile(job.output_path))
+
+    def test_run_reports_error_of_child(self):
+        job = self.create_job('missing', 10)
+        os.remove(job.source_path)
+        scheduler = pdfebc_core.scheduling.MemoryBudgetScheduler(1024 * MEGABYTE, 1)
+        result, = scheduler.run([job], 'gs')
+        self.assertIsInstance(result.error, FileNotFoundError)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the tracing module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import subprocess
+import asyncio
+import json
+import os
+from unittest.mock import patch, Mock
+from email.mime.multipart import MIMEMultipart
+from .context import pdfebc_core
+
+tracing = pdfebc_core.tracing
+
+def async_mock():
+    """Return a Mock whose calls return coroutines, like unittest.mock.AsyncMock of Python 3.8
+    and later.
+    """
+    async def coroutine(*args, **kwargs):
+        return None
+    return Mock(side_effect=coroutine)
+
+class TracingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        tracing.disable()
+        self.tmpdir.cleanup()
+
+    def span_names(self, tracer):
+        return [event['name'] for event in tracer.events]
+
+    def test_spans_are_not_recorded_when_off(self):
+        tracer = tracing.Tracer()
+        with tracing.span('a'):
+            pass
+        self.assertIs(tracing.span('a'), tracing.span('b'))
+        self.assertEqual(tracing.traced('c')(lambda x: x + 1)(1), 2)
+        self.assertEqual(tracer.events, [])
+
+    def test_span_when_off_passes_exceptions_on(self):
+        with self.assertRaises(KeyError):
+            with tracing.span('a'):
+                raise KeyError('a')
+
+    def test_nested_spans(self):
+        @tracing.traced('inner')
+        def inner():
+            return 42
+
+        with tracing.tracing() as tracer:
+            with tracing.span('outer', key='value'):
+                self.assertEqual(inner(), 42)
+        inner_event, outer_event = tracer.events
+        self.assertEqual((inner_event['name'], outer_event['name']), ('inner', 'outer'))
+        self.assertEqual(outer_event['args'], {'key': 'value'})
+        self.assertLessEqual(outer_event['ts'], inner_event['ts'])
+        self.assertGreaterEqual(outer_event['ts'] + outer_event['dur'],
+                                inner_event['ts'] + inner_event['dur'])
+        self.assertIsNone(tracing.disable())
+
+    def test_span_records_child_usage(self):
+        with tracing.tracing() as tracer:
+            with tracing.span('child', children=True):
+                subprocess.run(['true'], check=True)
+        event, = tracer.events
+        self.assertIn('children_user_time', event['args'])
+        self.assertIn('children_system_time', event['args'])
+
+    def test_export_chrome_trace(self):
+        with tracing.tracing() as tracer:
+            with tracing.span('a'):
+                pass
+        path = os.path.join(self.tmpdir.name, 'trace.json')
+        tracer.export(path)
+        with open(path, encoding='utf-8') as file:
+            trace = json.load(file)
+        event, = trace['traceEvents']
+        self.assertEqual((event['name'], event['ph']), ('a', 'X'))
+        self.assertEqual(event['pid'], os.getpid())
+
+    def test_traces_compress_multiple_pdfs(self):
+        source_directory = os.path.join(self.tmpdir.name, 'src')
+        os.mkdir(source_directory)
+        with open(os.path.join(source_directory, 'a.pdf'), 'wb') as file:
+            file.write(b'%PDF-1.4')
+        with tracing.tracing() as tracer:
+            list(pdfebc_core.compress.compress_multiple_pdfs(
+                source_directory, os.path.join(self.tmpdir.name, 'out'), 'gs'))
+        self.assertEqual(sorted(self.span_names(tracer)),
+                         ['compress_pdf', 'copy', 'move_into_place', 'scan'])
+
+    def test_traces_send_email_steps(self):
+        server = Mock(spec_set=['connect', 'starttls', 'login', 'send_message', 'quit',
+                                'supports_extension'])
+        for name in ('connect', 'starttls', 'login', 'send_message', 'quit'):
+            setattr(server, name, async_mock())
+        server.supports_extension.return_value = False
+        config = {pdfebc_core.config_utils.EMAIL_SECTION_KEY: {
+            'user': 'u', 'pass': 'p', 'receiver': 'r', 'smtp_server': 'localhost',
+            'smtp_port': '25'}}
+        loop = asyncio.new_event_loop()
+        try:
+            with patch('pdfebc_core.email_utils.aiosmtplib.SMTP', return_value=server), \
+                 tracing.tracing() as tracer:
+                loop.run_until_complete(
+                    pdfebc_core.email_utils._send_email(MIMEMultipart(), config, loop))
+        finally:
+            loop.close()
+        self.assertEqual(self.span_names(tracer),
+                         ['connect', 'starttls', 'login', 'send', 'quit'])
+
+    def test_traces_attaching_files(self):
+        path = os.path.join(self.tmpdir.name, 'a.pdf')
+        with open(path, 'wb') as file:
+            file.write(b'%PDF-1.4')
+        loop = asyncio.new_event_loop()
+        try:
+            with tracing.tracing() as tracer:
+                loop.run_until_complete(pdfebc_core.email_utils._attach_files_concurrently(
+                    [path], MIMEMultipart(), loop=loop))
+        finally:
+            loop.close()
+        event, = tracer.events
+        self.assertEqual((event['name'], event['args']), ('attach', {'files': 1}))
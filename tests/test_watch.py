@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the watch module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import threading
+import queue
+import os
+from unittest.mock import patch
+from .context import pdfebc_core
+
+class StabilityTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'a.pdf')
+        with open(self.path, 'wb') as file:
+            file.write(b'%PDF')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_file_is_stable_after_settle_time(self):
+        tracker = pdfebc_core.watch.StabilityTracker(settle_time=1)
+        tracker.touch(self.path, 0)
+        self.assertEqual(tracker.pop_stable(0.5), [])
+        self.assertEqual(tracker.next_deadline(), 1)
+        self.assertEqual(tracker.pop_stable(1), [self.path])
+        self.assertEqual(len(tracker), 0)
+
+    def test_growing_file_is_not_stable(self):
+        tracker = pdfebc_core.watch.StabilityTracker(settle_time=1)
+        tracker.touch(self.path, 0)
+        with open(self.path, 'ab') as file:
+            file.write(b'-1.4')
+        # the change was not reported, but is noticed when the file is checked
+        self.assertEqual(tracker.pop_stable(1), [])
+        self.assertEqual(tracker.pop_stable(1.5), [])
+        self.assertEqual(tracker.pop_stable(2), [self.path])
+
+    def test_removed_file_is_forgotten(self):
+        tracker = pdfebc_core.watch.StabilityTracker(settle_time=1)
+        tracker.touch(self.path, 0)
+        os.remove(self.path)
+        tracker.touch(self.path, 0.5)
+        self.assertEqual(len(tracker), 0)
+
+    def test_pop_stable_respects_limit(self):
+        tracker = pdfebc_core.watch.StabilityTracker(settle_time=1)
+        other_path = os.path.join(self.tmpdir.name, 'b.pdf')
+        with open(other_path, 'wb') as file:
+            file.write(b'%PDF')
+        tracker.touch(other_path, 0)
+        tracker.touch(self.path, 0.5)
+        self.assertEqual(tracker.pop_stable(2, limit=1), [other_path])
+        self.assertEqual(tracker.pop_stable(2, limit=1), [self.path])
+
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_watcher_reports_changes(self, watcher):
+        try:
+            path = os.path.join(self.tmpdir.name, 'a.pdf')
+            with open(path, 'wb') as file:
+                file.write(b'%PDF')
+            self.assertIn('a.pdf', watcher.changes(1))
+            self.assertEqual(watcher.changes(0.1), set())
+            with open(path, 'ab') as file:
+                file.write(b'-1.4 more content')
+            self.assertIn('a.pdf', watcher.changes(1))
+        finally:
+            watcher.close()
+
+    def test_polling_watcher_reports_changes(self):
+        self.check_watcher_reports_changes(
+            pdfebc_core.watch.PollingWatcher(self.tmpdir.name, interval=0.05))
+
+    def test_inotify_watcher_reports_changes(self):
+        try:
+            watcher = pdfebc_core.watch.InotifyWatcher(self.tmpdir.name)
+        except OSError:
+            self.skipTest("inotify is not available")
+        self.check_watcher_reports_changes(watcher)
+
+    def test_create_watcher_falls_back_to_polling(self):
+        watcher = pdfebc_core.watch.create_watcher(self.tmpdir.name, use_inotify=False)
+        self.assertIsInstance(watcher, pdfebc_core.watch.PollingWatcher)
+
+class WatchDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source_directory = os.path.join(self.tmpdir.name, 'src')
+        self.output_directory = os.path.join(self.tmpdir.name, 'out')
+        os.mkdir(self.source_directory)
+        self.events = queue.Queue()
+        self.stop = threading.Event()
+
+    def tearDown(self):
+        self.stop.set()
+        self.tmpdir.cleanup()
+
+    def start(self, **kwargs):
+        kwargs.setdefault('settle_time', 0.1)
+        kwargs.setdefault('poll_interval', 0.05)
+        thread = threading.Thread(target=pdfebc_core.watch.watch_directory,
+                                  args=(self.source_directory, self.output_directory, 'gs',
+                                        self.stop, self.events.put),
+                                  kwargs=dict(max_workers=2, **kwargs))
+        thread.start()
+        return thread
+
+    def drop(self, name, content=b'%PDF-1.4 content %%EOF'):
+        # the files are below the size limit, so they are copied without Ghostscript
+        path = os.path.join(self.source_directory, name)
+        with open(path, 'wb') as file:
+            file.write(content)
+        return path
+
+    def finished_event(self):
+        while True:
+            event = self.events.get(timeout=10)
+            if not isinstance(event, pdfebc_core.events.FileStarted):
+                return event
+
+    def check_compresses_dropped_files(self, use_inotify):
+        existing_path = self.drop('existing.pdf')
+        thread = self.start(use_inotify=use_inotify)
+        try:
+            self.assertEqual(self.finished_event().source_path, existing_path)
+            dropped_path = self.drop('dropped.pdf')
+            self.drop('ignored.txt')
+            event = self.finished_event()
+            self.assertIsInstance(event, pdfebc_core.events.Skipped)
+            self.assertEqual(event.source_path, dropped_path)
+            with open(event.output_path, 'rb') as file:
+                self.assertEqual(file.read(), b'%PDF-1.4 content %%EOF')
+        finally:
+            self.stop.set()
+            thread.join(10)
+        self.assertEqual(sorted(os.listdir(self.output_directory)),
+                         ['dropped.pdf', 'existing.pdf'])
+
+    def test_compresses_dropped_files_with_inotify(self):
+        self.check_compresses_dropped_files(use_inotify=True)
+
+    def test_compresses_dropped_files_with_polling(self):
+        self.check_compresses_dropped_files(use_inotify=False)
+
+    def test_skips_files_with_complete_outputs(self):
+        self.drop('done.pdf')
+        os.mkdir(self.output_directory)
+        with open(os.path.join(self.output_directory, 'done.pdf'), 'wb') as file:
+            file.write(b'%PDF-1.4 content %%EOF')
+        thread = self.start()
+        try:
+            dropped_path = self.drop('new.pdf')
+            self.assertEqual(self.finished_event().source_path, dropped_path)
+        finally:
+            self.stop.set()
+            thread.join(10)
+        self.assertTrue(self.events.empty())
+
+    def test_mails_outputs_together(self):
+        sent = []
+
+        async def send_with_attachments(subject, message, filepaths, config):
+            sent.append(sorted(os.path.basename(path) for path in filepaths))
+
+        with patch('pdfebc_core.email_utils.send_with_attachments', send_with_attachments):
+            thread = self.start(mail_config={'EMAIL': {}}, mail_delay=60)
+            try:
+                self.drop('a.pdf')
+                self.drop('b.pdf')
+                self.finished_event()
+                self.finished_event()
+                self.assertEqual(sent, [])
+            finally:
+                self.stop.set()
+                thread.join(10)
+        self.assertEqual(sent, [['a.pdf', 'b.pdf']])
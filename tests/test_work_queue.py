@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the work_queue module.
+
+Author: Simon Larsén
+"""
+import unittest
+import tempfile
+import multiprocessing
+import threading
+import time
+import os
+from collections import namedtuple
+from unittest.mock import patch
+from .context import pdfebc_core
+
+Job = namedtuple('Job', ['source_path', 'output_path'])
+
+def run_worker(queue_directory):
+    pdfebc_core.work_queue.run_worker(queue_directory, 'gs', lease_timeout=1,
+                                      poll_interval=0.05)
+
+def lease_and_hang(queue_directory, leased):
+    queue = pdfebc_core.work_queue.WorkQueue(queue_directory)
+    while queue.lease('dead') is None:
+        time.sleep(0.01)
+    leased.set()
+    time.sleep(60)
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.queue_directory = os.path.join(self.tmpdir.name, 'queue')
+        self.output_directory = os.path.join(self.tmpdir.name, 'out')
+        os.mkdir(self.output_directory)
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        self.tmpdir.cleanup()
+
+    def create_jobs(self, amount):
+        jobs = []
+        for index in range(amount):
+            # the files are below the size limit, so they are copied without Ghostscript
+            source_path = os.path.join(self.tmpdir.name, '{}.pdf'.format(index))
+            with open(source_path, 'wb') as file:
+                file.write(b'%PDF-1.4 ' + str(index).encode())
+            jobs.append(Job(source_path, os.path.join(self.output_directory,
+                                                      '{}.pdf'.format(index))))
+        return jobs
+
+    def start_workers(self, amount):
+        for _ in range(amount):
+            worker = multiprocessing.Process(target=run_worker, args=(self.queue_directory,))
+            worker.start()
+            self.workers.append(worker)
+
+    def test_job_is_leased_only_once(self):
+        queue = pdfebc_core.work_queue.WorkQueue(self.queue_directory)
+        job, = self.create_jobs(1)
+        job_id = queue.submit(job.source_path, job.output_path, 'gs')
+        lease = queue.lease('a')
+        self.assertEqual(lease.job_id, job_id)
+        self.assertEqual(lease.job['attempts'], 1)
+        self.assertIsNone(queue.lease('b'))
+
+    def test_jobs_are_leased_in_submission_order(self):
+        queue = pdfebc_core.work_queue.WorkQueue(self.queue_directory)
+        jobs = self.create_jobs(8)
+        for job in jobs:
+            queue.submit(job.source_path, job.output_path, 'gs')
+        leased = [queue.lease('worker').job['source_path'] for _ in jobs]
+        self.assertEqual(leased, [job.source_path for job in jobs])
+        self.assertIsNone(queue.lease('worker'))
+
+    def test_jobs_are_leased_by_order_across_listings(self):
+        queue = pdfebc_core.work_queue.WorkQueue(self.queue_directory)
+        jobs = self.create_jobs(5)
+        for order, job in reversed(list(enumerate(jobs))):
+            queue.submit(job.source_path, job.output_path, 'gs', order=order)
+        with patch('pdfebc_core.work_queue.LEASE_BATCH_SIZE', 2):
+            leased = [queue.lease('worker').job['source_path'] for _ in jobs]
+        self.assertEqual(leased, [job.source_path for job in jobs])
+
+    def test_requeue_gives_up_after_max_attempts(self):
+        queue = pdfebc_core.work_queue.WorkQueue(self.queue_directory)
+        job, = self.create_jobs(1)
+        job_id = queue.submit(job.source_path, job.output_path, 'gs')
+        queue.lease('a')
+        queue.requeue(job_id, max_attempts=2)
+        self.assertEqual(queue.lease('b').job['attempts'], 2)
+        queue.requeue(job_id, max_attempts=2)
+        self.assertIsNone(queue.lease('c'))
+        record = queue.records()[job_id]
+        self.assertEqual(record.worker, 'b')
+        self.assertIn('TimeoutError', record.error)
+
+    def test_expired_lease_can_not_be_completed(self):
+        queue = pdfebc_core.work_queue.WorkQueue(self.queue_directory)
+        job, = self.create_jobs(1)
+        job_id = queue.submit(job.source_path, job.output_path, 'gs')
+        expired = queue.lease('a')
+        queue.requeue(job_id)
+        current = queue.lease('b')
+        self.assertNotEqual(expired.path, current.path)
+        self.assertFalse(queue.renew(expired))
+        self.assertFalse(queue.complete(expired, error=OSError()))
+        self.assertTrue(os.path.isfile(current.path))
+        self.assertFalse(queue.records())
+        self.assertTrue(queue.complete(current))
+        self.assertEqual(queue.records()[job_id].worker, 'b')
+        self.assertFalse(queue.leased_jobs())
+
+    def test_coordinate_with_several_worker_processes(self):
+        jobs = self.create_jobs(12)
+        self.start_workers(3)
+        records = list(pdfebc_core.work_queue.coordinate(jobs, self.queue_directory, 'gs',
+                                                         lease_timeout=1, poll_interval=0.05))
+        self.assertEqual(sorted(record.source_path for record in records),
+                         sorted(job.source_path for job in jobs))
+        self.assertTrue(all(record.error is None for record in records))
+        # the records are removed as they are collected
+        self.assertFalse(os.listdir(os.path.join(self.queue_directory,
+                                                 pdfebc_core.work_queue.DONE_DIRECTORY)))
+        for job in jobs:
+            with open(job.source_path, 'rb') as source, open(job.output_path, 'rb') as output:
+                self.assertEqual(source.read(), output.read())
+
+    def test_coordinate_jobs_of_table_and_leave_records_of_other_runs(self):
+        queue = pdfebc_core.work_queue.WorkQueue(self.queue_directory)
+        old_job, *jobs = self.create_jobs(3)
+        old_id = queue.submit(old_job.source_path, old_job.output_path, 'gs', 0, 'old')
+        queue.complete(queue.lease('worker'))
+        table = pdfebc_core.job_table.JobTable()
+        for job in jobs:
+            table.add(job.source_path, job.output_path, os.stat(job.source_path).st_size, 0)
+        self.start_workers(1)
+        records = list(pdfebc_core.work_queue.coordinate(table.pending(), self.queue_directory,
+                                                         'gs', lease_timeout=1,
+                                                         poll_interval=0.05))
+        self.assertEqual(sorted(record.source_path for record in records),
+                         sorted(job.source_path for job in jobs))
+        self.assertEqual(list(queue.records()), [old_id])
+
+    def test_coordinate_redispatches_job_of_dead_worker(self):
+        job, = self.create_jobs(1)
+        leased = multiprocessing.Event()
+        dead_worker = multiprocessing.Process(target=lease_and_hang,
+                                              args=(self.queue_directory, leased))
+        dead_worker.start()
+        self.workers.append(dead_worker)
+        records = []
+        coordinator = threading.Thread(target=lambda: records.extend(
+            pdfebc_core.work_queue.coordinate([job], self.queue_directory, 'gs',
+                                              lease_timeout=0.3, poll_interval=0.05)))
+        coordinator.start()
+        self.assertTrue(leased.wait(10))
+        dead_worker.kill()
+        self.start_workers(1)
+        coordinator.join(10)
+        record, = records
+        self.assertEqual(record.attempts, 2)
+        self.assertNotEqual(record.worker, 'dead')
+        self.assertIsNone(record.error)
+        self.assertTrue(os.path.isfile(job.output_path))